@@ -0,0 +1,394 @@
+"""
+batch
+=====
+
+Register many brains in one invocation. The brains (and their pixel sizes
+and orientations) are listed in a manifest, and registered by a pool of
+worker processes, which share the atlas loaded by the main process.
+"""
+
+import os
+import csv
+import logging
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+
+from fancylog import fancylog
+from imlib.general.system import ensure_directory_exists, get_num_processes
+from imlib.general.numerical import check_positive_int
+
+from amap.cli import (
+    visualisation_parser,
+    registration_parse,
+    pixel_parser,
+    geometry_parser,
+    misc_parse,
+    copy_registration_config,
+    prep_atlas,
+    get_registration_options,
+)
+from amap.config.atlas import Atlas
+from amap.download.cli import atlas_parser, download_directory_parser
+from amap.main import main as register
+import amap as program_for_log
+
+REQUIRED_COLUMNS = ("image_paths", "registration_output_folder")
+PER_BRAIN_OPTIONS = (
+    "x_pixel_um",
+    "y_pixel_um",
+    "z_pixel_um",
+    "orientation",
+    "flip_x",
+    "flip_y",
+    "flip_z",
+)
+
+# the atlas shared by the jobs in a worker process
+_atlas = None
+
+
+class ManifestError(Exception):
+    pass
+
+
+def batch_cli_parser():
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser = batch_parse(parser)
+    parser = visualisation_parser(parser)
+    parser = registration_parse(parser)
+    parser = pixel_parser(parser)
+    parser = geometry_parser(parser)
+    parser = misc_parse(parser)
+    parser = atlas_parser(parser)
+    parser = download_directory_parser(parser)
+    return parser
+
+
+def batch_parse(parser):
+    batch_parser = parser.add_argument_group("amap batch options")
+    batch_parser.add_argument(
+        dest="manifest",
+        type=str,
+        help="CSV or YAML file listing the brains to register. Each brain "
+        "needs an 'image_paths' and a 'registration_output_folder', and "
+        "may set its own 'x_pixel_um', 'y_pixel_um', 'z_pixel_um', "
+        "'orientation', 'flip_x', 'flip_y', 'flip_z' and 'downsample' "
+        "(additional channels, separated by ';'). Otherwise the command "
+        "line options are used.",
+    )
+    batch_parser.add_argument(
+        dest="batch_output_folder",
+        type=str,
+        help="Directory to save the batch log and summary into",
+    )
+    batch_parser.add_argument(
+        "--concurrent-jobs",
+        dest="concurrent_jobs",
+        type=check_positive_int,
+        default=2,
+        help="How many brains to register at the same time.",
+    )
+    batch_parser.add_argument(
+        "--threads-per-job",
+        dest="threads_per_job",
+        type=check_positive_int,
+        default=None,
+        help="How many threads each registration (and NiftyReg) may use. "
+        "Defaults to sharing the available CPU cores between the "
+        "concurrent jobs.",
+    )
+    return parser
+
+
+def str_to_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("true", "yes", "1", "y")
+
+
+def load_manifest_rows(manifest_path):
+    """
+    Read the rows of a CSV or YAML manifest. A YAML manifest may be a list
+    of brains, or a mapping with the list under "brains".
+
+    :param manifest_path: The manifest
+    :return: List of dicts, one per brain
+    :rtype: list
+    """
+    manifest_path = str(manifest_path)
+    if manifest_path.endswith((".yaml", ".yml")):
+        import yaml
+
+        with open(manifest_path, "r") as manifest_file:
+            rows = yaml.safe_load(manifest_file)
+        if isinstance(rows, dict):
+            rows = rows.get("brains", [])
+    elif manifest_path.endswith(".csv"):
+        with open(manifest_path, "r", newline="") as manifest_file:
+            rows = list(csv.DictReader(manifest_file))
+    else:
+        raise ManifestError(
+            f"Unknown manifest type: {manifest_path}. "
+            f"Only CSV and YAML are supported."
+        )
+    return [
+        {
+            key.strip(): value
+            for key, value in row.items()
+            if value is not None and value != ""
+        }
+        for row in rows
+    ]
+
+
+def read_manifest(manifest_path, defaults):
+    """
+    Read a manifest of brains to register, filling in any per-brain options
+    not in the manifest from the defaults.
+
+    :param manifest_path: The CSV or YAML manifest
+    :param dict defaults: The default per-brain options (PER_BRAIN_OPTIONS)
+    :return: List of jobs (dicts of the per-brain arguments of
+        amap.main.main)
+    :rtype: list
+    :raises ManifestError: If a brain is missing a required value
+    """
+    manifest_directory = Path(manifest_path).parent
+    jobs = []
+    for idx, row in enumerate(load_manifest_rows(manifest_path)):
+        for column in REQUIRED_COLUMNS:
+            if column not in row:
+                raise ManifestError(
+                    f"Brain {idx} in the manifest has no {column}"
+                )
+        job = {
+            option: row.get(option, defaults[option])
+            for option in PER_BRAIN_OPTIONS
+        }
+        for axis in ("x", "y", "z"):
+            option = f"{axis}_pixel_um"
+            if job[option] is None:
+                raise ManifestError(
+                    f"Brain {idx} in the manifest has no {option}, and no "
+                    f"default was given"
+                )
+            job[option] = float(job[option])
+        for option in ("flip_x", "flip_y", "flip_z"):
+            job[option] = str_to_bool(job[option])
+
+        # relative paths are relative to the manifest
+        for column in REQUIRED_COLUMNS:
+            job[column] = os.path.abspath(
+                os.path.join(
+                    manifest_directory, os.path.expanduser(row[column])
+                )
+            )
+
+        downsample = row.get("downsample", [])
+        if isinstance(downsample, str):
+            downsample = [
+                path.strip() for path in downsample.split(";") if path.strip()
+            ]
+        job["additional_images_downsample"] = {
+            Path(path).name: os.path.abspath(
+                os.path.join(manifest_directory, path)
+            )
+            for path in downsample
+        }
+        jobs.append(job)
+    return jobs
+
+
+def get_thread_budget(concurrent_jobs, threads_per_job=None, n_free_cpus=2):
+    """
+    Split the available CPU cores between the concurrent jobs.
+
+    :param int concurrent_jobs: How many brains to register at once
+    :param int threads_per_job: How many threads each job may use. If None,
+        the available cores are shared equally between the jobs
+    :param int n_free_cpus: How many CPU cores to leave free
+    :return: The number of threads per job
+    :rtype: int
+    """
+    if threads_per_job is None:
+        n_cpus = get_num_processes(min_free_cpu_cores=n_free_cpus)
+        threads_per_job = max(1, n_cpus // concurrent_jobs)
+    return threads_per_job
+
+
+def _init_worker(atlas):
+    global _atlas
+    _atlas = atlas
+
+
+def register_job(registration_config, job, registration_options, n_threads):
+    """
+    Register a single brain of the batch (in a worker process).
+
+    :param registration_config: The amap config file
+    :param dict job: The per-brain arguments of amap.main.main
+    :param dict registration_options: The arguments of amap.main.main
+        shared by all the brains
+    :param int n_threads: The number of threads for this registration
+    :return: The output folder, the time taken (not including any time
+        queued for a worker), and the error (or None if the registration
+        succeeded)
+    """
+    start_time = datetime.now()
+    output_folder = job["registration_output_folder"]
+    ensure_directory_exists(output_folder)
+    copy_registration_config(registration_config, output_folder)
+
+    log_handler = logging.FileHandler(os.path.join(output_folder, "amap.log"))
+    log_handler.setFormatter(
+        logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+    )
+    logger = logging.getLogger()
+    logger.addHandler(log_handler)
+    try:
+        logging.info(f"Registering: {job['image_paths']}")
+        register(
+            registration_config,
+            job["image_paths"],
+            output_folder,
+            atlas=_atlas,
+            n_processes=n_threads,
+            **{
+                key: value
+                for key, value in job.items()
+                if key not in REQUIRED_COLUMNS
+            },
+            **registration_options,
+        )
+        return output_folder, datetime.now() - start_time, None
+    except Exception as err:
+        logging.exception(f"Registration of {job['image_paths']} failed")
+        return (
+            output_folder,
+            datetime.now() - start_time,
+            f"{type(err).__name__}: {err}",
+        )
+    finally:
+        logger.removeHandler(log_handler)
+        log_handler.close()
+
+
+def run_batch(
+    registration_config,
+    jobs,
+    registration_options,
+    concurrent_jobs=2,
+    threads_per_job=None,
+    n_free_cpus=2,
+):
+    """
+    Register a batch of brains over a pool of worker processes. The atlas
+    is loaded once, and shared by all the workers.
+
+    :param registration_config: The amap config file
+    :param list jobs: The per-brain arguments of amap.main.main
+    :param dict registration_options: The arguments of amap.main.main
+        shared by all the brains
+    :param int concurrent_jobs: How many brains to register at once
+    :param int threads_per_job: How many threads each registration may use.
+        If None, the available cores are shared between the jobs
+    :param int n_free_cpus: How many CPU cores to leave free
+    :return: List of (output folder, time taken, error) for each brain
+    :rtype: list
+    """
+    n_threads = get_thread_budget(
+        concurrent_jobs,
+        threads_per_job=threads_per_job,
+        n_free_cpus=n_free_cpus,
+    )
+    logging.info(
+        f"Registering {len(jobs)} brains, {concurrent_jobs} at a time with "
+        f"{n_threads} threads each"
+    )
+
+    logging.info("Loading atlas")
+    atlas = Atlas(registration_config)
+    atlas.load_all(in_memory=True)
+
+    results = []
+    with ProcessPoolExecutor(
+        max_workers=concurrent_jobs,
+        initializer=_init_worker,
+        initargs=(atlas,),
+    ) as executor:
+        futures = [
+            executor.submit(
+                register_job,
+                registration_config,
+                job,
+                registration_options,
+                n_threads,
+            )
+            for job in jobs
+        ]
+
+        for future in as_completed(futures):
+            output_folder, time_taken, error = future.result()
+            if error is None:
+                logging.info(f"Finished: {output_folder} ({time_taken})")
+            else:
+                logging.error(f"Failed: {output_folder} ({error})")
+            results.append((output_folder, time_taken, error))
+    return results
+
+
+def save_summary(results, summary_path):
+    with open(summary_path, "w", newline="") as summary_file:
+        writer = csv.writer(summary_file)
+        writer.writerow(["registration_output_folder", "time_taken", "error"])
+        for output_folder, time_taken, error in results:
+            writer.writerow(
+                [output_folder, time_taken.total_seconds(), error or ""]
+            )
+
+
+def main():
+    start_time = datetime.now()
+    args = batch_cli_parser().parse_args()
+    args.batch_output_folder = os.path.abspath(args.batch_output_folder)
+    ensure_directory_exists(args.batch_output_folder)
+
+    fancylog.start_logging(
+        args.batch_output_folder,
+        program_for_log,
+        variables=[args],
+        verbose=args.debug,
+        log_header="AMAP BATCH LOG",
+        multiprocessing_aware=False,
+    )
+
+    args = prep_atlas(args)
+    args.registration_config = os.path.abspath(args.registration_config)
+    jobs = read_manifest(
+        args.manifest,
+        {option: getattr(args, option) for option in PER_BRAIN_OPTIONS},
+    )
+
+    results = run_batch(
+        args.registration_config,
+        jobs,
+        get_registration_options(args),
+        concurrent_jobs=args.concurrent_jobs,
+        threads_per_job=args.threads_per_job,
+        n_free_cpus=args.n_free_cpus,
+    )
+    save_summary(
+        results, os.path.join(args.batch_output_folder, "batch_summary.csv")
+    )
+
+    n_failed = sum(error is not None for _, _, error in results)
+    logging.info(
+        f"Finished. {len(results) - n_failed} of {len(results)} brains "
+        f"registered. Total time taken: {datetime.now() - start_time}"
+    )
+
+
+if __name__ == "__main__":
+    main()
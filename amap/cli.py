@@ -3,23 +3,31 @@ import logging
 import tempfile
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 from datetime import datetime
-from fancylog import fancylog
 from pathlib import Path
 from shutil import copyfile
 
-from micrometa.micrometa import SUPPORTED_METADATA_TYPES
-from imlib.general.system import ensure_directory_exists
 from imlib.general.numerical import check_positive_int, check_positive_float
-from imlib.image.metadata import define_pixel_sizes
 from imlib.general.config import get_config_obj
 
 from amap.download.cli import atlas_parser, download_directory_parser
-from amap.main import main as register
-from amap.tools import source_files
-from amap.download import atlas as atlas_download
-from amap.download.download import amend_cfg
 import amap as program_for_log
 
+# The pipeline (and the libraries it needs) is only imported once the
+# arguments have been parsed, so that e.g. "amap --help" starts quickly.
+
+
+class SupportedMetadataTypes:
+    """
+    The metadata types supported by micrometa, as they are shown in the help.
+    micrometa is only imported when the help is shown, as it checks online
+    for a newer version when it is imported.
+    """
+
+    def __str__(self):
+        from micrometa.micrometa import SUPPORTED_METADATA_TYPES
+
+        return str(SUPPORTED_METADATA_TYPES)
+
 
 temp_dir = tempfile.TemporaryDirectory()
 temp_dir_path = temp_dir.name
@@ -46,7 +54,7 @@ def cli_parse(parser):
         dest="image_paths",
         type=str,
         help="Path to the directory of the image files. Can also be a text"
-        "file pointing to the files.",
+        "file pointing to the files, or a chunk store made by amap_ingest.",
     )
 
     cli_parser.add_argument(
@@ -85,14 +93,15 @@ def misc_parse(parser):
         help="Debug mode. Will increase verbosity of logging and save all "
         "intermediate files for diagnosis of software issues.",
     )
-    misc_parser.add_argument(
+    metadata_action = misc_parser.add_argument(
         "--metadata",
         dest="metadata",
         type=Path,
-        help="Path to the metadata file. Supported formats are '{}'.".format(
-            SUPPORTED_METADATA_TYPES
-        ),
+        help="Path to the metadata file. Supported formats are "
+        "'%(supported_metadata_types)s'.",
     )
+    # formatted into the help (only) when it is shown
+    metadata_action.supported_metadata_types = SupportedMetadataTypes()
     return parser
 
 
@@ -182,6 +191,22 @@ def visualisation_parser(parser):
         help="Do not precompute the outline images (if you don't want to"
         " use amap_vis",
     )
+    vis_parser.add_argument(
+        "--boundaries-label-ids",
+        dest="boundaries_label_ids",
+        action="store_true",
+        help="Store the label id of the atlas region in each voxel of the "
+        "outline image, rather than a binary image, e.g. to colour the "
+        "outlines by region.",
+    )
+    vis_parser.add_argument(
+        "--sparse-boundaries",
+        dest="sparse_boundaries",
+        action="store_true",
+        help="Save the outline image as runs of outline voxels in each "
+        "plane (boundaries.npz), rather than as a nifti image. This is much "
+        "smaller, and amap_vis only loads the planes that are displayed.",
+    )
     return parser
 
 
@@ -210,6 +235,91 @@ def registration_parse(parser):
         help="Dont save the downsampled brain before filtering.",
     )
 
+    registration_opt_parser.add_argument(
+        "--max-concurrent-stages",
+        dest="max_concurrent_stages",
+        type=check_positive_int,
+        default=None,
+        help="Maximum number of independent stages (e.g. segmentation and "
+        "the inverse transform) to run at once. The threads are shared "
+        "between concurrent registrations. Set to 1 to run the stages in "
+        "sequence. By default, all the stages that are ready are run.",
+    )
+    registration_opt_parser.add_argument(
+        "--reorient-atlas-header",
+        dest="reorient_atlas_header",
+        action="store_true",
+        help="Save the atlas files without reorienting the image data. "
+        "Instead, the reorientation is stored in the nifti header.",
+    )
+    registration_opt_parser.add_argument(
+        "--atlas-cache",
+        dest="atlas_cache_directory",
+        type=str,
+        default=None,
+        help="Directory in which to cache the reoriented atlas files, so "
+        "that later runs with the same atlas and orientation reuse them. "
+        "If not given, the atlas files are generated for every run.",
+    )
+    registration_opt_parser.add_argument(
+        "--atlas-cache-max-entries",
+        dest="atlas_cache_max_entries",
+        type=check_positive_int,
+        default=10,
+        help="Maximum number of reoriented atlases to keep in the cache. "
+        "The least recently used are removed first.",
+    )
+    registration_opt_parser.add_argument(
+        "--no-atlas-cache-verify",
+        dest="no_atlas_cache_verify",
+        action="store_true",
+        help="Dont check the cached atlas files against their checksums "
+        "before using them.",
+    )
+    registration_opt_parser.add_argument(
+        "--streaming",
+        dest="streaming",
+        action="store_true",
+        help="Load and downsample the raw data in chunks of planes, so that "
+        "memory use is bounded by the chunk size rather than the size of "
+        "the raw data. Only for a directory of planes or a text file "
+        "listing them. The volumes are also calculated from slabs of the "
+        "registered atlas.",
+    )
+    registration_opt_parser.add_argument(
+        "--streaming-chunk-size",
+        dest="streaming_chunk_size",
+        type=check_positive_int,
+        default=32,
+        help="Number of raw planes to load at once when streaming.",
+    )
+    registration_opt_parser.add_argument(
+        "--streaming-memmap",
+        dest="streaming_memmap",
+        action="store_true",
+        help="When streaming, write the downsampled data (and the boundary "
+        "image) into memory-mapped files in the output directory, rather "
+        "than holding them in memory.",
+    )
+    registration_opt_parser.add_argument(
+        "--filter-batch-size",
+        dest="filter_batch_size",
+        type=check_positive_int,
+        default=None,
+        help="Number of planes to filter at once when preparing the "
+        "downsampled brain for registration (e.g. 32). Larger batches are "
+        "faster, but use more memory. By default, the planes are filtered "
+        "one at a time.",
+    )
+    registration_opt_parser.add_argument(
+        "--low-memory",
+        dest="low_memory",
+        action="store_true",
+        help="Filter the downsampled brain in single precision, in place, "
+        "to reduce peak memory use. The filtered image may differ very "
+        "slightly. The brain is filtered plane by plane in a single "
+        "process, so --filter-batch-size is ignored.",
+    )
     registration_opt_parser.add_argument(
         "--affine-n-steps",
         dest="affine_n_steps",
@@ -275,6 +385,8 @@ def check_atlas_install():
     Checks whether the atlas directory exists, and whether it's empty or not.
     :return: Whether the directory exists, and whether the files also exist
     """
+    from amap.tools import source_files
+
     dir_exists = False
     files_exist = False
     cfg_file_path = source_files.source_custom_config()
@@ -295,7 +407,11 @@ def copy_registration_config(registration_config, output_directory):
     copyfile(registration_config, destination)
 
 
-def prep_registration(args):
+def prep_atlas(args):
+    from amap.tools import source_files
+    from amap.download import atlas as atlas_download
+    from amap.download.download import amend_cfg
+
     logging.info("Checking whether the atlas exists")
     _, atlas_files_exist = check_atlas_install()
     if not atlas_files_exist:
@@ -304,10 +420,18 @@ def prep_registration(args):
             args.download_path = os.path.join(temp_dir_path, "atlas.tar.gz")
         atlas_download.main(args.atlas, args.install_path, args.download_path)
         amend_cfg(
-            new_atlas_folder=args.install_path, atlas=args.atlas,
+            new_atlas_folder=args.install_path,
+            atlas=args.atlas,
         )
     if args.registration_config is None:
         args.registration_config = source_files.source_custom_config()
+    return args
+
+
+def prep_registration(args):
+    from imlib.general.system import ensure_directory_exists
+
+    args = prep_atlas(args)
 
     logging.debug("Making registration directory")
     ensure_directory_exists(args.registration_output_folder)
@@ -335,9 +459,54 @@ def make_paths_absolute(args):
     return args
 
 
+def get_registration_options(args):
+    """
+    Get the registration options that are independent of the brain being
+    registered (i.e. not the paths, pixel sizes or orientation).
+
+    :param args: The parsed arguments
+    :return: dict of keyword arguments for amap.main.main
+    :rtype: dict
+    """
+    return dict(
+        affine_n_steps=args.affine_n_steps,
+        affine_use_n_steps=args.affine_use_n_steps,
+        freeform_n_steps=args.freeform_n_steps,
+        freeform_use_n_steps=args.freeform_use_n_steps,
+        bending_energy_weight=args.bending_energy_weight,
+        grid_spacing=args.grid_spacing,
+        smoothing_sigma_reference=args.smoothing_sigma_reference,
+        smoothing_sigma_floating=args.smoothing_sigma_floating,
+        histogram_n_bins_floating=args.histogram_n_bins_floating,
+        histogram_n_bins_reference=args.histogram_n_bins_reference,
+        sort_input_file=args.sort_input_file,
+        n_free_cpus=args.n_free_cpus,
+        reorient_atlas_header=args.reorient_atlas_header,
+        atlas_cache_directory=args.atlas_cache_directory,
+        atlas_cache_max_entries=args.atlas_cache_max_entries,
+        atlas_cache_verify=not (args.no_atlas_cache_verify),
+        streaming=args.streaming,
+        streaming_chunk_size=args.streaming_chunk_size,
+        streaming_memmap=args.streaming_memmap,
+        filter_batch_size=args.filter_batch_size,
+        low_memory=args.low_memory,
+        save_downsampled=not (args.no_save_downsampled),
+        boundaries=not (args.no_boundaries),
+        boundaries_label_ids=args.boundaries_label_ids,
+        sparse_boundaries=args.sparse_boundaries,
+        max_concurrent_stages=args.max_concurrent_stages,
+        debug=args.debug,
+    )
+
+
 def run():
     start_time = datetime.now()
     args = register_cli_parser().parse_args()
+
+    from fancylog import fancylog
+    from imlib.image.metadata import define_pixel_sizes
+    from amap.main import main as register
+
     args = define_pixel_sizes(args)
 
     args, additional_images_downsample = prep_registration(args)
@@ -364,22 +533,8 @@ def run():
         flip_x=args.flip_x,
         flip_y=args.flip_y,
         flip_z=args.flip_z,
-        affine_n_steps=args.affine_n_steps,
-        affine_use_n_steps=args.affine_use_n_steps,
-        freeform_n_steps=args.freeform_n_steps,
-        freeform_use_n_steps=args.freeform_use_n_steps,
-        bending_energy_weight=args.bending_energy_weight,
-        grid_spacing=args.grid_spacing,
-        smoothing_sigma_reference=args.smoothing_sigma_reference,
-        smoothing_sigma_floating=args.smoothing_sigma_floating,
-        histogram_n_bins_floating=args.histogram_n_bins_floating,
-        histogram_n_bins_reference=args.histogram_n_bins_reference,
-        sort_input_file=args.sort_input_file,
-        n_free_cpus=args.n_free_cpus,
-        save_downsampled=not (args.no_save_downsampled),
-        boundaries=not (args.no_boundaries),
         additional_images_downsample=additional_images_downsample,
-        debug=args.debug,
+        **get_registration_options(args),
     )
 
     logging.info("Finished. Total time taken: %s", datetime.now() - start_time)
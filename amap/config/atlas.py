@@ -1,4 +1,5 @@
 import os
+import copy
 
 import numpy as np
 import nibabel as nb
@@ -33,6 +34,12 @@ class Atlas(object):
         self._brain_data = None
         self._hemispheres_data = None
 
+        # The reorientation (transpositions and flips) is not applied to the
+        # data until it is needed. The oriented data is:
+        # np.flip(np.transpose(original_data, self._axes), flipped axes)
+        self._axes = (0, 1, 2)
+        self._flipped = (False, False, False)
+
         self.original_orientation = self.atlas_conf["orientation"]
         if self.original_orientation != "horizontal":
             raise NotImplementedError(
@@ -95,7 +102,14 @@ class Atlas(object):
             self._data = brainio.load_nii(atlas_path)
         return self._data
 
-    def load_all(self):
+    def load_all(self, in_memory=False):
+        """
+        Load the atlas, brain and hemispheres images.
+
+        :param bool in_memory: Read the image data into memory, rather than
+            reading it from disk when it is needed (e.g. so that it can be
+            shared by several processes)
+        """
         if self._data is None:
             self._data = brainio.load_nii(self.get_path())
         if self._brain_data is None:
@@ -104,47 +118,132 @@ class Atlas(object):
             self._hemispheres_data = brainio.load_nii(
                 self.get_hemispheres_path()
             )
+        if in_memory:
+            self._data, self._brain_data, self._hemispheres_data = (
+                nb.Nifti1Image(
+                    np.array(nii_img.dataobj),
+                    nii_img.affine,
+                    nii_img.header,
+                )
+                for nii_img in (
+                    self._data,
+                    self._brain_data,
+                    self._hemispheres_data,
+                )
+            )
+
+    def copy(self, dest_folder=""):
+        """
+        Get a copy of the atlas for another output folder. The loaded images
+        are shared (they are never modified), but the copy has its own
+        orientation.
+
+        :param str dest_folder: The destination folder of the copy
+        :return: The copy
+        :rtype: Atlas
+        """
+        atlas = copy.copy(self)
+        atlas.dest_folder = dest_folder
+        atlas._axes = (0, 1, 2)
+        atlas._flipped = (False, False, False)
+        return atlas
+
+    def save_all(self, header_only=False):
+        """
+        Save the (reoriented) atlas, brain and hemispheres images to the
+        destination folder.
+
+        :param bool header_only: If True, the image data is saved as
+            loaded, and the reorientation is instead composed into the
+            affine transform of the saved images (so the images are
+            identical in world coordinates). Otherwise the data is
+            reoriented as it is written.
+        """
+        for nii_img, element_name in (
+            (self._data, "atlas_name"),
+            (self._brain_data, "brain_name"),
+            (self._hemispheres_data, "hemispheres_name"),
+        ):
+            if header_only:
+                nii_img = self._reorient_header(nii_img)
+            else:
+                nii_img = self._reorient_data(nii_img)
+            dest_path = self.get_dest_path(element_name)
+            # the existing file may be a hard link to a cached atlas (see
+            # amap.utils.cache.AtlasCache), which must not be overwritten
+            if os.path.lexists(dest_path):
+                os.remove(dest_path)
+            brainio.to_nii(nii_img, dest_path)
+
+    def get_oriented_data(self, nii_img):
+        """
+        Get the data of an atlas image, in the current orientation. This is
+        a view of the original data (a memory map if the image is not
+        compressed) so no data is copied until it is used.
 
-    def save_all(self):
-        brainio.to_nii(self._data, self.get_dest_path("atlas_name"))
-        brainio.to_nii(self._brain_data, self.get_dest_path("brain_name"))
-        brainio.to_nii(
-            self._hemispheres_data, self.get_dest_path("hemispheres_name")
+        :param nii_img: The (original) nifti image
+        :return: The reoriented data
+        :rtype: np.array
+        """
+        data = np.transpose(np.asanyarray(nii_img.dataobj), self._axes)
+        flip_axes = tuple(
+            axis for axis, flipped in enumerate(self._flipped) if flipped
         )
+        if flip_axes:
+            data = np.flip(data, flip_axes)
+        return data
+
+    def get_reorientation_matrix(self, shape):
+        """
+        Get the matrix mapping the voxel indices of the original atlas
+        image onto the voxel indices of the reoriented atlas.
+
+        :param tuple shape: The shape of the original image
+        :return: A 4x4 matrix
+        :rtype: np.array
+        """
+        reorientation = np.zeros((4, 4))
+        reorientation[3, 3] = 1
+        for axis, (original_axis, flipped) in enumerate(
+            zip(self._axes, self._flipped)
+        ):
+            if flipped:
+                reorientation[axis, original_axis] = -1
+                reorientation[axis, 3] = shape[original_axis] - 1
+            else:
+                reorientation[axis, original_axis] = 1
+        return reorientation
 
-    # FIXME: should be just changing the header
-    def _flip(self, nii_img, axis_idx):
+    def _reorient_data(self, nii_img):
         return nb.Nifti1Image(
-            np.flip(nii_img.get_data(), axis_idx),
-            nii_img.affine,
-            nii_img.header,
+            self.get_oriented_data(nii_img), nii_img.affine, nii_img.header
         )
 
-    def _flip_all(self, axis_idx):
-        self._data = self._flip(self._data, axis_idx)
-        self._brain_data = self._flip(self._brain_data, axis_idx)
-        self._hemispheres_data = self._flip(self._hemispheres_data, axis_idx)
+    def _reorient_header(self, nii_img):
+        # keep the rest of the header (e.g. the description, units and data
+        # type) as when the data is reoriented
+        affine = nii_img.affine @ self.get_reorientation_matrix(nii_img.shape)
+        header = nii_img.header.copy()
+        header.set_qform(affine)
+        header.set_sform(affine)
+        return nb.Nifti1Image(np.asanyarray(nii_img.dataobj), affine, header)
 
     def flip(self, axes):
+        flipped = list(self._flipped)
         for axis_idx, flip_axis in enumerate(axes):
             if flip_axis:
-                self._flip_all(axis_idx)
-
-    def _transpose(self, nii_img, transposition):
-        # FIXME: should be just changing the header
-        data = np.transpose(nii_img.get_data(), transposition)
-        data = np.swapaxes(data, 0, 1)
-        return nb.Nifti1Image(data, nii_img.affine, nii_img.header)
-
-    def _transpose_all(self, transposition):
-        self._data = self._transpose(self._data, transposition)
-        self._brain_data = self._transpose(self._brain_data, transposition)
-        self._hemispheres_data = self._transpose(
-            self._hemispheres_data, transposition
-        )
+                flipped[axis_idx] = not flipped[axis_idx]
+        self._flipped = tuple(flipped)
+
+    def _transpose(self, transposition):
+        # the data is transposed, and then the first two axes are swapped
+        axes_order = list(transposition)
+        axes_order[0], axes_order[1] = axes_order[1], axes_order[0]
+        self._axes = tuple(self._axes[axis] for axis in axes_order)
+        self._flipped = tuple(self._flipped[axis] for axis in axes_order)
 
     def reorientate_to_sample(self, sample_orientation):
-        self._transpose_all(transpositions[sample_orientation])
+        self._transpose(transpositions[sample_orientation])
 
     def get_dest_path(self, atlas_element_name):
         if not self.dest_folder:
@@ -4,9 +4,6 @@ from pathlib import Path
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
-from amap.download import atlas
-from amap.download.download import amend_cfg
-
 home = str(Path.home())
 DEFAULT_DOWNLOAD_DIRECTORY = os.path.join(home, ".amap", "atlas")
 temp_dir = tempfile.TemporaryDirectory()
@@ -62,6 +59,10 @@ def download_parser():
 
 def main():
     args = download_parser().parse_args()
+
+    from amap.download import atlas
+    from amap.download.download import amend_cfg
+
     if args.download_path is None:
         args.download_path = os.path.join(temp_dir_path, "atlas.tar.gz")
     if not args.no_atlas:
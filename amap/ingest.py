@@ -0,0 +1,187 @@
+"""
+ingest
+======
+
+Convert raw data (a directory of tiff planes, or a text file listing them)
+into a chunk store (see amap.tools.chunk_store), once. amap and amap_vis
+then read the store instead of the individual planes: amap streams it a
+chunk of planes at a time, and amap_vis reads only the chunks that are
+displayed.
+"""
+
+import os
+import math
+import shutil
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import tifffile
+from tqdm import tqdm
+from imlib.general.system import get_num_processes
+from imlib.general.numerical import check_positive_int
+
+from amap.register.downsample import get_plane_paths
+from amap.tools.chunk_store import ChunkStore
+
+
+class IngestError(Exception):
+    pass
+
+
+def ingest_parser():
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    ingest_parser = parser.add_argument_group("amap ingest options")
+    ingest_parser.add_argument(
+        dest="image_paths",
+        type=str,
+        help="Path to the directory of the image files. Can also be a text "
+        "file pointing to the files.",
+    )
+    ingest_parser.add_argument(
+        dest="output_path",
+        type=str,
+        help="Directory to save the chunk store to. Give this to amap or "
+        "amap_vis in place of the image files.",
+    )
+    ingest_parser.add_argument(
+        "--chunk-size",
+        dest="chunk_size",
+        type=check_positive_int,
+        nargs=3,
+        default=[32, 256, 256],
+        help="The size of each chunk, in planes, rows and columns. amap "
+        "reads a chunk of planes at a time, so the first size is best a "
+        "divisor of the amap '--streaming-chunk-size'.",
+    )
+    ingest_parser.add_argument(
+        "--compression-level",
+        dest="compression_level",
+        type=int,
+        choices=range(10),
+        default=1,
+        help="zlib compression level (0 is no compression, 9 the smallest).",
+    )
+    ingest_parser.add_argument(
+        "--sort-input-file",
+        dest="sort_input_file",
+        action="store_true",
+        help="If set to true, the input text file will be sorted using "
+        "natural sorting. This means that the file paths will be sorted as "
+        "would be expected by a human and not purely alphabetically",
+    )
+    ingest_parser.add_argument(
+        "--overwrite",
+        dest="overwrite",
+        action="store_true",
+        help="Replace the chunk store if it already exists.",
+    )
+    ingest_parser.add_argument(
+        "--n-free-cpus",
+        dest="n_free_cpus",
+        type=check_positive_int,
+        default=2,
+        help="The number of CPU cores on the machine to leave unused by the "
+        "program to spare resources.",
+    )
+    return parser
+
+
+def ingest(
+    plane_paths,
+    output_path,
+    chunks=(32, 256, 256),
+    compression_level=1,
+    n_threads=1,
+    overwrite=False,
+    attributes=None,
+):
+    """
+    Convert a series of planes into a chunk store, a slab of (chunks[0])
+    planes at a time. The store is written to a temporary directory, and
+    only moved to output_path once it is complete.
+
+    :param list plane_paths: Ordered list of plane paths
+    :param output_path: The directory of the chunk store
+    :param tuple chunks: The size of each chunk (planes, rows, columns)
+    :param int compression_level: The zlib compression level (0-9)
+    :param int n_threads: How many planes to load (and chunks to compress)
+        at once
+    :param bool overwrite: Replace the chunk store if it already exists
+    :param dict attributes: Any other (json serialisable) metadata to save
+        with the store
+    :return: The chunk store
+    :rtype: ChunkStore
+    :raises IngestError: If the chunk store already exists
+    """
+    # without a trailing separator, so the temporary store is a sibling of
+    # the output directory, rather than inside it
+    output_path = os.path.normpath(str(output_path))
+    if os.path.exists(output_path) and not overwrite:
+        raise IngestError(
+            f"{output_path} already exists, use '--overwrite' to replace it"
+        )
+    tmp_path = output_path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+
+    first_plane = tifffile.imread(plane_paths[0])
+    store = ChunkStore.create(
+        tmp_path,
+        (len(plane_paths),) + first_plane.shape,
+        first_plane.dtype,
+        chunks,
+        compression_level=compression_level,
+        attributes=attributes,
+        n_threads=n_threads,
+    )
+
+    slab_size = store.chunks[0]
+    n_slabs = math.ceil(len(plane_paths) / slab_size)
+    with ThreadPoolExecutor(max_workers=n_threads) as pool, tqdm(
+        total=len(plane_paths), desc="Ingesting", unit="plane"
+    ) as bar:
+        for slab_idx in range(n_slabs):
+            start = slab_idx * slab_size
+            end = min(start + slab_size, len(plane_paths))
+            slab = np.stack(
+                list(pool.map(tifffile.imread, plane_paths[start:end]))
+            )
+            store.write_slab(start, slab.astype(store.dtype, copy=False))
+            bar.update(end - start)
+
+    if os.path.exists(output_path):
+        shutil.rmtree(output_path)
+    os.replace(tmp_path, output_path)
+    return ChunkStore(output_path, n_threads=n_threads)
+
+
+def main():
+    start_time = datetime.now()
+    args = ingest_parser().parse_args()
+    plane_paths = get_plane_paths(
+        args.image_paths, sort_input_file=args.sort_input_file
+    )
+    if not plane_paths:
+        raise IngestError(
+            f"No planes found at: {args.image_paths}. Please give a "
+            f"directory of tiff files, or a text file listing them."
+        )
+    store = ingest(
+        plane_paths,
+        args.output_path,
+        chunks=tuple(args.chunk_size),
+        compression_level=args.compression_level,
+        n_threads=get_num_processes(min_free_cpu_cores=args.n_free_cpus),
+        overwrite=args.overwrite,
+        attributes={"source": os.path.abspath(args.image_paths)},
+    )
+    print(
+        f"Saved {store.shape} ({store.dtype}) image to: {args.output_path}. "
+        f"Total time taken: {datetime.now() - start_time}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import logging
+import threading
 import numpy as np
 
 from pathlib import Path
@@ -10,9 +11,13 @@ from amap.register.volume import calculate_volumes
 from amap.config.atlas import Atlas
 from amap.vis.boundaries import main as calc_boundaries
 from amap.register.registration_params import RegistrationParams
-from amap.register.tools import save_downsampled_image
+from amap.register.tools import save_downsampled_images
+from amap.utils.cache import AtlasCache
+from amap.utils.manifest import RunManifest
 from amap.utils.paths import Paths
+from amap.utils.resources import ResourceMonitor
 from amap.utils.run import Run
+from amap.utils.scheduler import Scheduler
 
 flips = {
     "horizontal": (True, True, False),
@@ -25,6 +30,151 @@ def check_downsampled(registration_output_folder, name):
     return Path(registration_output_folder, f"downsampled_{name}.nii").exists()
 
 
+def get_boundaries_output_path(paths, sparse_boundaries=False):
+    if sparse_boundaries:
+        return paths.sparse_boundaries_file_path
+    return paths.boundaries_file_path
+
+
+def make_run_manifest(
+    paths,
+    atlas,
+    registration_config,
+    registration_params,
+    target_brain_path,
+    preprocessing_parameters,
+    save_downsampled=True,
+    boundaries_label_ids=False,
+    sparse_boundaries=False,
+):
+    """
+    Describe the inputs, outputs and parameters of each stage, so that only
+    the stages affected by a change are run again.
+
+    :param paths: The amap.utils.paths.Paths of the run
+    :param atlas: The amap.config.atlas.Atlas
+    :param registration_config: The amap config file
+    :param registration_params: The RegistrationParams
+    :param target_brain_path: The raw data
+    :param dict preprocessing_parameters: The parameters that affect the
+        downsampled data and reoriented atlas
+    :param bool save_downsampled: Whether the downsampled brain is saved
+    :param bool boundaries_label_ids: Whether the boundary image keeps the
+        label ids of the atlas
+    :param bool sparse_boundaries: Whether the boundary image is saved in
+        the sparse (.npz) format
+    :return: The manifest
+    :rtype: RunManifest
+    """
+    manifest = RunManifest(paths.manifest_path)
+    atlas_outputs = [
+        atlas.get_dest_path(element)
+        for element in ("atlas_name", "brain_name", "hemispheres_name")
+    ]
+    manifest.define_stage(
+        "preprocess",
+        inputs=[registration_config],
+        raw_inputs=[
+            target_brain_path,
+            atlas.get_path(),
+            atlas.get_brain_path(),
+            atlas.get_hemispheres_path(),
+        ],
+        outputs=atlas_outputs
+        + ([paths.downsampled_brain_path] if save_downsampled else []),
+        temporary_outputs=[paths.tmp__downsampled_filtered],
+        parameters=preprocessing_parameters,
+    )
+
+    freeform_parameters = registration_params.format_freeform_params()
+    manifest.define_stage(
+        "affine",
+        dependencies=["preprocess"],
+        inputs=[paths.tmp__downsampled_filtered, paths.brain_filtered],
+        outputs=[paths.affine_matrix_path],
+        temporary_outputs=[paths.tmp__affine_registered_atlas_brain_path],
+        parameters={"affine": registration_params.format_affine_params()},
+        programs=[registration_params.affine_reg_program_path],
+    )
+    manifest.define_stage(
+        "freeform",
+        dependencies=["preprocess", "affine"],
+        inputs=[
+            paths.tmp__downsampled_filtered,
+            paths.brain_filtered,
+            paths.affine_matrix_path,
+        ],
+        outputs=[paths.control_point_file_path],
+        temporary_outputs=[paths.tmp__freeform_registered_atlas_brain_path],
+        parameters={"freeform": freeform_parameters},
+        programs=[registration_params.freeform_reg_program_path],
+    )
+    manifest.define_stage(
+        "inverse_transform",
+        dependencies=["preprocess", "affine"],
+        inputs=[
+            paths.tmp__downsampled_filtered,
+            paths.brain_filtered,
+            paths.affine_matrix_path,
+        ],
+        outputs=[
+            paths.invert_affine_matrix_path,
+            paths.inverse_control_point_file_path,
+        ],
+        temporary_outputs=[
+            paths.tmp__inverse_freeform_registered_atlas_brain_path
+        ],
+        parameters={"freeform": freeform_parameters},
+        programs=[
+            registration_params.transform_program_path,
+            registration_params.freeform_reg_program_path,
+        ],
+    )
+    for stage, atlas_image, output in (
+        ("segment", paths.annotations, paths.registered_atlas_img_path),
+        (
+            "hemispheres",
+            paths.hemispheres,
+            paths.registered_hemispheres_img_path,
+        ),
+    ):
+        manifest.define_stage(
+            stage,
+            dependencies=["preprocess", "freeform"],
+            inputs=[
+                paths.tmp__downsampled_filtered,
+                paths.control_point_file_path,
+                atlas_image,
+            ],
+            outputs=[output],
+            parameters={
+                "segmentation": (
+                    registration_params.format_segmentation_params()
+                )
+            },
+            programs=[registration_params.segmentation_program_path],
+        )
+    manifest.define_stage(
+        "volumes",
+        dependencies=["segment", "hemispheres"],
+        inputs=[
+            paths.registered_atlas_path,
+            paths.hemispheres_atlas_path,
+            atlas.get_structures_path(),
+            registration_config,
+        ],
+        outputs=[paths.volume_csv_path, paths.volume_hierarchy_csv_path],
+    )
+    manifest.define_stage(
+        "boundaries",
+        dependencies=["segment"],
+        inputs=[paths.registered_atlas_path, registration_config],
+        outputs=[get_boundaries_output_path(paths, sparse_boundaries)],
+        parameters={"label_ids": boundaries_label_ids},
+    )
+    return manifest
+
+
 def main(
     registration_config,
     target_brain_path,
@@ -47,11 +197,26 @@ def main(
     histogram_n_bins_floating=128,
     histogram_n_bins_reference=128,
     n_free_cpus=2,
+    reorient_atlas_header=False,
+    atlas_cache_directory=None,
+    atlas_cache_max_entries=10,
+    atlas_cache_verify=True,
+    streaming=False,
+    streaming_chunk_size=32,
+    streaming_memmap=False,
+    filter_batch_size=None,
+    low_memory=False,
     sort_input_file=False,
     save_downsampled=True,
     additional_images_downsample=None,
     boundaries=True,
+    boundaries_label_ids=False,
+    sparse_boundaries=False,
     debug=False,
+    atlas=None,
+    n_processes=None,
+    max_concurrent_stages=None,
+    stages=None,
 ):
     """
         The main function that will perform the library calls and
@@ -69,22 +234,130 @@ def main(
     :param flip_y:
     :param flip_z:
     :param n_free_cpus:
+    :param reorient_atlas_header: Store the atlas reorientation in the nifti
+    header rather than reorienting the data
+    :param atlas_cache_directory: If not None, the reoriented atlas files
+    are cached in this directory, and reused by later runs with the same
+    atlas and orientation
+    :param atlas_cache_max_entries: Maximum number of cached atlases to keep
+    (least recently used are removed first)
+    :param atlas_cache_verify: Check the cached atlas files against their
+    checksums before using them
+    :param streaming: Load and downsample the raw data in chunks of planes,
+    and calculate the volumes from slabs of the registered atlas
+    :param streaming_chunk_size: Number of raw (or registered atlas) planes
+    to load at once. The boundaries are always found in slabs of this size.
+    :param streaming_memmap: Stream the downsampled data into a
+    memory-mapped file, and write the boundary image to one before it is
+    saved
+    :param filter_batch_size: If not None, filter this many planes at once
+    (faster, but uses more memory). Otherwise the planes are filtered one at
+    a time.
+    :param low_memory: Filter in place, in single precision to reduce
+    memory usage
     :param sort_input_file:
     :param save_downsampled:
     :param additional_images_downsample: dict of
     {image_name: image_to_be_downsampled}
+    :param boundaries_label_ids: Store the label ids of the atlas in the
+    boundary image, rather than a 16 bit (0 or 2^16 - 1) image
+    :param sparse_boundaries: Save the boundary image as per-plane runs of
+    boundary voxels (boundaries.npz), rather than as a nifti image
+    :param atlas: An already loaded amap.config.atlas.Atlas to use (e.g. one
+    shared by several registrations). If None, it is loaded from the config
+    :param n_processes: Number of processes (and NiftyReg threads) to use.
+    If None, all but n_free_cpus of the CPU cores are used
+    :param max_concurrent_stages: Maximum number of independent stages
+    (e.g. segmentation and the inverse transform) to run at once. The
+    threads are shared between concurrent stages that use several threads
+    or processes (e.g. NiftyReg). If None, all the stages that are ready
+    are run.
+    :param stages: If not None, only run these stages (e.g. "preprocess"
+    and "affine", to share them between several registrations). The
+    temporary files are then kept for the later stages.
     :return:
     """
-    n_processes = get_num_processes(min_free_cpu_cores=n_free_cpus)
+    if n_processes is None:
+        n_processes = get_num_processes(min_free_cpu_cores=n_free_cpus)
     load_parallel = n_processes > 1
     paths = Paths(registration_output_folder)
-    atlas = Atlas(registration_config, dest_folder=registration_output_folder)
-    run = Run(paths, atlas, boundaries=boundaries, debug=debug)
+    if atlas is None:
+        atlas = Atlas(
+            registration_config, dest_folder=registration_output_folder
+        )
+    else:
+        atlas = atlas.copy(dest_folder=registration_output_folder)
+    atlas_flips = [flips[orientation], (flip_x, flip_y, flip_z)]
+    registration_params = RegistrationParams(
+        registration_config,
+        affine_n_steps=affine_n_steps,
+        affine_use_n_steps=affine_use_n_steps,
+        freeform_n_steps=freeform_n_steps,
+        freeform_use_n_steps=freeform_use_n_steps,
+        bending_energy_weight=bending_energy_weight,
+        grid_spacing=grid_spacing,
+        smoothing_sigma_reference=smoothing_sigma_reference,
+        smoothing_sigma_floating=smoothing_sigma_floating,
+        histogram_n_bins_floating=histogram_n_bins_floating,
+        histogram_n_bins_reference=histogram_n_bins_reference,
+    )
+
+    # stages are only run again if their inputs or parameters have changed
+    manifest = make_run_manifest(
+        paths,
+        atlas,
+        registration_config,
+        registration_params,
+        target_brain_path,
+        preprocessing_parameters=dict(
+            x_pixel_um=x_pixel_um,
+            y_pixel_um=y_pixel_um,
+            z_pixel_um=z_pixel_um,
+            orientation=orientation,
+            flips=atlas_flips,
+            sort_input_file=sort_input_file,
+            save_downsampled=save_downsampled,
+            reorient_atlas_header=reorient_atlas_header,
+            low_memory=low_memory,
+        ),
+        save_downsampled=save_downsampled,
+        boundaries_label_ids=boundaries_label_ids,
+        sparse_boundaries=sparse_boundaries,
+    )
+    if stages is not None:
+        # the temporary files are kept for the later stages, so are
+        # recreated if an earlier (complete) run has deleted them
+        manifest.require_temporary_outputs(stages)
+    run = Run(
+        paths,
+        atlas,
+        boundaries=boundaries,
+        sparse_boundaries=sparse_boundaries,
+        debug=debug,
+        manifest=manifest,
+    )
 
-    if run.preprocess:
+    if atlas_cache_directory is not None:
+        atlas_cache = AtlasCache(
+            atlas_cache_directory,
+            max_entries=atlas_cache_max_entries,
+            verify=atlas_cache_verify,
+        )
+    else:
+        atlas_cache = None
+
+    def preprocess():
         logging.info("Preprocessing data for registration")
-        logging.info("Loading data")
+        # the atlas images are only loaded (and reoriented) if they are not
+        # already cached
+        atlas_cached = atlas_cache is not None and atlas_cache.fetch_atlas(
+            atlas,
+            orientation,
+            atlas_flips,
+            header_only=reorient_atlas_header,
+        )
 
+        logging.info("Loading data")
         brain = BrainProcessor(
             atlas,
             target_brain_path,
@@ -95,7 +368,13 @@ def main(
             original_orientation=orientation,
             load_parallel=load_parallel,
             sort_input_file=sort_input_file,
+            load_atlas=not atlas_cached,
             n_free_cpus=n_free_cpus,
+            streaming=streaming,
+            streaming_chunk_size=streaming_chunk_size,
+            streaming_output_path=(
+                paths.tmp__downsampled_memmap if streaming_memmap else None
+            ),
         )
 
         # reorients the atlas to the orientation of the sample
@@ -104,13 +383,20 @@ def main(
         # reorients atlas to the nifti (origin is the most ventral, posterior,
         # left voxel) coordinate framework
 
-        flip = flips[orientation]
-        brain.flip_atlas(flip)
+        brain.flip_atlas(atlas_flips[0])
 
         # flips if the input data doesnt match the nifti standard
-        brain.flip_atlas((flip_x, flip_y, flip_z))
+        brain.flip_atlas(atlas_flips[1])
 
-        brain.atlas.save_all()
+        if atlas_cache is not None and not atlas_cached:
+            atlas_cache.save_all(
+                brain.atlas,
+                orientation,
+                atlas_flips,
+                header_only=reorient_atlas_header,
+            )
+        elif atlas_cache is None:
+            brain.atlas.save_all(header_only=reorient_atlas_header)
         if save_downsampled:
             brain.target_brain = brain.target_brain.astype(
                 np.uint16, copy=False
@@ -118,84 +404,99 @@ def main(
             logging.info("Saving downsampled image")
             brain.save(paths.downsampled_brain_path)
 
-        brain.filter()
+        brain.filter(
+            n_processes=n_processes,
+            batch_size=filter_batch_size,
+            low_memory=low_memory,
+        )
         logging.info("Saving filtered image")
         brain.save(paths.tmp__downsampled_filtered)
 
         del brain
 
-    if additional_images_downsample:
+    def downsample_additional_images(n_threads):
+        images_to_downsample = {}
         for name, image in additional_images_downsample.items():
             if not check_downsampled(registration_output_folder, name):
-                save_downsampled_image(
-                    image,
-                    name,
-                    registration_output_folder,
-                    atlas,
-                    x_pixel_um=x_pixel_um,
-                    y_pixel_um=y_pixel_um,
-                    z_pixel_um=z_pixel_um,
-                    orientation=orientation,
-                    n_free_cpus=n_free_cpus,
-                    sort_input_file=sort_input_file,
-                    load_parallel=load_parallel,
-                )
+                images_to_downsample[name] = image
             else:
                 logging.info(f"Image: {name} already downsampled, skipping.")
 
+        save_downsampled_images(
+            images_to_downsample,
+            registration_output_folder,
+            atlas,
+            x_pixel_um=x_pixel_um,
+            y_pixel_um=y_pixel_um,
+            z_pixel_um=z_pixel_um,
+            orientation=orientation,
+            n_free_cpus=n_free_cpus,
+            sort_input_file=sort_input_file,
+            load_parallel=load_parallel and n_threads > 1,
+            n_processes=n_threads,
+            streaming=streaming,
+            streaming_chunk_size=streaming_chunk_size,
+            streaming_memmap=streaming_memmap,
+        )
+
     if run.register:
         logging.info("Registering")
 
-    if any(
-        [
-            run.affine,
-            run.freeform,
-            run.segment,
-            run.hemispheres,
-            run.inverse_transform,
-        ]
-    ):
-        registration_params = RegistrationParams(
-            registration_config,
-            affine_n_steps=affine_n_steps,
-            affine_use_n_steps=affine_use_n_steps,
-            freeform_n_steps=freeform_n_steps,
-            freeform_use_n_steps=freeform_use_n_steps,
-            bending_energy_weight=bending_energy_weight,
-            grid_spacing=grid_spacing,
-            smoothing_sigma_reference=smoothing_sigma_reference,
-            smoothing_sigma_floating=smoothing_sigma_floating,
-            histogram_n_bins_floating=histogram_n_bins_floating,
-            histogram_n_bins_reference=histogram_n_bins_reference,
-        )
-        brain_reg = BrainRegistration(
-            registration_config,
-            paths,
-            registration_params,
-            n_processes=n_processes,
-        )
+    resource_monitor = ResourceMonitor()
+    brain_reg = BrainRegistration(
+        registration_config,
+        paths,
+        registration_params,
+        n_processes=n_processes,
+        resource_monitor=resource_monitor,
+    )
+
+    # the cached template is found (and its checksum validated) once, by
+    # the first registration stage that needs it
+    template = {}
+    template_lock = threading.Lock()
 
-    if run.affine:
+    def get_template_path():
+        with template_lock:
+            if "path" not in template:
+                template["path"] = atlas_cache.get_template_path(
+                    atlas,
+                    orientation,
+                    atlas_flips,
+                    header_only=reorient_atlas_header,
+                )
+            return template["path"]
+
+    def get_brain_reg(n_threads):
+        stage_brain_reg = brain_reg.with_n_processes(n_threads)
+        # start from the cached (checksum validated) atlas brain if possible
+        if atlas_cache is not None:
+            template_path = get_template_path()
+            if template_path is not None:
+                stage_brain_reg.brain_of_atlas_img_path = template_path
+        return stage_brain_reg
+
+    def register_affine(n_threads):
         logging.info("Starting affine registration")
-        brain_reg.register_affine()
+        get_brain_reg(n_threads).register_affine()
 
-    if run.freeform:
+    def register_freeform(n_threads):
         logging.info("Starting freeform registration")
-        brain_reg.register_freeform()
+        get_brain_reg(n_threads).register_freeform()
 
-    if run.segment:
+    def segment(n_threads):
         logging.info("Starting segmentation")
-        brain_reg.segment()
+        get_brain_reg(n_threads).segment()
 
-    if run.hemispheres:
+    def register_hemispheres(n_threads):
         logging.info("Segmenting hemispheres")
-        brain_reg.register_hemispheres()
+        get_brain_reg(n_threads).register_hemispheres()
 
-    if run.inverse_transform:
+    def generate_inverse_transforms(n_threads):
         logging.info("Generating inverse (sample to atlas) transforms")
-        brain_reg.generate_inverse_transforms()
+        get_brain_reg(n_threads).generate_inverse_transforms()
 
-    if run.volumes:
+    def volumes(n_threads):
         logging.info("Calculating volumes of each brain area")
         calculate_volumes(
             paths.registered_atlas_path,
@@ -205,17 +506,98 @@ def main(
             paths.volume_csv_path,
             left_hemisphere_value=atlas.get_left_hemisphere_value(),
             right_hemisphere_value=atlas.get_right_hemisphere_value(),
+            slab_size=streaming_chunk_size if streaming else None,
+            n_processes=n_threads,
+            hierarchy_output_file=paths.volume_hierarchy_csv_path,
         )
 
-    if run.boundaries:
+    def generate_boundaries(n_threads):
         logging.info("Generating boundary image")
         calc_boundaries(
             paths.registered_atlas_path,
-            paths.boundaries_file_path,
+            get_boundaries_output_path(paths, sparse_boundaries),
             atlas_config=registration_config,
+            slab_size=streaming_chunk_size,
+            n_processes=n_threads,
+            label_ids=boundaries_label_ids,
+            memmap_path=(
+                paths.tmp__boundaries_memmap if streaming_memmap else None
+            ),
         )
 
-    if run.delete_temp:
+    # segmentation, the hemispheres and the inverse transform are
+    # independent of each other once the transforms they need exist
+    scheduler = Scheduler(
+        n_threads=n_processes,
+        max_concurrent_stages=max_concurrent_stages,
+        on_stage_finished=run.complete,
+    )
+    scheduler.add_stage("preprocess", preprocess, run=run.preprocess)
+    scheduler.add_stage(
+        "downsample_additional_images",
+        downsample_additional_images,
+        dependencies=["preprocess"],
+        threaded=True,
+        run=bool(additional_images_downsample),
+    )
+    scheduler.add_stage(
+        "affine",
+        register_affine,
+        dependencies=["preprocess"],
+        threaded=True,
+        run=run.affine,
+    )
+    scheduler.add_stage(
+        "freeform",
+        register_freeform,
+        dependencies=["affine"],
+        threaded=True,
+        run=run.freeform,
+    )
+    scheduler.add_stage(
+        "segment",
+        segment,
+        dependencies=["freeform"],
+        threaded=True,
+        run=run.segment,
+    )
+    scheduler.add_stage(
+        "hemispheres",
+        register_hemispheres,
+        dependencies=["freeform"],
+        threaded=True,
+        run=run.hemispheres,
+    )
+    scheduler.add_stage(
+        "inverse_transform",
+        generate_inverse_transforms,
+        dependencies=["affine"],
+        threaded=True,
+        run=run.inverse_transform,
+    )
+    scheduler.add_stage(
+        "volumes",
+        volumes,
+        dependencies=["segment", "hemispheres"],
+        threaded=True,
+        run=run.volumes,
+    )
+    scheduler.add_stage(
+        "boundaries",
+        generate_boundaries,
+        dependencies=["segment"],
+        threaded=True,
+        run=run.boundaries,
+    )
+    scheduler.run(stage_names=stages)
+    scheduler.log_timings()
+    scheduler.save_timings(paths.stage_timings_path)
+    if resource_monitor.records:
+        resource_monitor.log_summary()
+        resource_monitor.save_json(paths.resource_usage_json_path)
+        resource_monitor.save_csv(paths.resource_usage_csv_path)
+
+    if run.delete_temp and stages is None:
         logging.info("Removing registration temp files")
         delete_temp(paths.registration_output_folder, paths)
 
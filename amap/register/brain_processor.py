@@ -5,14 +5,25 @@ brain_processor
 A module to prepare brains for registration
 """
 
+import math
 import logging
 import numpy as np
 
-from tqdm import trange
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm, trange
 from brainio import brainio
 from imlib.image.scale import scale_and_convert_to_16_bits
 
+from imlib.general.system import get_num_processes
+
 from amap.tools import image
+from amap.tools.chunk_store import ChunkStore, is_chunk_store
+from amap.utils.scheduler import get_process_pool_context
+from amap.register.downsample import (
+    get_plane_paths,
+    load_downsampled_streaming,
+)
 
 transpositions = {
     "horizontal": (1, 0, 2),
@@ -43,6 +54,9 @@ class BrainProcessor(object):
         load_atlas=True,
         n_free_cpus=2,
         scaling_rounding_decimals=5,
+        streaming=False,
+        streaming_chunk_size=32,
+        streaming_output_path=None,
     ):
         """
         :param str target_brain_path: The path to the brain to be processed
@@ -59,26 +73,32 @@ class BrainProcessor(object):
             multiprocessing for faster data loading
         :param bool sort_input_file: If set to true and the input is a
             filepaths file, it will be naturally sorted
+        :param bool streaming: Load and downsample the data in chunks of
+            planes, to bound the memory used by the size of the chunk rather
+            than that of the raw data. Only possible for a directory of
+            planes or a text file listing them.
+        :param int streaming_chunk_size: How many raw planes to load at once
+            when streaming
+        :param str streaming_output_path: If streaming, write the
+            downsampled image into a memory-mapped file at this path
         """
         self.target_brain_path = target_brain_path
 
         self.atlas = atlas
         atlas_pixel_sizes = self.atlas.pix_sizes
 
-        x_scaling = round(
-            x_pix_um / atlas_pixel_sizes["x"], scaling_rounding_decimals
-        )
-        y_scaling = round(
-            y_pix_um / atlas_pixel_sizes["y"], scaling_rounding_decimals
-        )
-        z_scaling = round(
-            z_pix_um / atlas_pixel_sizes["z"], scaling_rounding_decimals
+        x_scaling, y_scaling, z_scaling = get_scaling_factors(
+            atlas_pixel_sizes,
+            x_pix_um,
+            y_pix_um,
+            z_pix_um,
+            scaling_rounding_decimals=scaling_rounding_decimals,
         )
 
         self.original_orientation = original_orientation
 
         logging.info("Loading raw image data")
-        self.target_brain = brainio.load_any(
+        self.target_brain = load_downsampled(
             self.target_brain_path,
             x_scaling,
             y_scaling,
@@ -86,6 +106,9 @@ class BrainProcessor(object):
             load_parallel=load_parallel,
             sort_input_file=sort_input_file,
             n_free_cpus=n_free_cpus,
+            streaming=streaming,
+            streaming_chunk_size=streaming_chunk_size,
+            streaming_output_path=streaming_output_path,
         )
         self.swap_numpy_to_image_axis()
         self.output_folder = output_folder
@@ -113,32 +136,86 @@ class BrainProcessor(object):
     def swap_atlas_orientation_to_self(self):
         self.atlas.reorientate_to_sample(self.original_orientation)
 
-    def filter(self):
+    def filter(
+        self,
+        n_processes=None,
+        batch_size=None,
+        dtype=np.float64,
+        low_memory=False,
+    ):
         """
         Applies a set of filters to the brain to avoid overfitting details in
         the image during registration.
-        """
 
-        self.target_brain = BrainProcessor.filter_for_registration(
-            self.target_brain
-        )
+        :param int n_processes: If more than one, filter the planes in
+            parallel using this many processes
+        :param int batch_size: If not None, filter this many planes at once
+            (see filter_for_registration)
+        :param dtype: The floating point type used for filtering
+        :param bool low_memory: Filter in float32, in place
+            (see filter_for_registration_low_memory). This is always serial
+            and plane by plane, so n_processes and batch_size are ignored.
+        """
+        if low_memory:
+            ignored = []
+            if n_processes is not None and n_processes > 1:
+                ignored.append(f"n_processes={n_processes}")
+            if batch_size is not None:
+                ignored.append(f"batch_size={batch_size}")
+            if ignored:
+                logging.warning(
+                    f"Filtering with low memory use, in a single process "
+                    f"and plane by plane. Ignoring {', '.join(ignored)}"
+                )
+            self.target_brain = filter_for_registration_low_memory(
+                self.target_brain
+            )
+        else:
+            self.target_brain = BrainProcessor.filter_for_registration(
+                self.target_brain,
+                n_processes=n_processes,
+                batch_size=batch_size,
+                dtype=dtype,
+            )
 
     @staticmethod
-    def filter_for_registration(brain):
+    def filter_for_registration(
+        brain, n_processes=None, batch_size=None, dtype=np.float64
+    ):
         """
         A static method to filter a 3D image to allow registration
         (avoids overfitting details in the image) (algorithm from Alex Brown).
         The filter is composed of a despeckle filter using opening and a
         pseudo flatfield filter
 
+        :param np.array brain: The 3D image to filter
+        :param int n_processes: If more than one, the planes are split into
+            chunks and filtered in parallel using this many processes. The
+            result is identical to the serial version.
+        :param int batch_size: If not None, slabs of this many planes are
+            filtered at once by filter_stack_for_registration, rather than
+            plane by plane. The result is identical.
+        :param dtype: The floating point type used for filtering. Using
+            np.float32 halves the memory required, at the expense of
+            precision.
         :return: The filtered brain
         :rtype: np.array
         """
-        brain = brain.astype(np.float64, copy=False)
-        # OPTIMISE: could multiprocess but not slow
-        for i in trange(brain.shape[-1], desc="filtering", unit="plane"):
-            # OPTIMISE: see if in place better
-            brain[..., i] = filter_plane_for_registration(brain[..., i])
+        brain = brain.astype(dtype, copy=False)
+        if n_processes is not None and n_processes > 1:
+            filter_planes_parallel(brain, n_processes, batch_size=batch_size)
+        elif batch_size is not None:
+            for start in trange(
+                0, brain.shape[-1], batch_size, desc="filtering", unit="slab"
+            ):
+                end = start + batch_size
+                brain[..., start:end] = filter_stack_for_registration(
+                    brain[..., start:end]
+                )
+        else:
+            for i in trange(brain.shape[-1], desc="filtering", unit="plane"):
+                # OPTIMISE: see if in place better
+                brain[..., i] = filter_plane_for_registration(brain[..., i])
         brain = scale_and_convert_to_16_bits(brain)
         return brain
 
@@ -166,6 +243,114 @@ class BrainProcessor(object):
         )
 
 
+def get_scaling_factors(
+    atlas_pixel_sizes,
+    x_pix_um,
+    y_pix_um,
+    z_pix_um,
+    scaling_rounding_decimals=5,
+):
+    """
+    Compute the scaling factors to downsample the raw data to the atlas
+    resolution.
+
+    :param dict atlas_pixel_sizes: The atlas pixel sizes in um
+        ({"x": x, "y": y, "z": z})
+    :param float x_pix_um: The pixel spacing of the data in the x dimension
+    :param float y_pix_um: The pixel spacing of the data in the y dimension
+    :param float z_pix_um: The pixel spacing of the data in the z dimension
+    :param int scaling_rounding_decimals: How many decimals to round the
+        scaling factors to
+    :return: The x, y and z scaling factors
+    :rtype: tuple
+    """
+    x_scaling = round(
+        x_pix_um / atlas_pixel_sizes["x"], scaling_rounding_decimals
+    )
+    y_scaling = round(
+        y_pix_um / atlas_pixel_sizes["y"], scaling_rounding_decimals
+    )
+    z_scaling = round(
+        z_pix_um / atlas_pixel_sizes["z"], scaling_rounding_decimals
+    )
+    return x_scaling, y_scaling, z_scaling
+
+
+def load_downsampled(
+    target_brain_path,
+    x_scaling,
+    y_scaling,
+    z_scaling,
+    load_parallel=False,
+    sort_input_file=False,
+    n_free_cpus=2,
+    streaming=False,
+    streaming_chunk_size=32,
+    streaming_output_path=None,
+):
+    """
+    Load the raw data, downsampled by the given scaling factors, either all
+    at once (with brainio), or by streaming chunks of planes. Chunk stores
+    (see amap_ingest) are always streamed.
+
+    :param str target_brain_path: The path to the raw data (image file,
+        paths file, folder or chunk store)
+    :param float x_scaling: The scaling along the x dimension
+    :param float y_scaling: The scaling along the y dimension
+    :param float z_scaling: The scaling along the z dimension
+    :param bool load_parallel: Load planes in parallel
+    :param bool sort_input_file: If set to true and the input is a
+        filepaths file, it will be naturally sorted
+    :param int n_free_cpus: Number of cpu cores to leave free
+    :param bool streaming: Load and downsample the data in chunks of planes
+        if possible (see BrainProcessor)
+    :param int streaming_chunk_size: How many raw planes to load at once
+        when streaming
+    :param str streaming_output_path: If streaming, write the downsampled
+        image into a memory-mapped file at this path
+    :return: The downsampled data
+    :rtype: np.array
+    """
+    if load_parallel:
+        n_processes = get_num_processes(min_free_cpu_cores=n_free_cpus)
+    else:
+        n_processes = 1
+
+    plane_paths = None
+    if is_chunk_store(target_brain_path):
+        plane_paths = ChunkStore(target_brain_path, n_threads=n_processes)
+    elif streaming:
+        plane_paths = get_plane_paths(
+            target_brain_path, sort_input_file=sort_input_file
+        )
+        if plane_paths is None:
+            logging.warning(
+                f"Data: {target_brain_path} cannot be streamed, "
+                f"loading all at once."
+            )
+
+    if plane_paths is not None:
+        return load_downsampled_streaming(
+            plane_paths,
+            x_scaling,
+            y_scaling,
+            z_scaling,
+            chunk_size=streaming_chunk_size,
+            n_processes=n_processes,
+            output_path=streaming_output_path,
+        )
+    else:
+        return brainio.load_any(
+            target_brain_path,
+            x_scaling,
+            y_scaling,
+            z_scaling,
+            load_parallel=load_parallel,
+            sort_input_file=sort_input_file,
+            n_free_cpus=n_free_cpus,
+        )
+
+
 def filter_plane_for_registration(img_plane):
     """
     Apply a set of filter to the plane (typically to avoid overfitting details
@@ -180,3 +365,118 @@ def filter_plane_for_registration(img_plane):
     img_plane = image.despeckle_by_opening(img_plane)
     img_plane = image.pseudo_flatfield(img_plane)
     return img_plane
+
+
+def filter_for_registration_low_memory(brain):
+    """
+    Filter a 3D image to allow registration, as
+    BrainProcessor.filter_for_registration, but minimising peak memory use.
+    The brain is converted to float32 once, and each plane is filtered in
+    place using preallocated buffers. The final scaling to 16 bits is also
+    done in place. Due to the lower precision, the result may differ from
+    the default (float64) filtering by one grey level.
+
+    :param np.array brain: The 3D image to filter
+    :return: The filtered brain
+    :rtype: np.array
+    """
+    brain = brain.astype(np.float32, copy=False)
+    plane_buffer = np.empty(brain.shape[:-1], dtype=np.float32)
+    gaussian_buffer = np.empty_like(plane_buffer)
+    for i in trange(brain.shape[-1], desc="filtering", unit="plane"):
+        plane_buffer[:] = brain[..., i]
+        image.despeckle_by_opening(plane_buffer)
+        image.pseudo_flatfield_in_place(plane_buffer, gaussian_buffer)
+        brain[..., i] = plane_buffer
+    return image.scale_and_convert_to_16_bits_in_place(brain)
+
+
+def filter_stack_for_registration(stack):
+    """
+    Apply the same filters as filter_plane_for_registration to every plane
+    (the last axis) of a 3D image at once. The result is identical to
+    filtering each plane separately.
+
+    :param np.array stack: A 3D array of planes to filter
+    :return: The filtered image
+    :rtype: np.array
+    """
+    stack = image.despeckle_stack_by_opening(stack)
+    stack = image.pseudo_flatfield_stack(stack)
+    return stack
+
+
+def filter_planes_for_registration(planes, batch_size=None):
+    """
+    Apply filter_plane_for_registration to each plane of a chunk of planes
+    (the last axis)
+
+    :param np.array planes: A 3D array of planes to filter
+    :param int batch_size: If not None, filter the chunk in slabs of this
+        many planes using filter_stack_for_registration
+    :return: The filtered planes
+    :rtype: np.array
+    """
+    if batch_size is not None:
+        for start in range(0, planes.shape[-1], batch_size):
+            end = start + batch_size
+            planes[..., start:end] = filter_stack_for_registration(
+                planes[..., start:end]
+            )
+    else:
+        for i in range(planes.shape[-1]):
+            planes[..., i] = filter_plane_for_registration(planes[..., i])
+    return planes
+
+
+def get_plane_chunks(n_planes, n_processes, chunks_per_process=4):
+    """
+    Split the plane indices into contiguous chunks, so that each process
+    gets several chunks (to balance the load) without the overhead of
+    sending individual planes
+
+    :param int n_planes: The total number of planes
+    :param int n_processes: The number of processes to split the planes over
+    :param int chunks_per_process: How many chunks to aim for per process
+    :return: List of (start, end) plane indices
+    :rtype: list
+    """
+    chunk_size = max(
+        1, math.ceil(n_planes / (n_processes * chunks_per_process))
+    )
+    return [
+        (start, min(start + chunk_size, n_planes))
+        for start in range(0, n_planes, chunk_size)
+    ]
+
+
+def filter_planes_parallel(brain, n_processes, batch_size=None):
+    """
+    Filter all the planes of the brain (in place) using a process pool. Each
+    worker filters a chunk of planes exactly as in the serial version, so
+    the results are identical.
+
+    :param np.array brain: The 3D (float) image to filter. Planes are along
+        the last axis.
+    :param int n_processes: The number of processes to use
+    :param int batch_size: If not None, each worker filters its chunk in
+        slabs of this many planes using filter_stack_for_registration
+    """
+    chunks = get_plane_chunks(brain.shape[-1], n_processes)
+    logging.debug(
+        f"Filtering {brain.shape[-1]} planes in {len(chunks)} chunks using "
+        f"{n_processes} processes"
+    )
+    with ProcessPoolExecutor(
+        max_workers=n_processes, mp_context=get_process_pool_context()
+    ) as pool:
+        filtered_chunks = pool.map(
+            partial(filter_planes_for_registration, batch_size=batch_size),
+            (brain[..., start:end] for start, end in chunks),
+        )
+        with tqdm(
+            total=brain.shape[-1], desc="filtering", unit="plane"
+        ) as bar:
+            for (start, end), filtered in zip(chunks, filtered_chunks):
+                brain[..., start:end] = filtered
+                bar.update(end - start)
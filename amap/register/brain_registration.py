@@ -5,7 +5,7 @@ brain_registration
 The module to actually start the registration
 """
 
-
+import copy
 import logging
 
 
@@ -28,7 +28,21 @@ class BrainRegistration(object):
         paths,
         registration_params,
         n_processes=None,
+        brain_of_atlas_img_path=None,
+        resource_monitor=None,
     ):
+        """
+        :param registration_config: The amap config file
+        :param paths: The amap.utils.paths.Paths of the output files
+        :param registration_params: The RegistrationParams
+        :param n_processes: Number of OpenMP threads for NiftyReg
+        :param brain_of_atlas_img_path: The (filtered, reoriented) atlas
+            brain to use as the floating image. Defaults to the copy in the
+            output directory.
+        :param resource_monitor: Optional
+            amap.utils.resources.ResourceMonitor to record the resources used
+            by each NiftyReg program
+        """
         self.registration_config = registration_config
         self.paths = paths
         self.reg_params = registration_params
@@ -39,13 +53,46 @@ class BrainRegistration(object):
             self.n_processes = None
 
         self.dataset_img_path = paths.tmp__downsampled_filtered
-        self.brain_of_atlas_img_path = paths.brain_filtered
+        if brain_of_atlas_img_path is None:
+            brain_of_atlas_img_path = paths.brain_filtered
+        self.brain_of_atlas_img_path = brain_of_atlas_img_path
         self.atlas_img_path = paths.annotations
         self.hemispheres_img_path = paths.hemispheres
+        self.resource_monitor = resource_monitor
+
+    def with_n_processes(self, n_processes):
+        """
+        Get a copy of this BrainRegistration using a different number of
+        OpenMP threads (e.g. to run several registrations at once).
+
+        :param int n_processes: The number of threads
+        :return: The copy
+        :rtype: BrainRegistration
+        """
+        brain_reg = copy.copy(self)
+        brain_reg.n_processes = n_processes
+        if n_processes is not None:
+            brain_reg._prepare_openmp_thread_flag()
+        return brain_reg
 
     def _prepare_openmp_thread_flag(self):
         self.openmp_flag = "-omp {}".format(self.n_processes)
 
+    def _execute(
+        self, stage, cmd, log_file_path, error_file_path, multithreaded=False
+    ):
+        if self.resource_monitor is None:
+            safe_execute_command(cmd, log_file_path, error_file_path)
+        else:
+            # only the programs given the OpenMP flag use several threads
+            self.resource_monitor.execute(
+                stage,
+                cmd,
+                log_file_path,
+                error_file_path,
+                n_threads=self.n_processes if multithreaded else 1,
+            )
+
     def _prepare_affine_reg_cmd(self):
         cmd = "{} {} -flo {} -ref {} -aff {} -res {}".format(
             self.reg_params.affine_reg_program_path,
@@ -70,10 +117,12 @@ class BrainRegistration(object):
             registration.
         """
         try:
-            safe_execute_command(
+            self._execute(
+                "affine",
                 self._prepare_affine_reg_cmd(),
                 self.paths.tmp__affine_log_file_path,
                 self.paths.tmp__affine_error_path,
+                multithreaded=True,
             )
         except SafeExecuteCommandError as err:
             raise RegistrationError(
@@ -105,10 +154,12 @@ class BrainRegistration(object):
             registration.
         """
         try:
-            safe_execute_command(
+            self._execute(
+                "freeform",
                 self._prepare_freeform_reg_cmd(),
                 self.paths.tmp__freeform_log_file_path,
                 self.paths.tmp__freeform_error_file_path,
+                multithreaded=True,
             )
         except SafeExecuteCommandError as err:
             raise RegistrationError(
@@ -138,7 +189,8 @@ class BrainRegistration(object):
         """
         logging.debug("Generating inverse affine transform")
         try:
-            safe_execute_command(
+            self._execute(
+                "invert_affine",
                 self._prepare_invert_affine_cmd(),
                 self.paths.tmp__invert_affine_log_file,
                 self.paths.tmp__invert_affine_error_file,
@@ -176,10 +228,12 @@ class BrainRegistration(object):
         logging.debug("Registering sample to atlas")
 
         try:
-            safe_execute_command(
+            self._execute(
+                "inverse_freeform",
                 self._prepare_inverse_freeform_reg_cmd(),
                 self.paths.tmp__inverse_freeform_log_file_path,
                 self.paths.tmp__inverse_freeform_error_file_path,
+                multithreaded=True,
             )
         except SafeExecuteCommandError as err:
             raise RegistrationError(
@@ -208,7 +262,8 @@ class BrainRegistration(object):
             propagation.
         """
         try:
-            safe_execute_command(
+            self._execute(
+                "segment",
                 self._prepare_segmentation_cmd(
                     self.atlas_img_path, self.paths.registered_atlas_img_path
                 ),
@@ -216,7 +271,7 @@ class BrainRegistration(object):
                 self.paths.tmp__segmentation_error_file,
             )
         except SafeExecuteCommandError as err:
-            SegmentationError("Segmentation failed; {}".format(err))
+            raise SegmentationError("Segmentation failed; {}".format(err))
 
     def register_hemispheres(self):
         """
@@ -225,17 +280,18 @@ class BrainRegistration(object):
         hemispheres atlas itself).
 
         :return:
-        :raises RegistrationError: If any error was detected during the
+        :raises SegmentationError: If any error was detected during the
             propagation.
         """
         try:
-            safe_execute_command(
+            self._execute(
+                "hemispheres",
                 self._prepare_segmentation_cmd(
                     self.hemispheres_img_path,
                     self.paths.registered_hemispheres_img_path,
                 ),
-                self.paths.tmp__segmentation_log_file,
-                self.paths.tmp__segmentation_error_file,
+                self.paths.tmp__hemispheres_log_file,
+                self.paths.tmp__hemispheres_error_file,
             )
         except SafeExecuteCommandError as err:
-            SegmentationError("Segmentation failed; {}".format(err))
+            raise SegmentationError("Segmentation failed; {}".format(err))
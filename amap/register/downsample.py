@@ -0,0 +1,250 @@
+"""
+downsample
+==========
+
+Streaming (out-of-core) downsampling of raw data stored as a series of 2D
+planes (or in a chunk store, see amap.tools.chunk_store). Planes are loaded
+and downsampled in X/Y in chunks, and interpolated in Z as soon as the
+planes required are available, so that the peak memory is bounded by the
+chunk size rather than the size of the raw data. The result is the same as
+brainio.load_any with the same scaling factors.
+"""
+
+import os
+import math
+import logging
+import warnings
+import tifffile
+import numpy as np
+
+from tqdm import tqdm
+from natsort import natsorted
+from concurrent.futures import ThreadPoolExecutor
+from skimage import transform
+
+from imlib.general.system import get_sorted_file_paths
+
+from amap.tools.chunk_store import ChunkStore
+
+
+def get_plane_paths(src_path, sort_input_file=False):
+    """
+    Get the paths of each plane of the raw data, if the data can be
+    streamed (i.e. it is a directory of tiff files, or a text file listing
+    the files).
+
+    :param str src_path: Path to the raw data
+    :param bool sort_input_file: If set to true and the input is a
+        filepaths file, it will be naturally sorted
+    :return: The list of plane paths, or None if the data is in a format
+        that cannot be streamed
+    :rtype: list
+    """
+    src_path = str(src_path)
+    if os.path.isdir(src_path):
+        return get_sorted_file_paths(src_path, file_extension=".tif")
+    elif src_path.endswith(".txt"):
+        with open(src_path, "r") as in_file:
+            paths = [p.strip() for p in in_file.readlines()]
+        if sort_input_file:
+            paths = natsorted(paths)
+        return paths
+    else:
+        return None
+
+
+def load_plane(path, x_scaling_factor, y_scaling_factor, anti_aliasing=True):
+    """
+    Load a single plane and downsample it in X/Y (as brainio does).
+
+    :param str path: Path to the plane
+    :param float x_scaling_factor: The scaling along the first dimension
+    :param float y_scaling_factor: The scaling along the second dimension
+    :param bool anti_aliasing: Whether to apply a Gaussian filter to smooth
+        the image prior to down-scaling
+    :return: The downsampled plane
+    :rtype: np.array
+    """
+    return downsample_plane(
+        tifffile.imread(path),
+        x_scaling_factor,
+        y_scaling_factor,
+        anti_aliasing=anti_aliasing,
+    )
+
+
+def downsample_plane(
+    img, x_scaling_factor, y_scaling_factor, anti_aliasing=True
+):
+    """
+    Downsample a single plane in X/Y (as brainio does).
+
+    :param np.array img: The plane
+    :param float x_scaling_factor: The scaling along the first dimension
+    :param float y_scaling_factor: The scaling along the second dimension
+    :param bool anti_aliasing: Whether to apply a Gaussian filter to smooth
+        the image prior to down-scaling
+    :return: The downsampled plane
+    :rtype: np.array
+    """
+    if x_scaling_factor != 1 and y_scaling_factor != 1:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            img = transform.rescale(
+                img,
+                (x_scaling_factor, y_scaling_factor),
+                mode="constant",
+                preserve_range=True,
+                anti_aliasing=anti_aliasing,
+            )
+    return img
+
+
+def get_z_interpolation_coordinates(n_planes_in, n_planes_out):
+    """
+    Get the input (fractional) plane coordinate of each output plane, as
+    used by scipy.ndimage.zoom (i.e. the first and last planes are aligned).
+
+    :param int n_planes_in: Number of planes in the input
+    :param int n_planes_out: Number of planes in the output
+    :return: Array of input coordinates for each output plane
+    :rtype: np.array
+    """
+    if n_planes_out > 1:
+        ratio = (n_planes_in - 1) / (n_planes_out - 1)
+    else:
+        ratio = 1.0
+    return np.arange(n_planes_out) * ratio
+
+
+def interpolate_plane(plane_0, plane_1, weight, dtype):
+    """
+    Linearly interpolate between two planes, rounding to the nearest
+    integer for integer types (as scipy.ndimage.zoom with order=1).
+
+    :param np.array plane_0: The lower plane
+    :param np.array plane_1: The upper plane
+    :param float weight: The weight of the upper plane
+    :param dtype: The output type
+    :return: The interpolated plane
+    :rtype: np.array
+    """
+    plane = plane_0.astype(np.float64) * (1 - weight)
+    plane += plane_1.astype(np.float64) * weight
+    if np.issubdtype(dtype, np.integer):
+        plane = np.floor(plane + 0.5)
+    return plane.astype(dtype)
+
+
+def load_downsampled_streaming(
+    paths,
+    x_scaling_factor,
+    y_scaling_factor,
+    z_scaling_factor,
+    anti_aliasing=True,
+    chunk_size=32,
+    n_processes=1,
+    output_path=None,
+):
+    """
+    Load and downsample a series of planes, one chunk of planes at a time.
+    Each chunk is downsampled in X/Y (in parallel if n_processes > 1), and
+    every output plane whose input planes have been loaded is then
+    interpolated in Z. The last plane of each chunk is kept so that output
+    planes falling between two chunks are interpolated correctly.
+
+    :param paths: Ordered list of plane paths, or a ChunkStore of the
+        planes (read a chunk of planes at a time, so chunk_size is best a
+        multiple of the chunk size of the store)
+    :param float x_scaling_factor: The scaling along the first dimension
+    :param float y_scaling_factor: The scaling along the second dimension
+    :param float z_scaling_factor: The scaling along the third dimension
+        (across planes)
+    :param bool anti_aliasing: Whether to apply a Gaussian filter to smooth
+        the image prior to down-scaling
+    :param int chunk_size: How many raw planes to load at once
+    :param int n_processes: How many threads to use to load and
+        downsample planes
+    :param str output_path: If not None, the output is written to a
+        memory-mapped .npy file at this path rather than held in memory
+    :return: The downsampled image, with planes along the last axis
+    :rtype: np.array
+    """
+    n_planes_in = len(paths)
+    n_planes_out = int(round(n_planes_in * z_scaling_factor))
+
+    if isinstance(paths, ChunkStore):
+        first_plane = paths[0]
+    else:
+        first_plane = tifffile.imread(paths[0])
+    dtype = first_plane.dtype
+    first_plane = downsample_plane(
+        first_plane, x_scaling_factor, y_scaling_factor, anti_aliasing
+    )
+    shape = first_plane.shape + (n_planes_out,)
+    logging.debug(
+        f"Streaming {n_planes_in} planes in chunks of {chunk_size} into an "
+        f"image of shape: {shape}"
+    )
+    if output_path is not None:
+        downsampled = np.lib.format.open_memmap(
+            output_path, mode="w+", dtype=dtype, shape=shape
+        )
+    else:
+        downsampled = np.empty(shape, dtype=dtype)
+
+    coordinates = get_z_interpolation_coordinates(n_planes_in, n_planes_out)
+    next_output_plane = 0
+    loaded_planes = {}
+
+    n_chunks = math.ceil(n_planes_in / chunk_size)
+    with ThreadPoolExecutor(max_workers=n_processes) as pool, tqdm(
+        total=n_planes_in, desc="Downsampling", unit="plane"
+    ) as bar:
+        for chunk_idx in range(n_chunks):
+            start = chunk_idx * chunk_size
+            end = min(start + chunk_size, n_planes_in)
+            if isinstance(paths, ChunkStore):
+                planes = pool.map(
+                    lambda plane: downsample_plane(
+                        plane,
+                        x_scaling_factor,
+                        y_scaling_factor,
+                        anti_aliasing,
+                    ),
+                    paths[start:end],
+                )
+            else:
+                planes = pool.map(
+                    lambda path: load_plane(
+                        path, x_scaling_factor, y_scaling_factor, anti_aliasing
+                    ),
+                    paths[start:end],
+                )
+            for idx, plane in enumerate(planes, start=start):
+                # cast as brainio does, by assigning into the output type
+                loaded_planes[idx] = plane.astype(dtype)
+            bar.update(end - start)
+
+            while next_output_plane < n_planes_out:
+                coordinate = coordinates[next_output_plane]
+                lower = int(math.floor(coordinate))
+                upper = min(lower + 1, n_planes_in - 1)
+                if upper >= end:
+                    break
+                if z_scaling_factor == 1:
+                    downsampled[..., next_output_plane] = loaded_planes[lower]
+                else:
+                    downsampled[..., next_output_plane] = interpolate_plane(
+                        loaded_planes[lower],
+                        loaded_planes[upper],
+                        coordinate - lower,
+                        dtype,
+                    )
+                next_output_plane += 1
+
+            # only the last plane may be needed to interpolate planes
+            # between this chunk and the next
+            loaded_planes = {end - 1: loaded_planes[end - 1]}
+
+    return downsampled
@@ -0,0 +1,66 @@
+"""
+similarity
+==========
+
+Measures of how well two (registered) images match, e.g. to compare the
+results of different registration parameters.
+"""
+
+import numpy as np
+
+
+def normalised_mutual_information(image_0, image_1, n_bins=64, mask=None):
+    """
+    Compute the normalised mutual information, (H(A) + H(B)) / H(A, B), of
+    two images of the same shape. It is 1 for independent images and 2 for
+    identical ones.
+
+    :param np.array image_0: The first image
+    :param np.array image_1: The second image
+    :param int n_bins: Number of intensity bins per image
+    :param np.array mask: Optional boolean array of the voxels to include
+    :return: The normalised mutual information
+    :rtype: float
+    """
+    image_0, image_1 = _masked_voxels(image_0, image_1, mask)
+    joint_histogram, _, _ = np.histogram2d(image_0, image_1, bins=n_bins)
+    joint_probability = joint_histogram / joint_histogram.sum()
+
+    joint_entropy = _entropy(joint_probability)
+    if joint_entropy == 0:
+        return 2.0
+    return (
+        _entropy(joint_probability.sum(axis=1))
+        + _entropy(joint_probability.sum(axis=0))
+    ) / joint_entropy
+
+
+def correlation_coefficient(image_0, image_1, mask=None):
+    """
+    Compute the Pearson correlation coefficient of the voxel intensities of
+    two images of the same shape.
+
+    :param np.array image_0: The first image
+    :param np.array image_1: The second image
+    :param np.array mask: Optional boolean array of the voxels to include
+    :return: The correlation coefficient
+    :rtype: float
+    """
+    image_0, image_1 = _masked_voxels(image_0, image_1, mask)
+    return float(np.corrcoef(image_0, image_1)[0, 1])
+
+
+def _masked_voxels(image_0, image_1, mask=None):
+    if image_0.shape != image_1.shape:
+        raise ValueError(
+            f"Images must have the same shape, not: {image_0.shape} and "
+            f"{image_1.shape}"
+        )
+    if mask is None:
+        return image_0.ravel(), image_1.ravel()
+    return image_0[mask], image_1[mask]
+
+
+def _entropy(probability):
+    probability = probability[probability > 0]
+    return -np.sum(probability * np.log(probability))
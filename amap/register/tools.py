@@ -2,7 +2,14 @@ import os
 import logging
 import numpy as np
 
-from amap.register.brain_processor import BrainProcessor
+from concurrent.futures import ProcessPoolExecutor
+from brainio import brainio
+
+from amap.register.brain_processor import (
+    get_scaling_factors,
+    load_downsampled,
+)
+from amap.utils.scheduler import get_process_pool_context
 
 
 def save_downsampled_image(
@@ -17,6 +24,9 @@ def save_downsampled_image(
     n_free_cpus=2,
     sort_input_file=False,
     load_parallel=True,
+    streaming=False,
+    streaming_chunk_size=32,
+    streaming_memmap=False,
 ):
     """
 
@@ -32,29 +42,191 @@ def save_downsampled_image(
     :param sort_input_file: Should the data be naturally sorted
     (e.g. file paths)
     :param load_parallel: If possible, load the data in parallel
+    :param streaming: Load and downsample the data in chunks of planes
+    :param streaming_chunk_size: Number of raw planes to load at once
+    :param streaming_memmap: Stream the downsampled data into a
+    (temporary) memory-mapped file
+    """
+    save_downsampled_images(
+        {name: image},
+        output_folder,
+        atlas,
+        x_pixel_um=x_pixel_um,
+        y_pixel_um=y_pixel_um,
+        z_pixel_um=z_pixel_um,
+        orientation=orientation,
+        n_free_cpus=n_free_cpus,
+        sort_input_file=sort_input_file,
+        load_parallel=load_parallel,
+        streaming=streaming,
+        streaming_chunk_size=streaming_chunk_size,
+        streaming_memmap=streaming_memmap,
+    )
+
+
+def save_downsampled_images(
+    images,
+    output_folder,
+    atlas,
+    x_pixel_um=0.02,
+    y_pixel_um=0.02,
+    z_pixel_um=0.05,
+    orientation="coronal",
+    n_free_cpus=2,
+    sort_input_file=False,
+    load_parallel=True,
+    n_processes=1,
+    streaming=False,
+    streaming_chunk_size=32,
+    streaming_memmap=False,
+):
+    """
+    Downsample a number of images (channels) to the same coordinate space
+    as the atlas. The scaling factors and output image metadata are only
+    computed once (from the atlas), and if n_processes > 1, the channels are
+    downsampled concurrently, with one channel per process.
+
+    :param dict images: dict of {image_name: image_to_be_downsampled}
+    :param output_folder: Where the images are to be saved
+    :param atlas: atlas config
+    :param x_pixel_um: pixel spacing in the first dimension
+    :param y_pixel_um: pixel spacing in the second dimension
+    :param z_pixel_um: pixel spacing in the second dimension
+    :param orientation: anatomical orientation of the image
+    :param n_free_cpus: how many cpus to leave free when loading data
+    :param sort_input_file: Should the data be naturally sorted
+    (e.g. file paths)
+    :param load_parallel: If possible, load the data in parallel. Only used
+    when the channels are downsampled one at a time.
+    :param n_processes: How many channels to downsample at once
+    :param streaming: Load and downsample the data in chunks of planes
+    :param streaming_chunk_size: Number of raw planes to load at once
+    :param streaming_memmap: Stream the downsampled data into a
+    (temporary) memory-mapped file
+    """
+    if not images:
+        return
+
+    atlas_pixel_sizes = atlas.pix_sizes
+    scaling_factors = get_scaling_factors(
+        atlas_pixel_sizes, x_pixel_um, y_pixel_um, z_pixel_um
+    )
+    scale = tuple(atlas_pixel_sizes[axis] / 1000 for axis in ("x", "y", "z"))
+    transformation_matrix = atlas.make_atlas_scale_transformation_matrix()
+
+    n_workers = min(len(images), n_processes)
+    if n_workers > 1:
+        logging.info(
+            f"Downsampling {len(images)} images using {n_workers} processes"
+        )
+        load_parallel = False
+
+    kwargs = dict(
+        n_free_cpus=n_free_cpus,
+        sort_input_file=sort_input_file,
+        load_parallel=load_parallel,
+        streaming=streaming,
+        streaming_chunk_size=streaming_chunk_size,
+        streaming_memmap=streaming_memmap,
+    )
+
+    if n_workers > 1:
+        with ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=get_process_pool_context()
+        ) as pool:
+            futures = [
+                pool.submit(
+                    downsample_and_save,
+                    image,
+                    name,
+                    output_folder,
+                    scaling_factors,
+                    scale,
+                    transformation_matrix,
+                    **kwargs,
+                )
+                for name, image in images.items()
+            ]
+            for future in futures:
+                future.result()
+    else:
+        for name, image in images.items():
+            downsample_and_save(
+                image,
+                name,
+                output_folder,
+                scaling_factors,
+                scale,
+                transformation_matrix,
+                **kwargs,
+            )
+
+
+def downsample_and_save(
+    image,
+    name,
+    output_folder,
+    scaling_factors,
+    scale,
+    transformation_matrix,
+    n_free_cpus=2,
+    sort_input_file=False,
+    load_parallel=True,
+    streaming=False,
+    streaming_chunk_size=32,
+    streaming_memmap=False,
+):
     """
+    Downsample a single image by precomputed scaling factors, and save it
+    (as "downsampled_{name}.nii") in the same coordinate space as the main
+    downsampled brain.
 
+    :param image: Image to be downsampled.
+    :param str name: Name of the image (for the filename and logging)
+    :param output_folder: Where the image is to be saved
+    :param tuple scaling_factors: x, y, z scaling factors
+    :param tuple scale: The 'zooms' of the output nifti image
+    :param np.ndarray transformation_matrix: The affine transform of the
+    output nifti image
+    :param n_free_cpus: how many cpus to leave free when loading data
+    :param sort_input_file: Should the data be naturally sorted
+    (e.g. file paths)
+    :param load_parallel: If possible, load the data in parallel
+    :param streaming: Load and downsample the data in chunks of planes
+    :param streaming_chunk_size: Number of raw planes to load at once
+    :param streaming_memmap: Stream the downsampled data into a
+    (temporary) memory-mapped file
+    """
     logging.info(f"Downsampling image: {name}")
     logging.info("Loading data")
-    brain = BrainProcessor(
-        atlas,
+    memmap_path = None
+    if streaming_memmap:
+        memmap_path = os.path.join(output_folder, f"downsampled_{name}.npy")
+
+    downsampled = load_downsampled(
         image,
-        output_folder,
-        x_pixel_um,
-        y_pixel_um,
-        z_pixel_um,
-        original_orientation=orientation,
+        *scaling_factors,
         load_parallel=load_parallel,
         sort_input_file=sort_input_file,
-        load_atlas=False,
         n_free_cpus=n_free_cpus,
+        streaming=streaming,
+        streaming_chunk_size=streaming_chunk_size,
+        streaming_output_path=memmap_path,
     )
+    # same orientation as BrainProcessor.swap_numpy_to_image_axis
+    downsampled = np.swapaxes(downsampled, 0, 1)
+    downsampled = downsampled.astype(np.uint16, copy=False)
 
     downsampled_brain_path = os.path.join(
         output_folder, f"downsampled_{name}.nii"
     )
-
-    brain.target_brain = brain.target_brain.astype(np.uint16, copy=False)
-    logging.info("Saving downsampled image")
-    brain.save(downsampled_brain_path)
-    del brain
+    logging.info(f"Saving downsampled image: {name}")
+    brainio.to_nii(
+        downsampled,
+        downsampled_brain_path,
+        scale=scale,
+        affine_transform=transformation_matrix,
+    )
+    del downsampled
+    if memmap_path is not None and os.path.exists(memmap_path):
+        os.remove(memmap_path)
@@ -1,6 +1,6 @@
 """
-registration_params
-===================
+volume
+======
 
 Module to calculate volume of brain regions
 """
@@ -8,14 +8,15 @@ Module to calculate volume of brain regions
 import numpy as np
 import pandas as pd
 import logging
+import warnings
 
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 from brainio import brainio
-from imlib.pandas.misc import initialise_df
 from imlib.general.config import get_config_obj
 
-
-def load_structures_as_df(structures_file_path):
-    return pd.read_csv(structures_file_path, sep=",", header=0, quotechar='"')
+from amap.tools.structures import load_structures_as_df, StructureLookup
+from amap.utils.scheduler import get_process_pool_context
 
 
 def get_voxel_volume(registration_config):
@@ -30,94 +31,289 @@ def get_voxel_volume(registration_config):
     return voxel_volume
 
 
-def lateralise_atlas(
-    atlas, hemispheres, left_hemisphere_value=2, right_hemisphere_value=1
+def get_hemisphere_codes(
+    hemispheres, left_hemisphere_value=2, right_hemisphere_value=1
 ):
-    atlas_left = atlas[hemispheres == left_hemisphere_value]
-    atlas_right = atlas[hemispheres == right_hemisphere_value]
-    return atlas_left, atlas_right
+    """
+    Code each voxel by hemisphere: 1 for the left, 2 for the right and 0 for
+    neither.
 
+    :param np.array hemispheres: The hemispheres image
+    :param int left_hemisphere_value: The value of the left hemisphere
+    :param int right_hemisphere_value: The value of the right hemisphere
+    :return: The codes
+    :rtype: np.array
+    """
+    codes = np.zeros(hemispheres.shape, dtype=np.uint8)
+    codes[hemispheres == left_hemisphere_value] = 1
+    codes[hemispheres == right_hemisphere_value] = 2
+    return codes
 
-def get_lateralised_atlas(
-    atlas_path,
-    hemispheres_path,
+
+def count_structure_voxels(
+    atlas,
+    hemispheres,
+    structure_lookup,
     left_hemisphere_value=2,
     right_hemisphere_value=1,
 ):
-    atlas = brainio.load_any(atlas_path)
-    hemispheres = brainio.load_any(hemispheres_path)
+    """
+    Count the voxels of each structure in each hemisphere, in a single pass
+    over the images, as a joint histogram of (structure, hemisphere).
 
-    atlas_left, atlas_right = lateralise_atlas(
-        atlas,
-        hemispheres,
+    :param np.array atlas: The (registered) atlas. The labels may be of any
+        numerical type (e.g. float, after registration).
+    :param np.array hemispheres: The (registered) hemispheres image
+    :param structure_lookup: The amap.tools.structures.StructureLookup of
+        the atlas
+    :param int left_hemisphere_value: The value of the left hemisphere
+    :param int right_hemisphere_value: The value of the right hemisphere
+    :return: The counts of each structure (in order of structure id) in the
+        left and right hemispheres (shape: (len(structure_lookup), 2)), and
+        the sorted values of the atlas in the left hemisphere that are not
+        structure ids
+    :rtype: tuple
+    """
+    atlas = np.asarray(atlas).ravel()
+    hemisphere_codes = get_hemisphere_codes(
+        np.asarray(hemispheres).ravel(),
         left_hemisphere_value=left_hemisphere_value,
         right_hemisphere_value=right_hemisphere_value,
     )
+    n_structures = len(structure_lookup)
 
-    unique_vals_left, counts_left = np.unique(atlas_left, return_counts=True)
-    unique_vals_right, counts_right = np.unique(
-        atlas_right, return_counts=True
+    # neighbouring voxels mostly share a structure and hemisphere, so each
+    # run of identical (label, hemisphere) voxels is only looked up once
+    run_starts = np.flatnonzero(
+        (atlas[1:] != atlas[:-1])
+        | (hemisphere_codes[1:] != hemisphere_codes[:-1])
     )
-    return unique_vals_left, unique_vals_right, counts_left, counts_right
+    run_starts = np.concatenate(([0], run_starts + 1))
+    run_lengths = np.diff(np.append(run_starts, atlas.size))
+    run_values = atlas[run_starts]
+    run_codes = hemisphere_codes[run_starts]
 
+    # the index of each run's structure, or n_structures if it is unknown
+    structure_idx = structure_lookup.get_positions(run_values)
+    unknown = structure_idx == -1
+    structure_idx[unknown] = n_structures
 
-class UnknownAtlasValue(Exception):
-    pass
+    counts = np.bincount(
+        structure_idx * 3 + run_codes,
+        weights=run_lengths,
+        minlength=(n_structures + 1) * 3,
+    )
+    counts = counts.astype(np.int64).reshape(n_structures + 1, 3)
+    unknown_values = np.unique(run_values[unknown & (run_codes == 1)])
+    return counts[:n_structures, 1:], unknown_values
 
 
-def atlas_value_to_name(atlas_value, structures_reference_df):
-    line = structures_reference_df[
-        structures_reference_df["id"] == atlas_value
+def count_structure_voxels_in_slabs(
+    atlas_path,
+    hemispheres_path,
+    structure_lookup,
+    slab_size=32,
+    n_processes=1,
+    left_hemisphere_value=2,
+    right_hemisphere_value=1,
+):
+    """
+    Count the voxels of each structure in each hemisphere (as
+    count_structure_voxels), reading the images from disk in slabs of
+    planes, so that the memory used is bounded by the slab size rather than
+    the size of the images. Uncompressed nifti files are memory-mapped.
+
+    :param atlas_path: The (registered) atlas
+    :param hemispheres_path: The (registered) hemispheres image
+    :param structure_lookup: The amap.tools.structures.StructureLookup of
+        the atlas
+    :param int slab_size: How many planes (along the third axis) to read at
+        once
+    :param int n_processes: If more than one, count the slabs in parallel
+        using this many processes
+    :param int left_hemisphere_value: The value of the left hemisphere
+    :param int right_hemisphere_value: The value of the right hemisphere
+    :return: As count_structure_voxels
+    :rtype: tuple
+    """
+    atlas_shape = brainio.load_nii(str(atlas_path)).shape
+    hemispheres_shape = brainio.load_nii(str(hemispheres_path)).shape
+    if atlas_shape != hemispheres_shape:
+        raise ValueError(
+            f"The atlas and hemispheres images must have the same shape, "
+            f"not: {atlas_shape} and {hemispheres_shape}"
+        )
+
+    slabs = [
+        (start, min(start + slab_size, atlas_shape[2]))
+        for start in range(0, atlas_shape[2], slab_size)
     ]
-    if len(line) == 0:
-        raise UnknownAtlasValue(atlas_value)
-    name = line["name"]
-    return str(name.values[0])
+    count_slab = partial(
+        _count_slab_structure_voxels,
+        str(atlas_path),
+        str(hemispheres_path),
+        structure_lookup,
+        left_hemisphere_value=left_hemisphere_value,
+        right_hemisphere_value=right_hemisphere_value,
+    )
 
+    counts = np.zeros((len(structure_lookup), 2), dtype=np.int64)
+    unknown_values = []
+    if n_processes > 1:
+        with ProcessPoolExecutor(
+            max_workers=n_processes, mp_context=get_process_pool_context()
+        ) as executor:
+            slab_counts = list(executor.map(count_slab, slabs))
+    else:
+        slab_counts = map(count_slab, slabs)
+    for slab_count, slab_unknown_values in slab_counts:
+        counts += slab_count
+        unknown_values.append(slab_unknown_values)
+    return counts, np.unique(np.concatenate(unknown_values))
 
-def add_structure_volume_to_df(
-    df,
-    atlas_value,
-    structures_reference_df,
-    unique_vals_left,
-    unique_vals_right,
-    counts_left,
-    counts_right,
-    voxel_volume,
+
+def _count_slab_structure_voxels(
+    atlas_path,
+    hemispheres_path,
+    structure_lookup,
+    slab,
+    left_hemisphere_value=2,
+    right_hemisphere_value=1,
 ):
+    start, end = slab
+    atlas = brainio.load_nii(atlas_path).dataobj[:, :, start:end]
+    hemispheres = brainio.load_nii(hemispheres_path).dataobj[:, :, start:end]
+    return count_structure_voxels(
+        atlas,
+        hemispheres,
+        structure_lookup,
+        left_hemisphere_value=left_hemisphere_value,
+        right_hemisphere_value=right_hemisphere_value,
+    )
+
+
+def get_structure_ancestors(structures_reference_df):
+    """
+    Index each structure's ancestors (including itself), from the
+    "structure_id_path" (e.g. "/997/8/567/") or "parent_structure_id"
+    columns of the structures table. Ancestors that are not in the table are
+    ignored.
 
-    name = atlas_value_to_name(atlas_value, structures_reference_df)
+    :param pd.DataFrame structures_reference_df: The structures table (with
+        unique ids)
+    :return: The positions (in the table) of each structure, the positions
+        of each of its ancestors, and the list of the ids of each
+        structure's ancestors (from the root). If the table has no hierarchy,
+        each structure is only its own ancestor.
+    :rtype: tuple
+    """
+    ids = [int(structure_id) for structure_id in structures_reference_df["id"]]
+    positions = {structure_id: idx for idx, structure_id in enumerate(ids)}
 
-    try:
-        left_index = np.where(unique_vals_left == atlas_value)[0][0]
-        left_volume = counts_left[left_index] * voxel_volume
-    except IndexError:
+    if "structure_id_path" in structures_reference_df:
+        id_paths = [
+            [int(part) for part in str(id_path).strip("/").split("/") if part]
+            for id_path in structures_reference_df["structure_id_path"]
+        ]
+    elif "parent_structure_id" in structures_reference_df:
+        parents = {
+            structure_id: (None if pd.isnull(parent) else int(parent))
+            for structure_id, parent in zip(
+                ids, structures_reference_df["parent_structure_id"]
+            )
+        }
+        id_paths = []
+        for structure_id in ids:
+            id_path = [structure_id]
+            while parents.get(id_path[0]) is not None:
+                id_path.insert(0, parents[id_path[0]])
+            id_paths.append(id_path)
+    else:
         logging.warning(
-            "Atlas value: {} not found in registered atlas. "
-            "Setting registered volume to 0.".format(atlas_value)
+            "The structures file has no hierarchy (structure_id_path or "
+            "parent_structure_id). Volumes will not be rolled up."
         )
-        left_volume = 0
+        id_paths = [[structure_id] for structure_id in ids]
 
-    try:
-        right_index = np.where(unique_vals_right == atlas_value)[0][0]
-        right_volume = counts_right[right_index] * voxel_volume
-    except IndexError:
-        logging.warning(
-            "Atlas value: {} not found in registered atlas. "
-            "Setting registered volume to 0.".format(atlas_value)
+    structure_positions = []
+    ancestor_positions = []
+    ancestor_ids = []
+    for idx, (structure_id, id_path) in enumerate(zip(ids, id_paths)):
+        if not id_path or id_path[-1] != structure_id:
+            id_path = id_path + [structure_id]
+        id_path = [
+            ancestor_id for ancestor_id in id_path if ancestor_id in positions
+        ]
+        ancestor_ids.append(id_path)
+        structure_positions.extend([idx] * len(id_path))
+        ancestor_positions.extend(
+            positions[ancestor_id] for ancestor_id in id_path
         )
-        right_volume = 0
+    return (
+        np.array(structure_positions, dtype=np.intp),
+        np.array(ancestor_positions, dtype=np.intp),
+        ancestor_ids,
+    )
+
+
+def roll_up_counts(counts, structure_positions, ancestor_positions):
+    """
+    Add the counts of each structure to all of its ancestors.
+
+    :param np.array counts: The counts of each structure (first axis)
+    :param np.array structure_positions: See get_structure_ancestors
+    :param np.array ancestor_positions: See get_structure_ancestors
+    :return: The counts of each structure, including those of all its
+        descendants
+    :rtype: np.array
+    """
+    rolled_up = np.zeros_like(counts)
+    np.add.at(rolled_up, ancestor_positions, counts[structure_positions])
+    return rolled_up
 
-    df = df.append(
+
+def save_volume_hierarchy(
+    counts, structures_reference_df, voxel_volume_in_mm, output_file
+):
+    """
+    Save the volume of each structure, including all of its descendants, in
+    each hemisphere. Only structures with a volume are saved, in the order
+    of the structures file.
+
+    :param np.array counts: The counts of each structure in the left and
+        right hemispheres
+    :param pd.DataFrame structures_reference_df: The structures table (with
+        unique ids, in the same order as the counts)
+    :param float voxel_volume_in_mm: The volume of a voxel (mm3)
+    :param output_file: The csv file to save the volumes to
+    """
+    (
+        structure_positions,
+        ancestor_positions,
+        ancestor_ids,
+    ) = get_structure_ancestors(structures_reference_df)
+    counts = roll_up_counts(counts, structure_positions, ancestor_positions)
+
+    left_volumes = counts[:, 0] * voxel_volume_in_mm
+    right_volumes = counts[:, 1] * voxel_volume_in_mm
+    df = pd.DataFrame(
         {
-            "structure_name": name,
-            "left_volume_mm3": left_volume,
-            "right_volume_mm3": right_volume,
-            "total_volume_mm3": left_volume + right_volume,
+            "structure_id": structures_reference_df["id"].values,
+            "structure_name": structures_reference_df["name"].values,
+            "parent_structure_id": [
+                id_path[-2] if len(id_path) > 1 else None
+                for id_path in ancestor_ids
+            ],
+            "depth": [len(id_path) - 1 for id_path in ancestor_ids],
+            "left_volume_mm3": left_volumes,
+            "right_volume_mm3": right_volumes,
+            "total_volume_mm3": left_volumes + right_volumes,
         },
-        ignore_index=True,
+        index=structures_reference_df.index,
     )
-    return df
+    df["parent_structure_id"] = df["parent_structure_id"].astype("Int64")
+    df = df[(counts.sum(axis=1) > 0) & (df["structure_id"] != 0)]
+    df.sort_index().to_csv(output_file, index=False)
 
 
 def calculate_volumes(
@@ -128,48 +324,204 @@ def calculate_volumes(
     output_file,
     left_hemisphere_value=2,
     right_hemisphere_value=1,
+    slab_size=None,
+    n_processes=1,
+    hierarchy_output_file=None,
 ):
-    (
-        unique_vals_left,
-        unique_vals_right,
-        counts_left,
-        counts_right,
-    ) = get_lateralised_atlas(
-        atlas_path,
-        hemispheres_path,
-        left_hemisphere_value=left_hemisphere_value,
-        right_hemisphere_value=right_hemisphere_value,
-    )
+    """
+    Calculate the volume of each structure in each hemisphere, and save them
+    as a csv file, with one row per structure in the left hemisphere of the
+    atlas (in order of structure id). Optionally, also save the volumes
+    rolled up the structure hierarchy (see save_volume_hierarchy).
+
+    :param atlas_path: The (registered) atlas
+    :param hemispheres_path: The (registered) hemispheres image
+    :param atlas_structures_path: The structures csv file of the atlas
+    :param registration_config: The amap config file
+    :param output_file: The csv file to save the volumes to
+    :param int left_hemisphere_value: The value of the left hemisphere
+    :param int right_hemisphere_value: The value of the right hemisphere
+    :param int slab_size: If not None, the images are read from disk in
+        slabs of this many planes rather than loaded into memory (see
+        count_structure_voxels_in_slabs), e.g. for atlases registered at
+        the resolution of the raw data. The result is the same.
+    :param int n_processes: When reading slabs, count them in parallel
+        using this many processes
+    :param hierarchy_output_file: If not None, save the volume of every
+        structure, including its descendants, to this csv file
+    """
+    structure_lookup = StructureLookup.from_file(atlas_structures_path)
+    structures_reference_df = structure_lookup.structures
+    structure_ids = structure_lookup.ids
+
+    if slab_size is None:
+        counts, unknown_values = count_structure_voxels(
+            brainio.load_any(atlas_path),
+            brainio.load_any(hemispheres_path),
+            structure_lookup,
+            left_hemisphere_value=left_hemisphere_value,
+            right_hemisphere_value=right_hemisphere_value,
+        )
+    else:
+        counts, unknown_values = count_structure_voxels_in_slabs(
+            atlas_path,
+            hemispheres_path,
+            structure_lookup,
+            slab_size=slab_size,
+            n_processes=n_processes,
+            left_hemisphere_value=left_hemisphere_value,
+            right_hemisphere_value=right_hemisphere_value,
+        )
+    for atlas_value in unknown_values:
+        if atlas_value != 0:  # outside brain
+            logging.warning(
+                "Value: {} is not in the atlas structure reference file. "
+                "Not calculating the volume".format(atlas_value)
+            )
 
-    structures_reference_df = load_structures_as_df(atlas_structures_path)
+    present = (counts[:, 0] > 0) & (structure_ids != 0)
+    for atlas_value in structure_ids[present & (counts[:, 1] == 0)]:
+        logging.warning(
+            "Atlas value: {} not found in registered atlas. "
+            "Setting registered volume to 0.".format(atlas_value)
+        )
 
     voxel_volume = get_voxel_volume(registration_config)
     voxel_volume_in_mm = voxel_volume / (1000 ** 3)
-    df = initialise_df(
-        "structure_name",
-        "left_volume_mm3",
-        "right_volume_mm3",
-        "total_volume_mm3",
+    left_volumes = counts[present, 0] * voxel_volume_in_mm
+    right_volumes = counts[present, 1] * voxel_volume_in_mm
+    df = pd.DataFrame(
+        {
+            "structure_name": structures_reference_df["name"].values[present],
+            "left_volume_mm3": left_volumes,
+            "right_volume_mm3": right_volumes,
+            "total_volume_mm3": left_volumes + right_volumes,
+        }
     )
+    df.to_csv(output_file, index=False)
 
-    for atlas_value in unique_vals_left:
-        if atlas_value is not 0:  # outside brain
-            try:
-                df = add_structure_volume_to_df(
-                    df,
-                    atlas_value,
-                    structures_reference_df,
-                    unique_vals_left,
-                    unique_vals_right,
-                    counts_left,
-                    counts_right,
-                    voxel_volume_in_mm,
-                )
-
-            except UnknownAtlasValue:
-                print(
-                    "Value: {} is not in the atlas structure reference file. "
-                    "Not calculating the volume".format(atlas_value)
-                )
+    if hierarchy_output_file is not None:
+        save_volume_hierarchy(
+            counts,
+            structures_reference_df,
+            voxel_volume_in_mm,
+            hierarchy_output_file,
+        )
 
-    df.to_csv(output_file, index=False)
+
+# The functions below are kept for code that used them before the volumes
+# were counted with a joint histogram (see count_structure_voxels), and will
+# be removed in a future release.
+
+
+class UnknownAtlasValue(Exception):
+    pass
+
+
+def _warn_deprecated(name, replacement):
+    warnings.warn(
+        f"amap.register.volume.{name} is deprecated, use {replacement} "
+        f"instead",
+        DeprecationWarning,
+        stacklevel=3,
+    )
+
+
+def lateralise_atlas(
+    atlas, hemispheres, left_hemisphere_value=2, right_hemisphere_value=1
+):
+    """
+    Deprecated, use count_structure_voxels.
+    """
+    _warn_deprecated("lateralise_atlas", "count_structure_voxels")
+    atlas_left = atlas[hemispheres == left_hemisphere_value]
+    atlas_right = atlas[hemispheres == right_hemisphere_value]
+    return atlas_left, atlas_right
+
+
+def get_lateralised_atlas(
+    atlas_path,
+    hemispheres_path,
+    left_hemisphere_value=2,
+    right_hemisphere_value=1,
+):
+    """
+    Deprecated, use count_structure_voxels (or
+    count_structure_voxels_in_slabs).
+    """
+    _warn_deprecated("get_lateralised_atlas", "count_structure_voxels")
+    atlas = brainio.load_any(atlas_path)
+    hemisphere_codes = get_hemisphere_codes(
+        brainio.load_any(hemispheres_path),
+        left_hemisphere_value=left_hemisphere_value,
+        right_hemisphere_value=right_hemisphere_value,
+    )
+    unique_vals_left, counts_left = np.unique(
+        atlas[hemisphere_codes == 1], return_counts=True
+    )
+    unique_vals_right, counts_right = np.unique(
+        atlas[hemisphere_codes == 2], return_counts=True
+    )
+    return unique_vals_left, unique_vals_right, counts_left, counts_right
+
+
+def atlas_value_to_name(atlas_value, structures_reference_df):
+    """
+    Deprecated, use amap.tools.structures.StructureLookup.get_name.
+
+    :raises UnknownAtlasValue: If the value is not a structure id
+    """
+    _warn_deprecated("atlas_value_to_name", "StructureLookup.get_name")
+    return _atlas_value_to_name(atlas_value, structures_reference_df)
+
+
+def _atlas_value_to_name(atlas_value, structures_reference_df):
+    name = StructureLookup(structures_reference_df).get_name(atlas_value)
+    if name is None:
+        raise UnknownAtlasValue(atlas_value)
+    return str(name)
+
+
+def add_structure_volume_to_df(
+    df,
+    atlas_value,
+    structures_reference_df,
+    unique_vals_left,
+    unique_vals_right,
+    counts_left,
+    counts_right,
+    voxel_volume,
+):
+    """
+    Deprecated, use calculate_volumes.
+
+    :raises UnknownAtlasValue: If the value is not a structure id
+    """
+    _warn_deprecated("add_structure_volume_to_df", "calculate_volumes")
+    name = _atlas_value_to_name(atlas_value, structures_reference_df)
+
+    volumes = []
+    for unique_vals, counts in (
+        (unique_vals_left, counts_left),
+        (unique_vals_right, counts_right),
+    ):
+        index = np.flatnonzero(unique_vals == atlas_value)
+        if len(index):
+            volumes.append(counts[index[0]] * voxel_volume)
+        else:
+            logging.warning(
+                "Atlas value: {} not found in registered atlas. "
+                "Setting registered volume to 0.".format(atlas_value)
+            )
+            volumes.append(0)
+    left_volume, right_volume = volumes
+
+    row = pd.DataFrame(
+        {
+            "structure_name": [name],
+            "left_volume_mm3": [left_volume],
+            "right_volume_mm3": [right_volume],
+            "total_volume_mm3": [left_volume + right_volume],
+        }
+    )
+    return pd.concat([df, row], ignore_index=True)
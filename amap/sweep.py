@@ -0,0 +1,355 @@
+"""
+sweep
+=====
+
+Compare freeform registration parameters on a single brain. Preprocessing
+and the affine registration are run once, then the freeform registration
+and segmentation are run for every combination of the parameter grid (in
+parallel), each in its own folder. The runtime and similarity of the
+registered atlas brain to the sample are saved to a comparison table.
+"""
+
+import os
+import json
+import time
+import logging
+import shutil
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+from brainio import brainio
+from fancylog import fancylog
+from imlib.general.system import ensure_directory_exists
+from imlib.general.numerical import check_positive_int
+from imlib.image.metadata import define_pixel_sizes
+
+from amap.batch import get_thread_budget
+from amap.cli import (
+    register_cli_parser,
+    prep_registration,
+    make_paths_absolute,
+    get_registration_options,
+)
+from amap.main import main as register
+from amap.register.brain_registration import BrainRegistration
+from amap.register.registration_params import RegistrationParams
+from amap.register.similarity import (
+    normalised_mutual_information,
+    correlation_coefficient,
+)
+from amap.utils.paths import Paths
+from amap.utils.resources import ResourceMonitor
+import amap as program_for_log
+
+# The parameters that can be swept (those of the stages after the affine
+# registration)
+SWEEP_PARAMETERS = (
+    "freeform_n_steps",
+    "freeform_use_n_steps",
+    "bending_energy_weight",
+    "grid_spacing",
+    "smoothing_sigma_reference",
+    "smoothing_sigma_floating",
+    "histogram_n_bins_floating",
+    "histogram_n_bins_reference",
+)
+
+# The outputs of preprocessing and the affine registration used by the
+# later stages
+SHARED_PATHS = (
+    "brain_filtered",
+    "annotations",
+    "hemispheres",
+    "tmp__downsampled_filtered",
+    "affine_matrix_path",
+)
+
+SWEEP_FOLDER_NAME = "sweep"
+RESULTS_FILE_NAME = "sweep_results.csv"
+
+
+class SweepError(Exception):
+    pass
+
+
+def sweep_parse(parser):
+    sweep_parser = parser.add_argument_group("amap parameter sweep options")
+    sweep_parser.add_argument(
+        "--grid",
+        dest="grid",
+        type=str,
+        required=True,
+        help="YAML or JSON file of the parameter grid, mapping each "
+        "parameter to a list of values to try, e.g. "
+        "{'bending_energy_weight': [0.5, 0.95], 'grid_spacing': [-10, -5]}. "
+        f"The parameters that can be swept are: {SWEEP_PARAMETERS}",
+    )
+    sweep_parser.add_argument(
+        "--concurrent-jobs",
+        dest="concurrent_jobs",
+        type=check_positive_int,
+        default=2,
+        help="How many parameter combinations to register at the same time.",
+    )
+    sweep_parser.add_argument(
+        "--threads-per-job",
+        dest="threads_per_job",
+        type=check_positive_int,
+        default=None,
+        help="How many threads each registration may use. Defaults to "
+        "sharing the available CPU cores between the concurrent jobs.",
+    )
+    return parser
+
+
+def load_grid(grid_path):
+    """
+    Load a parameter grid, and expand it into every combination of values.
+
+    :param grid_path: YAML or JSON file, mapping parameters to lists of
+        values (a single value is also accepted)
+    :return: List of dicts of {parameter: value}
+    :rtype: list
+    :raises SweepError: If a parameter cannot be swept
+    """
+    grid_path = str(grid_path)
+    with open(grid_path, "r") as grid_file:
+        if grid_path.endswith((".yaml", ".yml")):
+            import yaml
+
+            grid = yaml.safe_load(grid_file)
+        else:
+            grid = json.load(grid_file)
+
+    for parameter in grid:
+        if parameter not in SWEEP_PARAMETERS:
+            raise SweepError(
+                f"Parameter: {parameter} cannot be swept. Only "
+                f"{SWEEP_PARAMETERS} can be."
+            )
+    parameters = list(grid)
+    values = [
+        (
+            grid[parameter]
+            if isinstance(grid[parameter], (list, tuple))
+            else [grid[parameter]]
+        )
+        for parameter in parameters
+    ]
+    return [
+        dict(zip(parameters, combination))
+        for combination in itertools.product(*values)
+    ]
+
+
+def prepare_combination_folder(base_paths, output_folder):
+    """
+    Make the folder of a parameter combination, copying the outputs of the
+    shared stages into it. They are copied rather than linked, as a later
+    run in the same output folder rewrites them in place, which would
+    change the inputs of this combination.
+
+    :param base_paths: The Paths of the shared stages
+    :param output_folder: The folder of the combination
+    :return: The Paths of the combination
+    """
+    ensure_directory_exists(output_folder)
+    paths = Paths(output_folder)
+    for name in SHARED_PATHS:
+        shutil.copyfile(getattr(base_paths, name), getattr(paths, name))
+    return paths
+
+
+def register_combination(
+    registration_config,
+    base_paths,
+    output_folder,
+    registration_parameters,
+    n_threads,
+):
+    """
+    Run the freeform registration and segmentation for one combination of
+    parameters, and measure how well the registered atlas brain matches the
+    sample.
+
+    :param registration_config: The amap config file
+    :param base_paths: The Paths of the shared stages
+    :param output_folder: The folder of the combination
+    :param dict registration_parameters: The RegistrationParams arguments
+    :param int n_threads: The number of threads for NiftyReg
+    :return: dict of the times taken (s), peak memory (MB) and similarity
+        metrics
+    :rtype: dict
+    """
+    paths = prepare_combination_folder(base_paths, output_folder)
+    resource_monitor = ResourceMonitor()
+    brain_reg = BrainRegistration(
+        registration_config,
+        paths,
+        RegistrationParams(registration_config, **registration_parameters),
+        n_processes=n_threads,
+        resource_monitor=resource_monitor,
+    )
+
+    results = {}
+    for name, function in (
+        ("freeform", brain_reg.register_freeform),
+        ("segment", brain_reg.segment),
+        ("hemispheres", brain_reg.register_hemispheres),
+    ):
+        start_time = time.perf_counter()
+        function()
+        results[f"{name}_time_s"] = time.perf_counter() - start_time
+    resource_monitor.save_csv(paths.resource_usage_csv_path)
+    results["peak_rss_mb"] = max(
+        (record.get("peak_rss_mb") or 0) for record in resource_monitor.records
+    )
+
+    registered_brain = brainio.load_nii(
+        str(paths.tmp__freeform_registered_atlas_brain_path), as_array=True
+    )
+    sample = brainio.load_nii(
+        str(paths.tmp__downsampled_filtered), as_array=True
+    )
+    mask = sample > 0
+    results["nmi"] = normalised_mutual_information(
+        registered_brain, sample, mask=mask
+    )
+    results["correlation"] = correlation_coefficient(
+        registered_brain, sample, mask=mask
+    )
+    return results
+
+
+def run_sweep(
+    registration_config,
+    registration_output_folder,
+    combinations,
+    base_parameters,
+    concurrent_jobs=2,
+    threads_per_job=None,
+    n_free_cpus=2,
+):
+    """
+    Run the freeform registration and segmentation for every combination
+    of parameters, using the shared preprocessing and affine registration in
+    the registration output folder.
+
+    :param registration_config: The amap config file
+    :param registration_output_folder: The folder of the shared stages
+    :param list combinations: dicts of the swept parameters
+    :param dict base_parameters: The RegistrationParams arguments used for
+        any parameter that is not swept
+    :param int concurrent_jobs: How many combinations to register at once
+    :param int threads_per_job: How many threads each registration may use
+    :param int n_free_cpus: How many CPU cores to leave free
+    :return: The comparison table, one row per combination
+    :rtype: pd.DataFrame
+    """
+    n_threads = get_thread_budget(
+        concurrent_jobs,
+        threads_per_job=threads_per_job,
+        n_free_cpus=n_free_cpus,
+    )
+    logging.info(
+        f"Registering {len(combinations)} parameter combinations, "
+        f"{concurrent_jobs} at a time with {n_threads} threads each"
+    )
+    base_paths = Paths(registration_output_folder)
+
+    def register_row(idx_combination):
+        idx, combination = idx_combination
+        name = f"combination_{idx:03d}"
+        output_folder = os.path.join(
+            registration_output_folder, SWEEP_FOLDER_NAME, name
+        )
+        row = {"combination": name, **combination}
+        start_time = time.perf_counter()
+        try:
+            row.update(
+                register_combination(
+                    registration_config,
+                    base_paths,
+                    output_folder,
+                    {**base_parameters, **combination},
+                    n_threads,
+                )
+            )
+            row["error"] = ""
+            logging.info(f"Finished: {name} ({combination})")
+        except Exception as err:
+            logging.error(f"Failed: {name} ({combination}); {err}")
+            row["error"] = f"{type(err).__name__}: {err}"
+        row["total_time_s"] = time.perf_counter() - start_time
+        return row
+
+    with ThreadPoolExecutor(max_workers=concurrent_jobs) as executor:
+        rows = list(executor.map(register_row, enumerate(combinations)))
+    return pd.DataFrame(rows)
+
+
+def main():
+    start_time = datetime.now()
+    parser = sweep_parse(register_cli_parser())
+    args = parser.parse_args()
+    args = define_pixel_sizes(args)
+
+    args, _ = prep_registration(args)
+    args = make_paths_absolute(args)
+    combinations = load_grid(args.grid)
+
+    fancylog.start_logging(
+        args.registration_output_folder,
+        program_for_log,
+        variables=[args],
+        verbose=args.debug,
+        log_header="AMAP SWEEP LOG",
+        multiprocessing_aware=False,
+    )
+
+    logging.info("Preprocessing and affine registration")
+    registration_options = get_registration_options(args)
+    register(
+        args.registration_config,
+        args.image_paths,
+        args.registration_output_folder,
+        x_pixel_um=args.x_pixel_um,
+        y_pixel_um=args.y_pixel_um,
+        z_pixel_um=args.z_pixel_um,
+        orientation=args.orientation,
+        flip_x=args.flip_x,
+        flip_y=args.flip_y,
+        flip_z=args.flip_z,
+        stages=["preprocess", "affine"],
+        **registration_options,
+    )
+
+    base_parameters = {
+        parameter: registration_options[parameter]
+        for parameter in ("affine_n_steps", "affine_use_n_steps")
+        + SWEEP_PARAMETERS
+    }
+    results = run_sweep(
+        args.registration_config,
+        args.registration_output_folder,
+        combinations,
+        base_parameters,
+        concurrent_jobs=args.concurrent_jobs,
+        threads_per_job=args.threads_per_job,
+        n_free_cpus=args.n_free_cpus,
+    )
+    results_path = os.path.join(
+        args.registration_output_folder, RESULTS_FILE_NAME
+    )
+    results.to_csv(results_path, index=False)
+    logging.info(f"Parameter sweep results:\n{results.to_string(index=False)}")
+    logging.info(
+        f"Finished. Results saved to: {results_path}. "
+        f"Total time taken: {datetime.now() - start_time}"
+    )
+
+
+if __name__ == "__main__":
+    main()
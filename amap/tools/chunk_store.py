@@ -0,0 +1,309 @@
+"""
+chunk_store
+===========
+
+A chunked, compressed on-disk array (in the style of N5/Zarr), for raw data
+that would otherwise be read as thousands of tiff planes. The store is a
+directory holding a metadata sidecar (store.json) and one zlib compressed
+file per chunk (chunks/<z>.<y>.<x>), so that any sub-block can be read by
+decompressing only the chunks it overlaps. Edge chunks are stored at their
+truncated size, and chunks that were never written read as zeros.
+"""
+
+import os
+import json
+import zlib
+import itertools
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from imlib.general.system import ensure_directory_exists
+
+METADATA_NAME = "store.json"
+CHUNKS_FOLDER_NAME = "chunks"
+STORE_FORMAT = "amap_chunk_store"
+STORE_VERSION = 1
+
+
+class ChunkStoreError(Exception):
+    pass
+
+
+def is_chunk_store(path):
+    """
+    Check whether a path is a chunk store.
+
+    :param path: The path
+    :return: True if the path is a chunk store
+    :rtype: bool
+    """
+    return Path(path, METADATA_NAME).is_file()
+
+
+class ChunkStore:
+    """
+    A chunked, compressed array stored in a directory. It can be indexed
+    with integers and slices (e.g. store[10:20, :, 100:200]) like a numpy
+    array, and converted to a dask array with to_dask.
+
+    :param path: The directory of the store
+    :param int n_threads: How many chunks to read (or write) at once
+    """
+
+    def __init__(self, path, n_threads=1):
+        self.path = Path(path)
+        self.n_threads = n_threads
+        try:
+            with open(self.path / METADATA_NAME, "r") as metadata_file:
+                metadata = json.load(metadata_file)
+        except IOError:
+            raise ChunkStoreError(f"No chunk store found at: {self.path}")
+        if metadata.get("format") != STORE_FORMAT:
+            raise ChunkStoreError(f"{self.path} is not an amap chunk store")
+
+        self.shape = tuple(metadata["shape"])
+        self.dtype = np.dtype(metadata["dtype"])
+        self.chunks = tuple(metadata["chunks"])
+        self.compression_level = metadata["compression_level"]
+        self.metadata = metadata.get("attributes", {})
+
+    @classmethod
+    def create(
+        cls,
+        path,
+        shape,
+        dtype,
+        chunks,
+        compression_level=1,
+        attributes=None,
+        n_threads=1,
+    ):
+        """
+        Create an empty chunk store.
+
+        :param path: The directory of the store (created if needed)
+        :param tuple shape: The shape of the array
+        :param dtype: The type of the array
+        :param tuple chunks: The shape of each chunk
+        :param int compression_level: The zlib compression level (0-9)
+        :param dict attributes: Any other (json serialisable) metadata to
+            save with the array, e.g. the source of the data
+        :param int n_threads: How many chunks to read (or write) at once
+        :return: The store
+        :rtype: ChunkStore
+        """
+        if len(chunks) != len(shape):
+            raise ChunkStoreError(
+                f"Chunks: {chunks} do not match the shape: {shape}"
+            )
+        ensure_directory_exists(str(Path(path, CHUNKS_FOLDER_NAME)))
+        metadata = {
+            "format": STORE_FORMAT,
+            "version": STORE_VERSION,
+            "shape": [int(size) for size in shape],
+            "dtype": np.dtype(dtype).str,
+            "chunks": [
+                int(min(chunk, size)) for chunk, size in zip(chunks, shape)
+            ],
+            "compression": "zlib",
+            "compression_level": compression_level,
+            "attributes": attributes or {},
+        }
+        with open(Path(path, METADATA_NAME), "w") as metadata_file:
+            json.dump(metadata, metadata_file, indent=4)
+        return cls(path, n_threads=n_threads)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def get_chunk_path(self, chunk_index):
+        name = ".".join(str(idx) for idx in chunk_index)
+        return self.path / CHUNKS_FOLDER_NAME / name
+
+    def get_chunk_shape(self, chunk_index):
+        return tuple(
+            min(chunk, size - idx * chunk)
+            for idx, chunk, size in zip(chunk_index, self.chunks, self.shape)
+        )
+
+    def read_chunk(self, chunk_index):
+        """
+        Read (and decompress) a single chunk.
+
+        :param tuple chunk_index: The index of the chunk along each axis
+        :return: The chunk (zeros if it was never written)
+        :rtype: np.array
+        """
+        chunk_shape = self.get_chunk_shape(chunk_index)
+        try:
+            with open(self.get_chunk_path(chunk_index), "rb") as chunk_file:
+                data = zlib.decompress(chunk_file.read())
+        except FileNotFoundError:
+            return np.zeros(chunk_shape, dtype=self.dtype)
+        return np.frombuffer(data, dtype=self.dtype).reshape(chunk_shape)
+
+    def write_chunk(self, chunk_index, chunk):
+        """
+        Compress and write a single chunk.
+
+        :param tuple chunk_index: The index of the chunk along each axis
+        :param np.array chunk: The chunk
+        """
+        chunk_shape = self.get_chunk_shape(chunk_index)
+        if chunk.shape != chunk_shape:
+            raise ChunkStoreError(
+                f"Chunk: {chunk_index} should have shape: {chunk_shape}, "
+                f"not: {chunk.shape}"
+            )
+        data = np.ascontiguousarray(chunk, dtype=self.dtype).tobytes()
+        chunk_path = self.get_chunk_path(chunk_index)
+        tmp_path = f"{chunk_path}.tmp"
+        with open(tmp_path, "wb") as chunk_file:
+            chunk_file.write(zlib.compress(data, self.compression_level))
+        os.replace(tmp_path, chunk_path)
+
+    def write_slab(self, start, slab):
+        """
+        Write whole chunks along the first axis, i.e. a slab of planes
+        starting at a chunk boundary, and spanning all of the other axes.
+
+        :param int start: The first plane of the slab
+        :param np.array slab: The planes
+        """
+        if start % self.chunks[0] or slab.shape[1:] != self.shape[1:]:
+            raise ChunkStoreError(
+                "Slabs must start at a chunk boundary, and span all of the "
+                "other axes"
+            )
+        first_chunk = start // self.chunks[0]
+        n_chunks = -(-slab.shape[0] // self.chunks[0])
+        chunk_indices = list(
+            itertools.product(
+                range(first_chunk, first_chunk + n_chunks),
+                *[
+                    range(-(-size // chunk))
+                    for size, chunk in zip(self.shape[1:], self.chunks[1:])
+                ],
+            )
+        )
+
+        def write(chunk_index):
+            # the position of the chunk in the slab
+            slab_index = (chunk_index[0] - first_chunk,) + chunk_index[1:]
+            region = tuple(
+                slice(idx * chunk, (idx + 1) * chunk)
+                for idx, chunk in zip(slab_index, self.chunks)
+            )
+            self.write_chunk(chunk_index, slab[region])
+
+        self._map(write, chunk_indices)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(idx is Ellipsis for idx in key):
+            ellipsis = key.index(Ellipsis)
+            key = (
+                key[:ellipsis]
+                + (slice(None),) * (self.ndim - len(key) + 1)
+                + key[ellipsis + 1 :]
+            )
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        bounds = []
+        steps = []
+        squeeze = []
+        for axis, (idx, size) in enumerate(zip(key, self.shape)):
+            if isinstance(idx, slice):
+                start, stop, step = idx.indices(size)
+                if step < 0:
+                    raise IndexError("Negative steps are not supported")
+                bounds.append((start, max(start, stop)))
+                steps.append(slice(None, None, step))
+            else:
+                idx = int(idx)
+                if idx < 0:
+                    idx += size
+                if not 0 <= idx < size:
+                    raise IndexError(
+                        f"Index {idx} is out of bounds for axis {axis} with "
+                        f"size {size}"
+                    )
+                bounds.append((idx, idx + 1))
+                steps.append(slice(None))
+                squeeze.append(axis)
+
+        block = self.read_block(bounds)
+        return np.squeeze(block[tuple(steps)], axis=tuple(squeeze))
+
+    def read_block(self, bounds):
+        """
+        Read a block of the array, decompressing only the chunks it overlaps.
+
+        :param list bounds: The (start, stop) of the block along each axis
+        :return: The block
+        :rtype: np.array
+        """
+        block = np.empty([stop - start for start, stop in bounds], self.dtype)
+        if not block.size:
+            return block
+        chunk_ranges = [
+            range(start // chunk, -(-stop // chunk))
+            for (start, stop), chunk in zip(bounds, self.chunks)
+        ]
+
+        def read(chunk_index):
+            chunk = self.read_chunk(chunk_index)
+            chunk_region = []
+            block_region = []
+            for idx, chunk_size, (start, stop) in zip(
+                chunk_index, self.chunks, bounds
+            ):
+                chunk_start = idx * chunk_size
+                overlap_start = max(start, chunk_start)
+                overlap_stop = min(stop, chunk_start + chunk_size)
+                chunk_region.append(
+                    slice(
+                        overlap_start - chunk_start, overlap_stop - chunk_start
+                    )
+                )
+                block_region.append(
+                    slice(overlap_start - start, overlap_stop - start)
+                )
+            block[tuple(block_region)] = chunk[tuple(chunk_region)]
+
+        self._map(read, list(itertools.product(*chunk_ranges)))
+        return block
+
+    def to_dask(self):
+        """
+        Get a lazy (dask) array of the store, with one dask chunk per chunk
+        of the store.
+
+        :return: The lazy array
+        :rtype: dask.array.Array
+        """
+        import dask.array as da
+
+        return da.from_array(
+            ChunkStore(self.path, n_threads=1),
+            chunks=self.chunks,
+            asarray=True,
+            fancy=False,
+        )
+
+    def _map(self, function, chunk_indices):
+        if self.n_threads > 1 and len(chunk_indices) > 1:
+            # zlib releases the GIL
+            with ThreadPoolExecutor(max_workers=self.n_threads) as pool:
+                list(pool.map(function, chunk_indices))
+        else:
+            for chunk_index in chunk_indices:
+                function(chunk_index)
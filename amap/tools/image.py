@@ -6,8 +6,10 @@ Image processing functions
 
 """
 
+import numpy as np
+
 from skimage import morphology
-from scipy.ndimage import gaussian_filter
+from scipy.ndimage import gaussian_filter, grey_opening
 
 
 def despeckle_by_opening(img_plane, radius=2):  # WARNING: inplace operation
@@ -35,6 +37,77 @@ def pseudo_flatfield(img_plane, sigma=5):
     :return: The pseudo flat field filtered image
     :rtype: np.array
     """
-    img_plane = img_plane.copy()  # OPTIMISE: check if necessary
     filtered_img = gaussian_filter(img_plane, sigma)
     return img_plane / (filtered_img + 1)
+
+
+def pseudo_flatfield_in_place(img_plane, buffer, sigma=5):
+    """
+    Pseudo flat field filter, as pseudo_flatfield, but writing the result
+    into the input plane and using a preallocated buffer for the gaussian
+    filtered copy, so that no new arrays are allocated.
+
+    :param np.array img_plane: The (floating point) image to filter.
+        Will be overwritten.
+    :param np.array buffer: Array of the same shape and type as img_plane
+        to store the gaussian filtered image in
+    :param int sigma: The sigma of the gaussian filter applied to the
+        image used for de-trending
+    :return: The pseudo flat field filtered image
+    :rtype: np.array
+    """
+    gaussian_filter(img_plane, sigma, output=buffer)
+    buffer += 1
+    np.divide(img_plane, buffer, out=img_plane)
+    return img_plane
+
+
+def scale_and_convert_to_16_bits_in_place(img):
+    """
+    Normalise the input (floating point) image to the full 0-2^16 bit depth
+    and return as type: "np.uint16". Unlike
+    imlib.image.scale.scale_and_convert_to_16_bits, the normalisation is
+    done in place (the input is overwritten), so the only new array is the
+    16 bit output.
+
+    :param np.array img: The input image. Will be overwritten.
+    :return: The normalised, 16 bit image
+    :rtype: np.array
+    """
+    img /= img.max()
+    img *= 2 ** 16 - 1
+    return img.astype(np.uint16)
+
+
+def despeckle_stack_by_opening(stack, radius=2):  # WARNING: inplace operation
+    """
+    Despeckle each plane (along the last axis) of a 3D image using a
+    grayscale opening. This gives the same result as calling
+    despeckle_by_opening on every plane, but the whole stack is processed in
+    a single call with the 2D kernel broadcast along the plane axis.
+
+    :param np.array stack: 3D image, with planes along the last axis
+    :param int radius: The radius of the opening kernel
+    :return: The despeckled image
+    :rtype: np.array
+    """
+    kernel = morphology.disk(radius)[:, :, np.newaxis]
+    grey_opening(stack, footprint=kernel, output=stack)
+    return stack
+
+
+def pseudo_flatfield_stack(stack, sigma=5):
+    """
+    Pseudo flat field filter each plane (along the last axis) of a 3D image.
+    This gives the same result as calling pseudo_flatfield on every plane,
+    by using a separable gaussian filter that is not applied along the
+    plane axis.
+
+    :param np.array stack: 3D image, with planes along the last axis
+    :param int sigma: The sigma of the gaussian filter applied to the
+        image used for de-trending
+    :return: The pseudo flat field filtered image
+    :rtype: np.array
+    """
+    filtered_stack = gaussian_filter(stack, (sigma, sigma, 0))
+    return stack / (filtered_stack + 1)
@@ -0,0 +1,192 @@
+"""
+structures
+==========
+
+Constant-time lookup of the structures (name, acronym and colour) of atlas
+labels, built once from the structures csv file of the atlas, and shared by
+the volume calculation and the amap_vis hover display.
+"""
+
+import os
+import ast
+
+import numpy as np
+import pandas as pd
+
+from functools import lru_cache
+
+# Above this id, a dense (label -> position) array would be too large, so
+# arrays of labels are looked up by binary search instead
+DENSE_LOOKUP_MAX_ID = 2 ** 20
+
+
+def load_structures_as_df(structures_file_path):
+    return pd.read_csv(structures_file_path, sep=",", header=0, quotechar='"')
+
+
+def get_structure_positions(structure_ids, values):
+    """
+    Get the position of each value in an array of structure ids.
+
+    :param np.array structure_ids: The sorted, unique structure ids
+    :param np.array values: The values (e.g. atlas labels, of any
+        numerical type)
+    :return: The position of each value, or -1 if it is not a structure id
+    :rtype: np.array
+    """
+    values = np.asarray(values)
+    positions = np.searchsorted(structure_ids, values)
+    positions[positions == len(structure_ids)] = 0
+    if len(structure_ids):
+        positions[structure_ids[positions] != values] = -1
+    else:
+        positions[:] = -1
+    return positions
+
+
+class StructureLookup:
+    """
+    The structures of an atlas, indexed by id. The first structure with each
+    id is used. self.structures is the table sorted by id (keeping the index
+    of the structures file), and a "position" is a row of this table.
+
+    :param pd.DataFrame structures_df: The structures table (with at least
+        "id" and "name" columns)
+    """
+
+    def __init__(self, structures_df):
+        self.structures = structures_df.drop_duplicates("id").sort_values("id")
+        self.ids = self.structures["id"].values
+        self._positions = {
+            structure_id: position
+            for position, structure_id in enumerate(self.ids.tolist())
+        }
+        self._names = self.structures["name"].tolist()
+        self._acronyms = self._get_column("acronym")
+        self._colours = [
+            _parse_colour(colour) for colour in self._get_colour_column()
+        ]
+
+        if (
+            len(self.ids)
+            and 0 <= self.ids.min()
+            and (self.ids.max() < DENSE_LOOKUP_MAX_ID)
+        ):
+            self._dense_positions = np.full(
+                int(self.ids.max()) + 1, -1, dtype=np.int64
+            )
+            self._dense_positions[self.ids.astype(np.int64)] = np.arange(
+                len(self.ids)
+            )
+        else:
+            self._dense_positions = None
+
+    @classmethod
+    def from_file(cls, structures_file_path):
+        """
+        Load the lookup of a structures csv file. The lookup is cached (until
+        the file is modified), so it is only built once.
+
+        :param structures_file_path: The structures csv file
+        :return: The lookup
+        :rtype: StructureLookup
+        """
+        structures_file_path = os.path.abspath(str(structures_file_path))
+        return _load_structure_lookup(
+            structures_file_path, os.path.getmtime(structures_file_path)
+        )
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, value):
+        return value in self._positions
+
+    def get_position(self, value):
+        """
+        Get the position (row of self.structures) of an atlas label.
+
+        :param value: The label
+        :return: The position, or None if the label is not a structure id
+        """
+        return self._positions.get(value)
+
+    def get_positions(self, values):
+        """
+        Get the position (row of self.structures) of each of an array of
+        atlas labels.
+
+        :param np.array values: The labels (of any numerical type)
+        :return: The position of each label, or -1 if it is not a
+            structure id
+        :rtype: np.array
+        """
+        values = np.asarray(values)
+        if self._dense_positions is None:
+            return get_structure_positions(self.ids, values)
+        int_values = values.astype(np.int64)
+        valid = (
+            (int_values == values)
+            & (int_values >= 0)
+            & (int_values < len(self._dense_positions))
+        )
+        positions = np.full(values.shape, -1, dtype=np.int64)
+        positions[valid] = self._dense_positions[int_values[valid]]
+        return positions
+
+    def get_name(self, value):
+        """
+        :param value: The atlas label
+        :return: The name of the structure, or None if it is unknown
+        """
+        return self._get(self._names, value)
+
+    def get_acronym(self, value):
+        """
+        :param value: The atlas label
+        :return: The acronym of the structure, or None if it is unknown (or
+            the structures file has no acronyms)
+        """
+        return self._get(self._acronyms, value)
+
+    def get_colour(self, value):
+        """
+        :param value: The atlas label
+        :return: The (r, g, b) colour of the structure (0-255), or None if it
+            is unknown (or the structures file has no colours)
+        """
+        return self._get(self._colours, value)
+
+    def _get(self, properties, value):
+        position = self._positions.get(value)
+        if position is None:
+            return None
+        return properties[position]
+
+    def _get_column(self, column):
+        if column in self.structures:
+            return self.structures[column].tolist()
+        return [None] * len(self.structures)
+
+    def _get_colour_column(self):
+        for column in ("rgb_triplet", "color_hex_triplet"):
+            if column in self.structures:
+                return self.structures[column].tolist()
+        return [None] * len(self.structures)
+
+
+@lru_cache(maxsize=8)
+def _load_structure_lookup(structures_file_path, modification_time):
+    return StructureLookup(load_structures_as_df(structures_file_path))
+
+
+def _parse_colour(colour):
+    if not isinstance(colour, str):
+        return None
+    colour = colour.strip()
+    if colour.startswith("["):
+        # e.g. "[255, 255, 255]"
+        return tuple(int(channel) for channel in ast.literal_eval(colour))
+    # e.g. "FFFFFF"
+    colour = colour.lstrip("#")
+    return tuple(int(colour[idx : idx + 2], 16) for idx in (0, 2, 4))
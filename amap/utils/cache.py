@@ -0,0 +1,423 @@
+"""
+cache
+=====
+
+A content-addressed on-disk cache of files that depend only on a small set
+of inputs (e.g. the reoriented atlas files, which depend only on the atlas
+and the orientation of the sample). Each entry is a directory named by the
+hash of its inputs, holding the files and a manifest with their
+checksums.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+
+from pathlib import Path
+
+from imlib.general.system import ensure_directory_exists
+
+MANIFEST_NAME = "manifest.json"
+CHECKSUMS_DIRECTORY_NAME = ".checksums"
+
+# Entries used (or added) more recently than this many seconds ago are not
+# evicted, as another process may be linking their files
+EVICTION_MIN_AGE = 30
+
+
+def hash_inputs(inputs):
+    """
+    Hash a (json serialisable) description of the inputs of a cache entry
+
+    :param inputs: The inputs (e.g. a dict of parameters)
+    :return: The hex digest
+    :rtype: str
+    """
+    serialised = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(serialised.encode()).hexdigest()
+
+
+def file_checksum(file_path, block_size=2 ** 20):
+    """
+    Compute the sha256 checksum of a file, reading it in blocks.
+
+    :param file_path: The file
+    :param int block_size: How many bytes to read at once
+    :return: The hex digest
+    :rtype: str
+    """
+    checksum = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def file_signature(file_path):
+    """
+    A cheap description of a file that changes if the file is replaced or
+    modified (without reading its contents).
+
+    :param file_path: The file
+    :return: dict of the path, size and modification time
+    :rtype: dict
+    """
+    stat = os.stat(file_path)
+    return {
+        "path": os.path.abspath(file_path),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+    }
+
+
+def link_or_copy(source, destination):
+    """
+    Hard link the source file to the destination (so that no extra disk
+    space is used), or copy it if linking is not possible (e.g. the files
+    are on different filesystems). A linked destination shares its data
+    with the source, so it must be replaced (removed and written again)
+    rather than modified in place.
+
+    :param source: The file to link
+    :param destination: The path of the link
+    """
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+class FileCache:
+    """
+    A directory of cache entries. Entries are keyed by the hash of their
+    inputs, and hold a set of named files.
+
+    :param cache_directory: Where the cache is stored
+    :param int max_entries: The maximum number of entries to keep. When
+        exceeded, the least recently used entries are removed. If None,
+        entries are never removed.
+    :param bool verify: Check the checksums of the files in an entry
+        before they are used. Entries that fail are removed.
+    :param min_age: Entries used more recently than this many seconds ago
+        are not evicted (so there may briefly be more than max_entries)
+    """
+
+    def __init__(
+        self,
+        cache_directory,
+        max_entries=None,
+        verify=True,
+        min_age=EVICTION_MIN_AGE,
+    ):
+        self.cache_directory = Path(cache_directory)
+        self.max_entries = max_entries
+        self.verify = verify
+        self.min_age = min_age
+        ensure_directory_exists(str(self.cache_directory))
+
+    def get_file_checksum(self, file_path):
+        """
+        Get the checksum of a file (see file_checksum). Checksums are
+        memoised in the cache directory on the path, size, inode and
+        modification and change times of the file, so an unchanged file is
+        only read once.
+
+        :param file_path: The file
+        :return: The hex digest
+        :rtype: str
+        """
+        stat = os.stat(file_path)
+        signature = hash_inputs(
+            {
+                "path": os.path.abspath(file_path),
+                "size": stat.st_size,
+                "inode": stat.st_ino,
+                "mtime": stat.st_mtime_ns,
+                "ctime": stat.st_ctime_ns,
+            }
+        )
+        checksums_directory = self.cache_directory / CHECKSUMS_DIRECTORY_NAME
+        memo_path = checksums_directory / signature
+        try:
+            return memo_path.read_text()
+        except OSError:
+            pass
+
+        checksum = file_checksum(file_path)
+        ensure_directory_exists(str(checksums_directory))
+        file_descriptor, tmp_path = tempfile.mkstemp(
+            prefix=f".{signature}.", dir=str(checksums_directory)
+        )
+        with os.fdopen(file_descriptor, "w") as memo_file:
+            memo_file.write(checksum)
+        os.replace(tmp_path, memo_path)
+        return checksum
+
+    def get_entry_directory(self, key):
+        return self.cache_directory / key
+
+    def get_entry_paths(self, key, verify=None):
+        """
+        Get the paths of the files in a (valid) cache entry, and mark the
+        entry as used.
+
+        :param str key: The entry key
+        :param verify: Whether to check the files against their checksums.
+            If None, the cache setting is used. If a list of file names,
+            only those files are checked.
+        :return: dict of {file name: path}, or None if there is no valid
+            entry
+        :rtype: dict
+        """
+        manifest = self._load_manifest(key)
+        if manifest is None:
+            return None
+
+        if verify is None:
+            verify = self.verify
+        if isinstance(verify, bool):
+            verify = manifest["checksums"] if verify else []
+
+        entry_directory = self.get_entry_directory(key)
+        paths = {
+            name: entry_directory / name for name in manifest["checksums"]
+        }
+        for name, path in paths.items():
+            if not path.exists() or (
+                name in verify
+                and file_checksum(path) != manifest["checksums"][name]
+            ):
+                logging.warning(
+                    f"Cache entry: {entry_directory} is corrupt "
+                    f"({name} failed the integrity check), removing."
+                )
+                self.remove(key)
+                return None
+
+        # the modification time of the manifest records when it was last
+        # used, for least recently used eviction
+        os.utime(entry_directory / MANIFEST_NAME)
+        return paths
+
+    def fetch(self, key, destinations):
+        """
+        Link (or copy) the files of a cache entry to their destinations.
+
+        :param str key: The entry key
+        :param dict destinations: dict of {file name: destination path}
+        :return: True if the entry was found and the files linked
+        :rtype: bool
+        """
+        paths = self.get_entry_paths(key)
+        if paths is None or not set(destinations).issubset(paths):
+            return False
+        for name, destination in destinations.items():
+            link_or_copy(paths[name], destination)
+        logging.info(
+            f"Using cached files from: {self.get_entry_directory(key)}"
+        )
+        return True
+
+    def store(self, key, sources, inputs=None):
+        """
+        Add files to the cache as a new entry. The entry is written to a
+        temporary directory and then moved into place, so a partially
+        written entry is never used.
+
+        :param str key: The entry key
+        :param dict sources: dict of {file name: path of file to cache}
+        :param inputs: Optional (json serialisable) description of the
+            inputs, stored in the manifest for reference
+        """
+        entry_directory = self.get_entry_directory(key)
+        if entry_directory.exists():
+            return
+
+        tmp_directory = Path(
+            tempfile.mkdtemp(prefix=f".{key}.", dir=str(self.cache_directory))
+        )
+        checksums = {}
+        for name, source in sources.items():
+            link_or_copy(source, tmp_directory / name)
+            checksums[name] = file_checksum(tmp_directory / name)
+
+        manifest = {
+            "inputs": inputs,
+            "checksums": checksums,
+            "created": time.time(),
+        }
+        with open(tmp_directory / MANIFEST_NAME, "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=4, default=str)
+
+        try:
+            os.rename(tmp_directory, entry_directory)
+            logging.info(f"Added cache entry: {entry_directory}")
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+        self.evict()
+
+    def remove(self, key):
+        shutil.rmtree(self.get_entry_directory(key), ignore_errors=True)
+
+    def get_keys(self):
+        """
+        Get the keys of all the entries in the cache, the least recently
+        used first.
+
+        :return: List of keys
+        :rtype: list
+        """
+        manifests = [
+            manifest
+            for manifest in self.cache_directory.glob(f"*/{MANIFEST_NAME}")
+            if not manifest.parent.name.startswith(".")
+        ]
+        manifests.sort(key=lambda manifest: manifest.stat().st_mtime)
+        return [manifest.parent.name for manifest in manifests]
+
+    def evict(self):
+        """
+        Remove the least recently used entries, until there are at most
+        max_entries entries. Entries used in the last min_age seconds are
+        kept.
+        """
+        if self.max_entries is None:
+            return
+        keys = self.get_keys()
+        for key in keys[: max(0, len(keys) - self.max_entries)]:
+            manifest_path = self.get_entry_directory(key) / MANIFEST_NAME
+            try:
+                age = time.time() - manifest_path.stat().st_mtime
+            except OSError:
+                # already removed
+                continue
+            if age < self.min_age:
+                # the remaining entries were used even more recently
+                break
+            logging.info(f"Removing cache entry: {key}")
+            self.remove(key)
+
+    def _load_manifest(self, key):
+        manifest_path = self.get_entry_directory(key) / MANIFEST_NAME
+        if not manifest_path.exists():
+            return None
+        try:
+            with open(manifest_path, "r") as manifest_file:
+                return json.load(manifest_file)
+        except ValueError:
+            logging.warning(f"Could not read cache manifest: {manifest_path}")
+            self.remove(key)
+            return None
+
+
+class AtlasCache(FileCache):
+    """
+    A cache of the reoriented atlas files (atlas, brain and hemispheres),
+    which depend only on the atlas (and its resolution), the orientation of
+    the sample, and any additional flips. The atlas is identified by the
+    checksums of its files, so a copied or touched atlas uses the same
+    entry. The cached (filtered) atlas brain
+    can be used directly as the registration template.
+    """
+
+    elements = ("atlas_name", "brain_name", "hemispheres_name")
+
+    def get_inputs(self, atlas, orientation, flips, header_only=False):
+        """
+        Get the description of everything the reoriented atlas files
+        depend on.
+
+        :param atlas: The (not yet reoriented) amap.config.atlas.Atlas
+        :param str orientation: The orientation of the sample
+        :param list flips: The sequence of flips applied to the atlas
+        :param bool header_only: Whether the reorientation is stored in the
+            header only
+        :return: dict of inputs
+        :rtype: dict
+        """
+        return {
+            "files": {
+                element: self.get_file_checksum(
+                    atlas.get_atlas_element_path(element)
+                )
+                for element in self.elements
+            },
+            "pixel_sizes": atlas.get_pixel_sizes_from_config(),
+            "orientation": orientation,
+            "flips": [list(flip) for flip in flips],
+            "header_only": header_only,
+        }
+
+    def get_key(self, atlas, orientation, flips, header_only=False):
+        return hash_inputs(
+            self.get_inputs(atlas, orientation, flips, header_only)
+        )
+
+    def get_destinations(self, atlas):
+        return {
+            atlas.atlas_conf[element]: atlas.get_dest_path(element)
+            for element in self.elements
+        }
+
+    def fetch_atlas(self, atlas, orientation, flips, header_only=False):
+        """
+        Link (or copy) the cached, reoriented atlas files to the atlas
+        destination folder, if they are cached. The atlas images do not need
+        to be loaded.
+
+        :param atlas: The amap.config.atlas.Atlas
+        :param str orientation: The orientation of the sample
+        :param list flips: The sequence of flips applied to the atlas
+        :param bool header_only: Whether the reorientation is stored in the
+            header only
+        :return: True if the files were cached
+        :rtype: bool
+        """
+        key = self.get_key(atlas, orientation, flips, header_only)
+        return self.fetch(key, self.get_destinations(atlas))
+
+    def save_all(self, atlas, orientation, flips, header_only=False):
+        """
+        Save the reoriented atlas files to the atlas destination folder,
+        from the cache if possible. Otherwise they are generated
+        (Atlas.save_all) and added to the cache.
+
+        :param atlas: The reoriented amap.config.atlas.Atlas
+        :param str orientation: The orientation of the sample
+        :param list flips: The sequence of flips applied to the atlas
+        :param bool header_only: Store the reorientation in the header only
+        """
+        inputs = self.get_inputs(atlas, orientation, flips, header_only)
+        key = hash_inputs(inputs)
+        destinations = self.get_destinations(atlas)
+        if not self.fetch(key, destinations):
+            atlas.save_all(header_only=header_only)
+            self.store(key, destinations, inputs=inputs)
+
+    def get_template_path(self, atlas, orientation, flips, header_only=False):
+        """
+        Get the path of the cached, reoriented atlas brain, to be used as the
+        floating image for registration. The file is always checked against
+        its checksum, regardless of the cache setting.
+
+        :param atlas: The amap.config.atlas.Atlas
+        :param str orientation: The orientation of the sample
+        :param list flips: The sequence of flips applied to the atlas
+        :param bool header_only: Whether the reorientation is stored in the
+            header only
+        :return: The path of the cached template, or None if it is not
+            cached (or failed the integrity check)
+        """
+        key = self.get_key(atlas, orientation, flips, header_only)
+        template_name = atlas.atlas_conf["brain_name"]
+        paths = self.get_entry_paths(key, verify=[template_name])
+        if paths is None or template_name not in paths:
+            return None
+        return paths[template_name]
@@ -0,0 +1,302 @@
+"""
+manifest
+========
+
+Records what each stage of amap was run with, so that a stage is only run
+again if something it depends on has changed. For each stage, the manifest
+stores a fingerprint of its parameters, the programs it runs, its input
+files, and the stages it depends on, together with checksums of the files
+it produced.
+
+A stage is up to date if its fingerprint is unchanged, the stages it
+depends on are up to date, and its outputs are intact (a stage that failed
+part way through is never recorded).
+"""
+
+import os
+import json
+import logging
+import threading
+
+from amap.utils.cache import file_checksum, file_signature, hash_inputs
+
+
+class ManifestError(Exception):
+    pass
+
+
+class ManifestStage:
+    """
+    The definition of a stage.
+
+    :param str name: The name of the stage
+    :param dependencies: The names of the stages whose outputs this stage
+        uses
+    :param inputs: Files read by the stage (either outputs of its
+        dependencies, or other files that are checksummed)
+    :param raw_inputs: Files or directories read by the stage that are too
+        large to checksum. Only their size and modification times are
+        compared.
+    :param outputs: Files written by the stage
+    :param temporary_outputs: Files written by the stage that may later be
+        deleted. If a later stage that reads them needs to be run, this stage
+        is run again to recreate them.
+    :param dict parameters: The parameters of the stage
+    :param programs: Paths of the programs the stage runs
+    """
+
+    def __init__(
+        self,
+        name,
+        dependencies=(),
+        inputs=(),
+        raw_inputs=(),
+        outputs=(),
+        temporary_outputs=(),
+        parameters=None,
+        programs=(),
+    ):
+        self.name = name
+        self.dependencies = tuple(dependencies)
+        self.inputs = [str(path) for path in inputs]
+        self.raw_inputs = [str(path) for path in raw_inputs]
+        self.outputs = [str(path) for path in outputs]
+        self.temporary_outputs = [str(path) for path in temporary_outputs]
+        self.parameters = parameters or {}
+        self.programs = [str(path) for path in programs]
+
+
+def raw_signature(path):
+    """
+    Describe a (possibly very large) file or directory by the sizes and
+    modification times of its files.
+
+    :param path: The file or directory
+    :return: The signature (or None if it does not exist)
+    """
+    if os.path.isdir(path):
+        return [
+            file_signature(os.path.join(path, file_name))
+            for file_name in sorted(os.listdir(path))
+            if os.path.isfile(os.path.join(path, file_name))
+        ]
+    elif os.path.isfile(path):
+        signature = file_signature(path)
+        if path.endswith(".txt"):
+            # a text file listing the planes
+            with open(path, "r") as in_file:
+                signature["contents"] = [
+                    file_signature(line.strip())
+                    for line in in_file
+                    if os.path.isfile(line.strip())
+                ]
+        return signature
+    else:
+        return None
+
+
+class RunManifest:
+    """
+    The manifest of the stages of a single amap run, stored as a JSON file
+    in the output directory.
+
+    :param manifest_path: The path of the manifest file
+    """
+
+    def __init__(self, manifest_path):
+        self.manifest_path = str(manifest_path)
+        self.stages = {}
+        self._required_temporary_outputs = set()
+        self._plan = None
+        self._lock = threading.Lock()
+        self._records = self._load()
+
+    def define_stage(self, name, **kwargs):
+        """
+        Define a stage (see ManifestStage). Stages must be defined after the
+        stages they depend on.
+
+        :raises ManifestError: If the stage depends on an undefined stage
+        """
+        stage = ManifestStage(name, **kwargs)
+        for dependency in stage.dependencies:
+            if dependency not in self.stages:
+                raise ManifestError(
+                    f"Stage: {name} depends on undefined stage: {dependency}"
+                )
+        self.stages[name] = stage
+        self._plan = None
+
+    def require_temporary_outputs(self, names):
+        """
+        Require the temporary outputs of some stages to exist once they have
+        run (e.g. because they are shared with later runs), so that a stage
+        is run again if its temporary outputs have since been deleted.
+
+        :param names: The stages
+        """
+        self._required_temporary_outputs = set(names)
+        self._plan = None
+
+    def needs_run(self, name):
+        """
+        Whether a stage needs to be run.
+
+        :param str name: The stage
+        :return: False if the stage is up to date
+        :rtype: bool
+        """
+        if self._plan is None:
+            self._plan = self._make_plan()
+        return self._plan[name]
+
+    def record(self, name):
+        """
+        Record that a stage has finished successfully, with the checksums of
+        its outputs and its current fingerprint.
+
+        :param str name: The stage
+        """
+        stage = self.stages[name]
+        outputs = {
+            path: self._file_record(path)
+            for path in stage.outputs + stage.temporary_outputs
+            if os.path.isfile(path)
+        }
+        with self._lock:
+            self._records[name] = {
+                "fingerprint": self._fingerprint(stage),
+                "outputs": outputs,
+            }
+            self._save()
+
+    def _make_plan(self):
+        plan = {}
+        reasons = {}
+        for name, stage in self.stages.items():
+            record = self._records.get(name)
+            if record is None:
+                reasons[name] = "not run yet"
+            elif any(plan[dependency] for dependency in stage.dependencies):
+                reasons[name] = "an earlier stage will be run"
+            elif record["fingerprint"] != self._fingerprint(stage):
+                reasons[name] = "inputs or parameters have changed"
+            elif not self._outputs_intact(stage, record):
+                reasons[name] = "outputs are missing or have changed"
+            elif name in self._required_temporary_outputs and not all(
+                os.path.isfile(path) for path in stage.temporary_outputs
+            ):
+                reasons[name] = "temporary outputs are required"
+            plan[name] = name in reasons
+
+        # stages that need to be run may need the temporary outputs of
+        # earlier stages to be recreated
+        for name in reversed(list(self.stages)):
+            if not plan[name]:
+                continue
+            stage = self.stages[name]
+            for dependency in stage.dependencies:
+                needed = set(stage.inputs).intersection(
+                    self.stages[dependency].temporary_outputs
+                )
+                if not plan[dependency] and not all(
+                    os.path.isfile(path) for path in needed
+                ):
+                    plan[dependency] = True
+                    reasons[dependency] = (
+                        f"temporary outputs are needed by: {name}"
+                    )
+
+        for name, needs_run in plan.items():
+            if needs_run:
+                logging.debug(f"Stage: {name} will be run ({reasons[name]})")
+        return plan
+
+    def _fingerprint(self, stage):
+        produced = {}
+        dependencies = {}
+        for dependency in stage.dependencies:
+            record = self._records.get(dependency, {})
+            dependencies[dependency] = record.get("fingerprint")
+            for path, file_record in record.get("outputs", {}).items():
+                produced[path] = file_record["sha256"]
+
+        inputs = {}
+        for path in stage.inputs:
+            if path in produced:
+                inputs[path] = produced[path]
+            elif os.path.isfile(path):
+                inputs[path] = self._file_checksum(path)
+            else:
+                inputs[path] = None
+
+        return hash_inputs(
+            {
+                "parameters": stage.parameters,
+                "programs": {
+                    path: (
+                        self._file_checksum(path)
+                        if os.path.isfile(path)
+                        else None
+                    )
+                    for path in stage.programs
+                },
+                "inputs": inputs,
+                "raw_inputs": {
+                    path: raw_signature(path) for path in stage.raw_inputs
+                },
+                "dependencies": dependencies,
+            }
+        )
+
+    def _outputs_intact(self, stage, record):
+        for path in stage.outputs:
+            file_record = record["outputs"].get(path)
+            if file_record is None or not os.path.isfile(path):
+                return False
+            signature = file_signature(path)
+            if (signature["size"], signature["mtime"]) != (
+                file_record["size"],
+                file_record["mtime"],
+            ) and file_checksum(path) != file_record["sha256"]:
+                return False
+        return True
+
+    def _file_record(self, path):
+        signature = file_signature(path)
+        return {
+            "size": signature["size"],
+            "mtime": signature["mtime"],
+            "sha256": self._file_checksum(path),
+        }
+
+    def _file_checksum(self, path):
+        # reuse the checksum of any recorded output that is unchanged
+        signature = file_signature(path)
+        for record in self._records.values():
+            file_record = record.get("outputs", {}).get(path)
+            if file_record is not None and (
+                file_record["size"],
+                file_record["mtime"],
+            ) == (signature["size"], signature["mtime"]):
+                return file_record["sha256"]
+        return file_checksum(path)
+
+    def _load(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        try:
+            with open(self.manifest_path, "r") as manifest_file:
+                return json.load(manifest_file)
+        except ValueError:
+            logging.warning(
+                f"Could not read the run manifest: {self.manifest_path}. "
+                f"All stages will be run."
+            )
+            return {}
+
+    def _save(self):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as manifest_file:
+            json.dump(self._records, manifest_file, indent=4, default=str)
+        os.replace(tmp_path, self.manifest_path)
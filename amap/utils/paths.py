@@ -23,11 +23,24 @@ class Paths:
         self.tmp__downsampled_filtered = self.make_reg_path(
             "downsampled_filtered.nii"
         )
+        self.tmp__downsampled_memmap = self.make_reg_path("downsampled.npy")
+        self.tmp__boundaries_memmap = self.make_reg_path(
+            "boundaries_memmap.npy"
+        )
         self.registered_atlas_path = self.make_reg_path("registered_atlas.nii")
         self.hemispheres_atlas_path = self.make_reg_path(
             "registered_hemispheres.nii"
         )
         self.volume_csv_path = self.make_reg_path("volumes.csv")
+        self.volume_hierarchy_csv_path = self.make_reg_path(
+            "volumes_hierarchy.csv"
+        )
+        self.stage_timings_path = self.make_reg_path("stage_timings.csv")
+        self.manifest_path = self.make_reg_path("amap_manifest.json")
+        self.resource_usage_json_path = self.make_reg_path(
+            "resource_usage.json"
+        )
+        self.resource_usage_csv_path = self.make_reg_path("resource_usage.csv")
 
         self.tmp__affine_registered_atlas_brain_path = self.make_reg_path(
             "affine_registered_atlas_brain.nii"
@@ -59,6 +72,7 @@ class Paths:
         )
 
         self.boundaries_file_path = self.make_reg_path("boundaries.nii")
+        self.sparse_boundaries_file_path = self.make_reg_path("boundaries.npz")
 
         (
             self.tmp__affine_log_file_path,
@@ -76,6 +90,10 @@ class Paths:
             self.tmp__segmentation_log_file,
             self.tmp__segmentation_error_file,
         ) = self.compute_reg_log_file_paths("segment")
+        (
+            self.tmp__hemispheres_log_file,
+            self.tmp__hemispheres_error_file,
+        ) = self.compute_reg_log_file_paths("hemispheres")
         (
             self.tmp__invert_affine_log_file,
             self.tmp__invert_affine_error_file,
@@ -0,0 +1,207 @@
+"""
+resources
+=========
+
+Run external programs (e.g. NiftyReg), measuring the resources they use:
+wall time, CPU time, peak memory and how many cores were used on average.
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import shlex
+import logging
+import tempfile
+import threading
+import subprocess
+from argparse import ArgumentParser
+
+RESOURCE_FIELDS = (
+    "stage",
+    "n_threads",
+    "wall_time_s",
+    "user_time_s",
+    "system_time_s",
+    "cpu_time_s",
+    "cpu_utilisation",
+    "thread_utilisation",
+    "peak_rss_mb",
+    "command",
+)
+
+
+def execute_command(cmd, log_file_path, error_file_path, env=None):
+    """
+    Execute a command in the shell with
+    imlib.general.system.safe_execute_command, and measure the resources
+    used by it and any processes it starts. The command is run through this
+    module (see run_and_measure), which waits for it with os.wait4.
+
+    :param str cmd: The command
+    :param log_file_path: The file to write the standard output to
+    :param error_file_path: The file to write the standard error to
+    :param dict env: The environment variables of the command. If None,
+        those of this process are used.
+    :return: dict of the wall time, user and system CPU time (s), the CPU
+        utilisation (CPU time / wall time, i.e. the average number of cores
+        used) and peak resident memory (MB). Only the wall time is measured
+        if the platform does not support os.wait4.
+    :rtype: dict
+    :raises SafeExecuteCommandError: If the command fails
+    """
+    # imported here, so that running this module to measure a command does
+    # not import imlib (which would add to the memory measured)
+    from imlib.general.system import safe_execute_command
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        usage_path = os.path.join(tmp_dir, "usage.json")
+        measured_cmd = [sys.executable, os.path.abspath(__file__), usage_path]
+        if env is not None:
+            env_path = os.path.join(tmp_dir, "env.json")
+            with open(env_path, "w") as env_file:
+                json.dump(dict(env), env_file)
+            measured_cmd += ["--env", env_path]
+        measured_cmd += ["--", cmd]
+
+        safe_execute_command(
+            " ".join(shlex.quote(arg) for arg in measured_cmd),
+            log_file_path,
+            error_file_path,
+        )
+        with open(usage_path, "r") as usage_file:
+            return json.load(usage_file)
+
+
+def run_and_measure(cmd, usage_path, env=None):
+    """
+    Run a command in the shell, and save the resources used by it (see
+    execute_command) to a json file.
+
+    :param str cmd: The command
+    :param usage_path: The json file to save the resource usage to
+    :param dict env: The environment variables of the command. If None,
+        those of this process are used.
+    :return: The exit code of the command (or 128 + the signal that
+        terminated it)
+    :rtype: int
+    """
+    start_time = time.perf_counter()
+    process = subprocess.Popen(cmd, shell=True, env=env)
+    if hasattr(os, "wait4"):
+        _, status, rusage = os.wait4(process.pid, 0)
+        if os.WIFSIGNALED(status):
+            returncode = 128 + os.WTERMSIG(status)
+        else:
+            returncode = os.WEXITSTATUS(status)
+    else:
+        returncode = process.wait()
+        rusage = None
+    wall_time = time.perf_counter() - start_time
+
+    usage = {"wall_time_s": wall_time}
+    if rusage is not None:
+        cpu_time = rusage.ru_utime + rusage.ru_stime
+        usage.update(
+            {
+                "user_time_s": rusage.ru_utime,
+                "system_time_s": rusage.ru_stime,
+                "cpu_time_s": cpu_time,
+                "cpu_utilisation": cpu_time / wall_time if wall_time else 0,
+                # ru_maxrss is in kilobytes on Linux
+                "peak_rss_mb": rusage.ru_maxrss / 1024,
+            }
+        )
+    with open(usage_path, "w") as usage_file:
+        json.dump(usage, usage_file)
+    return returncode
+
+
+class ResourceMonitor:
+    """
+    Collects the resource usage of each external program run by amap, and
+    saves and summarises them.
+    """
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def execute(self, stage, cmd, log_file_path, error_file_path, n_threads):
+        """
+        Execute a command, and record its resource usage.
+
+        :param str stage: The name of the stage the command belongs to
+        :param str cmd: The command
+        :param log_file_path: The file to write the standard output to
+        :param error_file_path: The file to write the standard error to
+        :param int n_threads: The number of threads the program was given
+        :raises SafeExecuteCommandError: If the command fails
+        """
+        usage = execute_command(cmd, log_file_path, error_file_path)
+        usage.update({"stage": stage, "n_threads": n_threads, "command": cmd})
+        if usage.get("cpu_utilisation") is not None and n_threads:
+            # the fraction of the threads that were kept busy
+            usage["thread_utilisation"] = usage["cpu_utilisation"] / n_threads
+        else:
+            usage["thread_utilisation"] = None
+        with self._lock:
+            self.records.append(usage)
+        logging.debug(f"Stage: {stage} resource usage: {usage}")
+
+    def save_json(self, output_path):
+        with open(output_path, "w") as output_file:
+            json.dump(self.records, output_file, indent=4)
+
+    def save_csv(self, output_path):
+        with open(output_path, "w", newline="") as output_file:
+            writer = csv.DictWriter(output_file, fieldnames=RESOURCE_FIELDS)
+            writer.writeheader()
+            for record in self.records:
+                writer.writerow(record)
+
+    def log_summary(self):
+        if not self.records:
+            return
+        name_width = max(len(record["stage"]) for record in self.records)
+        lines = [
+            f"{'Stage':<{name_width}}  Threads  Wall (s)  CPU (s)  "
+            f"Utilisation  Peak RSS (MB)"
+        ]
+        for record in self.records:
+            threads = (
+                "" if record["n_threads"] is None else record["n_threads"]
+            )
+            line = (
+                f"{record['stage']:<{name_width}}  {threads:>7}  "
+                f"{record['wall_time_s']:>8.1f}"
+            )
+            if record.get("cpu_time_s") is not None:
+                line += (
+                    f"  {record['cpu_time_s']:>7.1f}  "
+                    f"{record['thread_utilisation']:>11.0%}  "
+                    f"{record['peak_rss_mb']:>13.0f}"
+                )
+            lines.append(line)
+        logging.info(
+            "Resource usage of external programs:\n" + "\n".join(lines)
+        )
+
+
+def main():
+    # used by execute_command to run (and measure) a command
+    parser = ArgumentParser()
+    parser.add_argument("usage_path")
+    parser.add_argument("cmd")
+    parser.add_argument("--env", dest="env_path")
+    args = parser.parse_args()
+    env = None
+    if args.env_path is not None:
+        with open(args.env_path, "r") as env_file:
+            env = json.load(env_file)
+    sys.exit(run_and_measure(args.cmd, args.usage_path, env=env))
+
+
+if __name__ == "__main__":
+    main()
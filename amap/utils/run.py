@@ -2,10 +2,21 @@ import logging
 
 from pathlib import Path
 
+REGISTRATION_STAGES = (
+    "affine",
+    "freeform",
+    "segment",
+    "hemispheres",
+    "inverse_transform",
+)
+
 
 class Run:
     """
-    Determines what parts of amap to run, based on what files already exist
+    Determines what parts of amap to run. If a manifest
+    (amap.utils.manifest.RunManifest) is given, a stage is run if anything it
+    depends on has changed since it was last run. Otherwise, it is run if
+    its outputs do not exist.
     """
 
     def __init__(
@@ -13,18 +24,42 @@ class Run:
         paths,
         atlas,
         boundaries=True,
+        sparse_boundaries=False,
         additional_images=False,
         debug=False,
+        manifest=None,
     ):
         self._paths = paths
         self._atlas = atlas
         self._boundaries = boundaries
+        self._sparse_boundaries = sparse_boundaries
         self._additional_images = additional_images
         self._debug = debug
+        self._manifest = manifest
+
+    def complete(self, stage):
+        """
+        Record that a stage has finished successfully.
+
+        :param str stage: The name of the stage
+        """
+        if self._manifest is not None and stage in self._manifest.stages:
+            self._manifest.record(stage)
+
+    def _uses_manifest(self, stage):
+        return self._manifest is not None and stage in self._manifest.stages
+
+    def _needs_run(self, stage):
+        needs_run = self._manifest.needs_run(stage)
+        if not needs_run:
+            logging.info(f"Stage: {stage} is up to date, skipping")
+        return needs_run
 
     # TODO: make this more specific
     @property
     def preprocess(self):
+        if self._uses_manifest("preprocess"):
+            return self._needs_run("preprocess")
         if (
             self._brain_exists
             and self._atlas_exists
@@ -40,6 +75,12 @@ class Run:
 
     @property
     def register(self):
+        if self._manifest is not None:
+            return any(
+                self._manifest.needs_run(stage)
+                for stage in REGISTRATION_STAGES
+                if stage in self._manifest.stages
+            )
         if (
             self._registered_atlas_exists
             and self._registered_hemispheres_exists
@@ -52,6 +93,8 @@ class Run:
 
     @property
     def affine(self):
+        if self._uses_manifest("affine"):
+            return self._needs_run("affine")
         if self.register and not (
             self._affine_reg_brain_exists or self._control_point_exists
         ):
@@ -62,6 +105,8 @@ class Run:
 
     @property
     def freeform(self):
+        if self._uses_manifest("freeform"):
+            return self._needs_run("freeform")
         if self.register and not self._control_point_exists:
             return True
         else:
@@ -70,6 +115,8 @@ class Run:
 
     @property
     def segment(self):
+        if self._uses_manifest("segment"):
+            return self._needs_run("segment")
         if self._registered_atlas_exists:
             logging.info("Registered atlas exists, skipping segmentation")
             return False
@@ -78,6 +125,8 @@ class Run:
 
     @property
     def hemispheres(self):
+        if self._uses_manifest("hemispheres"):
+            return self._needs_run("hemispheres")
         if self._registered_hemispheres_exists:
             logging.info("Registered hemispheres exist, skipping segmentation")
             return False
@@ -86,6 +135,8 @@ class Run:
 
     @property
     def inverse_transform(self):
+        if self._uses_manifest("inverse_transform"):
+            return self._needs_run("inverse_transform")
         if self._inverse_control_point_exists:
             logging.info(
                 "Inverse transform exists, skipping inverse registration"
@@ -96,6 +147,8 @@ class Run:
 
     @property
     def volumes(self):
+        if self._uses_manifest("volumes"):
+            return self._needs_run("volumes")
         if self._volumes_exist:
             logging.info(
                 "Volumes csv exists, skipping region volume calculation"
@@ -106,6 +159,8 @@ class Run:
 
     @property
     def boundaries(self):
+        if self._boundaries and self._uses_manifest("boundaries"):
+            return self._needs_run("boundaries")
         if self._boundaries:
             if self._boundaries_exist:
                 logging.info(
@@ -174,6 +229,8 @@ class Run:
 
     @property
     def _boundaries_exist(self):
+        if self._sparse_boundaries:
+            return self._exists(self._paths.sparse_boundaries_file_path)
         return self._exists(self._paths.boundaries_file_path)
 
     @staticmethod
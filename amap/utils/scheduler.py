@@ -0,0 +1,253 @@
+"""
+scheduler
+=========
+
+A small dependency-aware scheduler for the stages of amap. Each stage runs
+as soon as all the stages it depends on have finished, so independent
+stages (e.g. segmentation and the inverse transform) run at the same time.
+Stages that use several threads or processes (e.g. NiftyReg, or counting
+the volumes in parallel) share a thread budget between them.
+"""
+
+import csv
+import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+
+
+class SchedulerError(Exception):
+    pass
+
+
+def get_process_pool_context():
+    """
+    Get the multiprocessing context for the process pools of the stages.
+    As the stages run on the threads of the scheduler, forking while other
+    stages hold locks (e.g. of logging or subprocess) could deadlock the
+    child processes, so they are started by a fork server (or spawned, if
+    that is not available) instead.
+
+    :return: The multiprocessing context
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+class Stage:
+    """
+    A single stage of the pipeline.
+
+    :param str name: The name of the stage
+    :param function: The function to run. If the stage is threaded, it is
+        called with the number of threads it may use (n_threads).
+    :param dependencies: The names of the stages that must finish before
+        this one starts
+    :param bool threaded: Whether the stage uses several threads or
+        processes, and so should be given a share of the thread budget
+    :param bool run: Whether to run the stage at all (e.g. False if its
+        outputs already exist). Stages that are not run still satisfy the
+        dependencies of later stages.
+    """
+
+    def __init__(
+        self, name, function, dependencies=(), threaded=False, run=True
+    ):
+        self.name = name
+        self.function = function
+        self.dependencies = tuple(dependencies)
+        self.threaded = threaded
+        self.run = run
+
+        self.n_threads = None
+        self.start_time = None
+        self.end_time = None
+
+    @property
+    def time_taken(self):
+        if self.start_time is None or self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    def __call__(self):
+        self.start_time = datetime.now()
+        try:
+            if self.threaded:
+                self.function(n_threads=self.n_threads)
+            else:
+                self.function()
+        finally:
+            self.end_time = datetime.now()
+
+
+class Scheduler:
+    """
+    Runs a set of stages in dependency order, running independent stages
+    concurrently.
+
+    :param int n_threads: The thread budget, shared between the threaded
+        stages that run at the same time
+    :param int max_concurrent_stages: The maximum number of stages to run at
+        once. If None, all the stages that are ready are run. If 1, the
+        stages are run in sequence (in the order they were added).
+    :param on_stage_finished: Optional function called with the name of
+        each stage that finishes successfully
+    """
+
+    def __init__(
+        self,
+        n_threads=1,
+        max_concurrent_stages=None,
+        on_stage_finished=None,
+    ):
+        self.n_threads = n_threads
+        self.max_concurrent_stages = max_concurrent_stages
+        self.on_stage_finished = on_stage_finished
+        self.stages = {}
+
+    def add_stage(
+        self, name, function, dependencies=(), threaded=False, run=True
+    ):
+        """
+        Add a stage to the pipeline (see Stage).
+
+        :raises SchedulerError: If the stage depends on an unknown stage
+        """
+        for dependency in dependencies:
+            if dependency not in self.stages:
+                raise SchedulerError(
+                    f"Stage: {name} depends on unknown stage: {dependency}"
+                )
+        self.stages[name] = Stage(
+            name,
+            function,
+            dependencies=dependencies,
+            threaded=threaded,
+            run=run,
+        )
+
+    def _get_n_threads(self, running, ready):
+        # the budget is split between the threaded stages running at once.
+        # Stages that are already running keep their threads.
+        n_threaded = sum(stage.threaded for stage in ready)
+        if n_threaded == 0:
+            return None
+        used = sum(stage.n_threads for stage in running if stage.threaded)
+        return max(1, (self.n_threads - used) // n_threaded)
+
+    def run(self, stage_names=None):
+        """
+        Run all the stages. If a stage fails, no more stages are started,
+        and the error is raised once the running stages have finished.
+
+        :param stage_names: If not None, only these stages are run (the
+            others are treated as already finished)
+        """
+        stages_to_run = {
+            stage.name: stage.run for stage in self.stages.values()
+        }
+        if stage_names is not None:
+            for name in stages_to_run:
+                if name not in stage_names:
+                    stages_to_run[name] = False
+
+        finished = set()
+        pending = list(self.stages.values())
+        running = {}
+
+        max_workers = self.max_concurrent_stages or max(1, len(pending))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending or running:
+                ready = []
+                for stage in list(pending):
+                    if not set(stage.dependencies).issubset(finished):
+                        continue
+                    pending.remove(stage)
+                    if stages_to_run[stage.name]:
+                        ready.append(stage)
+                    else:
+                        finished.add(stage.name)
+
+                if len(running) + len(ready) > max_workers:
+                    n_to_start = max_workers - len(running)
+                    pending = ready[n_to_start:] + pending
+                    ready = ready[:n_to_start]
+
+                n_threads = self._get_n_threads(running.values(), ready)
+                for stage in ready:
+                    if stage.threaded:
+                        stage.n_threads = n_threads
+                    logging.debug(
+                        f"Starting stage: {stage.name}"
+                        + (f" ({n_threads} threads)" if stage.threaded else "")
+                    )
+                    running[executor.submit(stage)] = stage
+
+                if not running:
+                    # skipping stages may have made others ready
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        logging.error(f"Stage: {stage.name} failed")
+                        wait(running)
+                        raise error
+                    logging.debug(
+                        f"Finished stage: {stage.name} "
+                        f"({stage.time_taken})"
+                    )
+                    if self.on_stage_finished is not None:
+                        self.on_stage_finished(stage.name)
+                    finished.add(stage.name)
+
+    def get_timings(self):
+        """
+        Get the start time, end time and time taken of each stage that was
+        run.
+
+        :return: List of (stage name, threads, start, end, time taken)
+        :rtype: list
+        """
+        return [
+            (
+                stage.name,
+                stage.n_threads,
+                stage.start_time,
+                stage.end_time,
+                stage.time_taken,
+            )
+            for stage in self.stages.values()
+            if stage.time_taken is not None
+        ]
+
+    def log_timings(self):
+        timings = self.get_timings()
+        if not timings:
+            return
+        name_width = max(len(name) for name, *_ in timings)
+        lines = [f"{'Stage':<{name_width}}  Threads  Time taken"]
+        for name, n_threads, _, _, time_taken in timings:
+            threads = "" if n_threads is None else n_threads
+            lines.append(f"{name:<{name_width}}  {threads:>7}  {time_taken}")
+        logging.info("Stage timings:\n" + "\n".join(lines))
+
+    def save_timings(self, output_path):
+        with open(output_path, "w", newline="") as output_file:
+            writer = csv.writer(output_file)
+            writer.writerow(
+                ["stage", "threads", "start", "end", "time_taken_s"]
+            )
+            for name, n_threads, start, end, time_taken in self.get_timings():
+                writer.writerow(
+                    [
+                        name,
+                        n_threads,
+                        start.isoformat(),
+                        end.isoformat(),
+                        time_taken.total_seconds(),
+                    ]
+                )
@@ -1,19 +1,36 @@
 import logging
+import numpy as np
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from brainio import brainio
 from skimage.segmentation import find_boundaries
 from imlib.image.scale import scale_and_convert_to_16_bits
 from imlib.image import nii
 
 from amap.tools.source_files import source_custom_config
+from amap.utils.scheduler import get_process_pool_context
 
 
-def main(registered_atlas, boundaries_out_path, atlas_config=None):
+def main(
+    registered_atlas,
+    boundaries_out_path,
+    atlas_config=None,
+    slab_size=None,
+    n_processes=1,
+    label_ids=False,
+    memmap_path=None,
+):
     atlas_info = GetAtlas(registered_atlas, atlas_config=atlas_config)
     boundaries(
-        atlas_info.atlas,
+        atlas_info.atlas_proxy if slab_size is not None else atlas_info.atlas,
         boundaries_out_path,
         atlas_scale=atlas_info.atlas_scale,
         transformation_matrix=atlas_info.transformation_matrix,
+        slab_size=slab_size,
+        n_processes=n_processes,
+        memmap_path=memmap_path,
+        label_ids=label_ids,
     )
 
 
@@ -23,7 +40,8 @@ class GetAtlas:
         self._atlas_path = registered_atlas
         self._atlas_config = atlas_config
 
-        self.atlas = None
+        self._atlas_image = None
+        self._atlas = None
         self.atlas_scale = None
         self.transformation_matrix = None
 
@@ -35,11 +53,29 @@ class GetAtlas:
             self._atlas_config = source_custom_config()
 
     def get_atlas(self):
-        atlas = brainio.load_nii(self._atlas_path, as_array=False)
-        self.atlas_scale = atlas.header.get_zooms()
-        self.atlas = atlas.get_data()
+        self._atlas_image = brainio.load_nii(self._atlas_path, as_array=False)
+        self.atlas_scale = self._atlas_image.header.get_zooms()
         self.get_transformation_matrix()
 
+    @property
+    def atlas(self):
+        # only loaded when it is first used
+        if self._atlas is None:
+            self._atlas = self._atlas_image.get_data()
+        return self._atlas
+
+    @atlas.setter
+    def atlas(self, atlas):
+        self._atlas = atlas
+
+    @property
+    def atlas_proxy(self):
+        """
+        The array proxy of the atlas image, which is only read when it is
+        sliced (e.g. one slab at a time by find_boundaries_in_slabs)
+        """
+        return self._atlas_image.dataobj
+
     def get_transformation_matrix(self):
         self.transformation_matrix = nii.get_transformation_matrix(
             self._atlas_config
@@ -52,13 +88,18 @@ def boundaries(
     atlas_labels=False,
     atlas_scale=None,
     transformation_matrix=None,
+    slab_size=None,
+    n_processes=1,
+    memmap_path=None,
+    label_ids=False,
 ):
     """
     Generate the boundary image, which is the border between each segmentation
     region. Useful for overlaying on the raw image to assess the registration
     and segmentation
 
-    :param atlas: The registered atlas
+    :param atlas: The registered atlas (an array, or the array proxy of a
+    nifti image, which is only read one slab at a time if slab_size is set)
     :param boundaries_out_path: Path to save the boundary image
     :param atlas_labels: If True, keep the numerical values of the atlas for
     the labels
@@ -66,15 +107,346 @@ def boundaries(
     processed using other tools.
     :param transformation_matrix: Transformation matrix so that the resulting
     nifti can be processed using other tools.
+    :param slab_size: If not None, the boundaries are found in slabs of this
+    many planes (see find_boundaries_in_slabs), which uses less memory and
+    can use several processes. The image is the same.
+    :param n_processes: The number of processes to find the boundaries of
+    the slabs with
+    :param memmap_path: If not None (and using slabs), the boundary image is
+    written to a memory-mapped file at this path before it is saved
+    :param label_ids: If True, the boundary voxels keep the label ids of the
+    atlas (in an integer type, see get_label_dtype), and are not rescaled
+    :param boundaries_out_path: If this ends with ".npz", the boundaries are
+    saved in the sparse format of save_sparse_boundaries, rather than as
+    a nifti image
     """
-    boundaries_image = find_boundaries(atlas, mode="inner")
-    if atlas_labels:
-        boundaries_image = boundaries_image * atlas
-    boundaries_image = scale_and_convert_to_16_bits(boundaries_image)
+    if label_ids and slab_size is None:
+        slab_size = atlas.shape[-1]
+    if slab_size is None:
+        atlas = np.asarray(atlas)
+        boundaries_image = find_boundaries(atlas, mode="inner")
+        if atlas_labels:
+            boundaries_image = boundaries_image * atlas
+        boundaries_image = scale_and_convert_to_16_bits(boundaries_image)
+    else:
+        boundaries_image = find_boundaries_in_slabs(
+            atlas,
+            slab_size=slab_size,
+            n_processes=n_processes,
+            atlas_labels=atlas_labels,
+            memmap_path=memmap_path,
+            label_ids=label_ids,
+        )
     logging.debug("Saving segmentation boundary image")
-    brainio.to_nii(
-        boundaries_image,
-        boundaries_out_path,
-        scale=atlas_scale,
-        affine_transform=transformation_matrix,
+    if str(boundaries_out_path).endswith(".npz"):
+        save_sparse_boundaries(
+            boundaries_image,
+            boundaries_out_path,
+            atlas_scale=atlas_scale,
+            transformation_matrix=transformation_matrix,
+        )
+    else:
+        brainio.to_nii(
+            boundaries_image,
+            boundaries_out_path,
+            scale=atlas_scale,
+            affine_transform=transformation_matrix,
+        )
+
+
+def find_boundaries_in_slabs(
+    atlas,
+    slab_size=32,
+    n_processes=1,
+    atlas_labels=False,
+    memmap_path=None,
+    label_ids=False,
+):
+    """
+    Find the boundaries of the atlas regions (as find_boundaries with
+    mode="inner"), and scale them to 16 bits (as
+    scale_and_convert_to_16_bits), one slab of planes (along the last axis)
+    at a time. Each slab is extended by a halo of one plane on each side,
+    so the boundaries are identical to those of the whole image. Only the
+    output image is allocated in full.
+
+    :param atlas: The registered atlas (may be memory-mapped, or the array
+        proxy of a nifti image, e.g. nibabel's dataobj). Only the slabs are
+        read from it.
+    :param int slab_size: The number of planes in each slab
+    :param int n_processes: If more than one, find the boundaries of the
+        slabs in parallel using this many processes
+    :param bool atlas_labels: If True, keep the (scaled) values of the
+        atlas for the labels
+    :param memmap_path: If not None, write the output image to a memory
+        mapped (.npy) file at this path
+    :param bool label_ids: If True, the boundary voxels keep the label ids
+        of the atlas, in an integer type (see get_label_dtype), rather than
+        being scaled. Each slab is then only processed once.
+    :return: The 16 bit boundary image (or the label ids)
+    :rtype: np.array
+    """
+    dtype = get_label_dtype(atlas.dtype) if label_ids else np.uint16
+    if memmap_path is not None:
+        output = np.lib.format.open_memmap(
+            str(memmap_path), mode="w+", dtype=dtype, shape=atlas.shape
+        )
+    else:
+        output = np.zeros(atlas.shape, dtype=dtype)
+
+    n_planes = atlas.shape[-1]
+    slabs = [
+        (start, min(start + slab_size, n_planes))
+        for start in range(0, n_planes, slab_size)
+    ]
+    halo_slabs = (
+        (
+            atlas[..., max(start - 1, 0) : min(end + 1, n_planes)],
+            start - max(start - 1, 0),
+            end - start,
+        )
+        for start, end in slabs
+    )
+
+    if label_ids:
+        for (start, end), slab_labels in zip(
+            slabs,
+            _map_slabs(_find_slab_boundary_labels, halo_slabs, n_processes),
+        ):
+            output[..., start:end] = slab_labels
+        return output
+
+    # first the boundaries (stored as 0 or 1), and the maximum value to
+    # scale them by
+    max_value = None
+    for (start, end), slab_boundaries in zip(
+        slabs, _map_slabs(_find_slab_boundaries, halo_slabs, n_processes)
+    ):
+        output[..., start:end] = slab_boundaries
+        slab_values = _get_slab_values(
+            slab_boundaries, atlas, start, end, atlas_labels
+        )
+        if slab_values.size:
+            slab_max = slab_values.max()
+            if max_value is None or slab_max > max_value:
+                max_value = slab_max
+
+    for start, end in slabs:
+        slab_values = _get_slab_values(
+            output[..., start:end].astype(bool),
+            atlas,
+            start,
+            end,
+            atlas_labels,
+        )
+        # as scale_and_convert_to_16_bits, with the maximum of the whole
+        # image
+        with np.errstate(invalid="ignore", divide="ignore"):
+            scaled = slab_values / max_value * (2 ** 16 - 1)
+        if not max_value:
+            # there are no boundaries
+            scaled = np.zeros_like(scaled)
+        output[..., start:end] = scaled.astype(np.uint16, copy=False)
+    return output
+
+
+def get_label_dtype(atlas_dtype):
+    """
+    Get the integer type to store the label ids of an atlas in. Integer
+    atlases keep their type, and floating point (e.g. registered) atlases
+    are stored as unsigned 32 bit integers (enough for all the structure ids
+    of the Allen atlas).
+
+    :param atlas_dtype: The type of the atlas
+    :return: The integer type
+    """
+    atlas_dtype = np.dtype(atlas_dtype)
+    if atlas_dtype == bool:
+        return np.dtype(np.uint8)
+    elif np.issubdtype(atlas_dtype, np.integer):
+        return atlas_dtype
+    else:
+        return np.dtype(np.uint32)
+
+
+def _get_slab_values(slab_boundaries, atlas, start, end, atlas_labels):
+    # the atlas slab is only read if it is needed
+    if atlas_labels:
+        return slab_boundaries * np.asarray(atlas[..., start:end])
+    return slab_boundaries
+
+
+def _find_slab_boundaries(halo_slab):
+    slab, offset, n_planes = halo_slab
+    slab_boundaries = find_boundaries(np.asarray(slab), mode="inner")
+    return slab_boundaries[..., offset : offset + n_planes]
+
+
+def _find_slab_boundary_labels(halo_slab):
+    slab, offset, n_planes = halo_slab
+    slab = np.asarray(slab)
+    core = slab[..., offset : offset + n_planes]
+    slab_boundaries = _find_slab_boundaries((slab, offset, n_planes))
+    labels = np.zeros(core.shape, dtype=get_label_dtype(slab.dtype))
+    np.copyto(labels, core, casting="unsafe", where=slab_boundaries)
+    return labels
+
+
+def _map_slabs(function, slabs, n_processes):
+    # as map, but with at most two slabs per process in flight, so that the
+    # memory used does not depend on the size of the image
+    if n_processes is None or n_processes <= 1:
+        yield from map(function, slabs)
+        return
+    with ProcessPoolExecutor(
+        max_workers=n_processes, mp_context=get_process_pool_context()
+    ) as pool:
+        futures = deque()
+        for slab in slabs:
+            futures.append(pool.submit(function, slab))
+            if len(futures) >= 2 * n_processes:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def save_sparse_boundaries(
+    boundaries_image,
+    output_path,
+    atlas_scale=None,
+    transformation_matrix=None,
+):
+    """
+    Save a boundary image sparsely, as the runs of non-zero voxels of each
+    plane (along the third axis), in a compressed .npz file. As boundaries
+    are a small fraction of the image, this is much smaller than the nifti
+    image, and each plane can be decoded separately (see SparseBoundaries).
+
+    :param np.array boundaries_image: The boundary image (may be
+        memory-mapped)
+    :param output_path: The path of the .npz file
+    :param atlas_scale: The scaling of the image, saved with it
+    :param transformation_matrix: The transformation matrix of the image,
+        saved with it
+    """
+    plane_offsets = [0]
+    run_starts = []
+    run_lengths = []
+    run_values = []
+    for plane_idx in range(boundaries_image.shape[2]):
+        # in memory order for a nifti image
+        plane = np.asarray(boundaries_image[:, :, plane_idx]).ravel(order="F")
+        starts, lengths, values = _encode_runs(plane)
+        run_starts.append(starts)
+        run_lengths.append(lengths)
+        run_values.append(values)
+        plane_offsets.append(plane_offsets[-1] + len(starts))
+
+    np.savez_compressed(
+        str(output_path),
+        shape=np.array(boundaries_image.shape),
+        dtype=np.array(boundaries_image.dtype.str),
+        plane_offsets=np.array(plane_offsets, dtype=np.int64),
+        run_starts=np.concatenate(run_starts),
+        run_lengths=np.concatenate(run_lengths),
+        run_values=np.concatenate(run_values),
+        scale=np.array(() if atlas_scale is None else atlas_scale),
+        affine=np.array(
+            () if transformation_matrix is None else transformation_matrix
+        ),
+    )
+
+
+def _encode_runs(plane):
+    run_starts = np.flatnonzero(plane[1:] != plane[:-1]) + 1
+    run_starts = np.concatenate(([0], run_starts)).astype(np.int64)
+    run_lengths = np.diff(np.append(run_starts, plane.size))
+    run_values = plane[run_starts]
+    foreground = run_values != 0
+    return (
+        run_starts[foreground],
+        run_lengths[foreground],
+        run_values[foreground],
     )
+
+
+class SparseBoundaries:
+    """
+    A boundary image saved by save_sparse_boundaries. Only the runs are
+    loaded, and each plane is decoded when it is needed.
+
+    :param path: The path of the .npz file
+    """
+
+    def __init__(self, path):
+        with np.load(str(path)) as sparse:
+            self.shape = tuple(int(size) for size in sparse["shape"])
+            self.dtype = np.dtype(str(sparse["dtype"]))
+            self.plane_offsets = sparse["plane_offsets"]
+            self.run_starts = sparse["run_starts"]
+            self.run_lengths = sparse["run_lengths"]
+            self.run_values = sparse["run_values"]
+            self.scale = sparse["scale"]
+            self.affine = sparse["affine"]
+        self.plane_shape = self.shape[:2] + self.shape[3:]
+
+    def get_plane(self, plane_idx):
+        """
+        Decode a single plane, i.e. image[:, :, plane_idx].
+
+        :param int plane_idx: The index of the plane (along the third axis)
+        :return: The plane
+        :rtype: np.array
+        """
+        start, end = self.plane_offsets[plane_idx : plane_idx + 2]
+        run_starts = self.run_starts[start:end]
+        run_lengths = self.run_lengths[start:end]
+
+        plane = np.zeros(int(np.prod(self.plane_shape)), dtype=self.dtype)
+        # the index of each voxel in a run, relative to the start of its run
+        run_offsets = np.arange(run_lengths.sum()) - np.repeat(
+            np.cumsum(run_lengths) - run_lengths, run_lengths
+        )
+        plane[np.repeat(run_starts, run_lengths) + run_offsets] = np.repeat(
+            self.run_values[start:end], run_lengths
+        )
+        return plane.reshape(self.plane_shape, order="F")
+
+    def to_array(self):
+        """
+        Decode the whole image.
+
+        :return: The boundary image
+        :rtype: np.array
+        """
+        image = np.zeros(self.shape, dtype=self.dtype)
+        for plane_idx in range(self.shape[2]):
+            image[:, :, plane_idx] = self.get_plane(plane_idx)
+        return image
+
+    def to_dask(self):
+        """
+        Get a lazy (dask) array of the image, with the planes along the first
+        axis (i.e. np.swapaxes(image, 2, 0), as displayed by amap_vis). Each
+        plane is decoded when it is first displayed.
+
+        :return: The lazy array
+        :rtype: dask.array.Array
+        """
+        import dask
+        import dask.array as da
+
+        swapped_shape = (self.shape[1], self.shape[0]) + self.shape[3:]
+        return da.stack(
+            [
+                da.from_delayed(
+                    dask.delayed(self._get_swapped_plane)(plane_idx),
+                    shape=swapped_shape,
+                    dtype=self.dtype,
+                )
+                for plane_idx in range(self.shape[2])
+            ]
+        )
+
+    def _get_swapped_plane(self, plane_idx):
+        return np.swapaxes(self.get_plane(plane_idx), 0, 1)
@@ -0,0 +1,170 @@
+"""
+pyramid
+=======
+
+Resolution pyramids (multiscale images) for amap_vis. Each level is half
+the size of the previous one along every axis, and is built a slab of
+planes at a time, so the full resolution image is never loaded at once.
+The levels are saved as .npy files, and memory-mapped when displayed, so
+that zoomed out views only read the coarse levels.
+
+The levels are cached by the signature (path, size and modification time)
+of the source files, and are rebuilt if these change.
+"""
+
+import os
+import json
+import shutil
+import logging
+
+import numpy as np
+
+from pathlib import Path
+
+from imlib.general.system import ensure_directory_exists
+
+from amap.utils.cache import hash_inputs, file_signature
+
+PYRAMID_FACTOR = 2
+COMPLETE_NAME = "complete.json"
+
+
+def get_n_levels(shape, min_size=256, factor=PYRAMID_FACTOR):
+    """
+    Get how many levels a pyramid needs, so that the largest dimension of
+    the coarsest level is no larger than min_size.
+
+    :param tuple shape: The shape of the full resolution image
+    :param int min_size: The largest dimension of the coarsest level
+    :param int factor: How much each level is downsampled by
+    :return: The number of levels (including the full resolution image)
+    :rtype: int
+    """
+    n_levels = 1
+    size = max(shape)
+    while size > min_size:
+        size = -(-size // factor)
+        n_levels += 1
+    return n_levels
+
+
+def downsample_slab(slab, factor=PYRAMID_FACTOR, labels=False):
+    """
+    Downsample a slab of planes by a factor along every axis. Images are
+    averaged in blocks (the edge blocks are padded by repeating the edge),
+    labels take the value of the first voxel of each block, so that no new
+    labels are created.
+
+    :param np.array slab: The slab (planes along the first axis)
+    :param int factor: How much to downsample by
+    :param bool labels: Whether the slab is a label image
+    :return: The downsampled slab
+    :rtype: np.array
+    """
+    if labels:
+        return slab[(slice(None, None, factor),) * slab.ndim]
+    padding = [(0, -size % factor) for size in slab.shape]
+    slab = np.pad(slab, padding, mode="edge")
+    blocks = slab.reshape(
+        [
+            dimension
+            for size in slab.shape
+            for dimension in (size // factor, factor)
+        ]
+    )
+    block_axes = tuple(range(1, 2 * slab.ndim, 2))
+    return blocks.mean(axis=block_axes).astype(slab.dtype)
+
+
+def build_level(source, output_path, factor=PYRAMID_FACTOR, labels=False):
+    """
+    Downsample an image into a .npy file, a slab of (factor) planes at a
+    time.
+
+    :param source: The image to downsample (any array that can be sliced
+        along the first axis, e.g. a memory-mapped or dask array)
+    :param output_path: The .npy file to save the downsampled image to
+    :param int factor: How much to downsample by
+    :param bool labels: Whether the image is a label image
+    """
+    output_shape = tuple(-(-size // factor) for size in source.shape)
+    tmp_path = str(output_path) + ".tmp"
+    level = np.lib.format.open_memmap(
+        tmp_path, mode="w+", dtype=source.dtype, shape=output_shape
+    )
+    for plane_idx in range(output_shape[0]):
+        start = plane_idx * factor
+        slab = np.asarray(source[start : start + factor])
+        level[plane_idx : plane_idx + 1] = downsample_slab(
+            slab, factor=factor, labels=labels
+        )
+    level.flush()
+    del level
+    os.replace(tmp_path, output_path)
+
+
+def get_pyramid(
+    image,
+    cache_directory,
+    name,
+    source_files,
+    labels=False,
+    min_size=256,
+    factor=PYRAMID_FACTOR,
+):
+    """
+    Get the resolution pyramid of an image, building and caching the levels
+    if they have not already been built from the same source files.
+
+    :param image: The full resolution image (planes along the first axis)
+    :param cache_directory: The directory to cache the levels in
+    :param str name: The name of the image (e.g. "raw_data")
+    :param list source_files: The files the image is loaded from
+    :param bool labels: Whether the image is a label image
+    :param int min_size: The largest dimension of the coarsest level
+    :param int factor: How much each level is downsampled by
+    :return: List of the levels, from the full resolution image to the
+        coarsest (memory-mapped) level
+    :rtype: list
+    """
+    n_levels = get_n_levels(image.shape, min_size=min_size, factor=factor)
+    if n_levels == 1:
+        return [image]
+
+    inputs = {
+        "sources": [file_signature(str(file)) for file in source_files],
+        "shape": image.shape,
+        "labels": labels,
+        "factor": factor,
+        "n_levels": n_levels,
+    }
+    pyramid_directory = Path(cache_directory, name)
+    level_paths = [
+        pyramid_directory / f"level_{level}.npy"
+        for level in range(1, n_levels)
+    ]
+    complete_path = pyramid_directory / COMPLETE_NAME
+    key = hash_inputs(inputs)
+    if not _is_complete(complete_path, key):
+        logging.info(f"Building {n_levels - 1} pyramid levels of: {name}")
+        if pyramid_directory.exists():
+            shutil.rmtree(pyramid_directory)
+        ensure_directory_exists(str(pyramid_directory))
+        source = image
+        for level_path in level_paths:
+            build_level(source, level_path, factor=factor, labels=labels)
+            source = np.load(str(level_path), mmap_mode="r")
+        with open(complete_path, "w") as complete_file:
+            json.dump({"key": key, "inputs": inputs}, complete_file)
+
+    return [image] + [
+        np.load(str(level_path), mmap_mode="r") for level_path in level_paths
+    ]
+
+
+def _is_complete(complete_path, key):
+    try:
+        with open(complete_path, "r") as complete_file:
+            return json.load(complete_file)["key"] == key
+    except (IOError, ValueError, KeyError):
+        return False
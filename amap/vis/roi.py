@@ -0,0 +1,172 @@
+"""
+roi
+===
+
+Crop the raw data to the region around some atlas structures, so that the
+region can be viewed at full resolution without streaming the whole image.
+The bounding box of the structures is found in the registered atlas, and
+only the raw data inside it is loaded. The annotations (and their
+boundaries) are upsampled to the raw resolution for the crop only.
+"""
+
+import math
+
+import numpy as np
+
+
+class RoiError(Exception):
+    pass
+
+
+def get_roi_structure_ids(structures, structure_lookup):
+    """
+    Get the ids of some structures, and of all of their descendants (the
+    registered atlas only holds the ids of the finest structures).
+
+    :param list structures: The structures, each as an id, a name or an
+        acronym (not case sensitive)
+    :param structure_lookup: The amap.tools.structures.StructureLookup of
+        the atlas
+    :return: The sorted ids
+    :rtype: np.array
+    :raises RoiError: If a structure is not in the structures file
+    """
+    from amap.register.volume import get_structure_ancestors
+
+    table = structure_lookup.structures
+    names = table["name"].str.lower().tolist()
+    if "acronym" in table:
+        acronyms = table["acronym"].astype(str).str.lower().tolist()
+    else:
+        acronyms = [None] * len(names)
+
+    roi_ids = set()
+    for structure in structures:
+        structure = str(structure).strip()
+        if structure.isdigit() and int(structure) in structure_lookup:
+            roi_ids.add(int(structure))
+            continue
+        matches = [
+            int(structure_id)
+            for structure_id, name, acronym in zip(
+                structure_lookup.ids, names, acronyms
+            )
+            if structure.lower() in (name, acronym)
+        ]
+        if not matches:
+            raise RoiError(
+                f"Structure: '{structure}' is not in the structures file"
+            )
+        roi_ids.update(matches)
+
+    # each structure is one of its own ancestors
+    _, _, ancestor_ids = get_structure_ancestors(table)
+    return np.unique(
+        [
+            int(structure_id)
+            for structure_id, id_path in zip(table["id"], ancestor_ids)
+            if roi_ids.intersection(id_path)
+        ]
+    )
+
+
+def get_structure_bounds(atlas, structure_ids, padding=0):
+    """
+    Get the bounding box of some structures in the (registered) atlas.
+
+    :param np.array atlas: The atlas
+    :param structure_ids: The ids of the structures
+    :param int padding: How many voxels to add on each side of the box
+    :return: The (start, stop) of the box along each axis
+    :rtype: list
+    :raises RoiError: If none of the structures are in the atlas
+    """
+    mask = np.isin(np.asarray(atlas), structure_ids)
+    if not mask.any():
+        raise RoiError(
+            "None of the structures are in the registered atlas. Is the "
+            "registration complete?"
+        )
+    bounds = []
+    for axis, size in enumerate(mask.shape):
+        other_axes = tuple(idx for idx in range(mask.ndim) if idx != axis)
+        present = np.flatnonzero(mask.any(axis=other_axes))
+        bounds.append(
+            (
+                max(0, int(present[0]) - padding),
+                min(size, int(present[-1]) + 1 + padding),
+            )
+        )
+    return bounds
+
+
+def scale_bounds(bounds, scales, shape):
+    """
+    Scale a bounding box from the atlas to the raw data. As when the atlas
+    is displayed scaled over the raw data, atlas voxel i covers raw voxels
+    (i - 0.5) * scale to (i + 0.5) * scale, i.e. raw voxel j is in atlas
+    voxel floor(j / scale + 0.5) (see upsample_crop).
+
+    :param list bounds: The (start, stop) of the box in the atlas
+    :param tuple scales: The scaling from the atlas to the raw data
+    :param tuple shape: The shape of the raw data
+    :return: The (start, stop) of the box in the raw data
+    :rtype: list
+    """
+    return [
+        (
+            max(0, int(math.ceil((start - 0.5) * scale))),
+            min(size, int(math.ceil((stop - 0.5) * scale))),
+        )
+        for (start, stop), scale, size in zip(bounds, scales, shape)
+    ]
+
+
+def upsample_crop(atlas, raw_bounds, scales):
+    """
+    Upsample (by nearest neighbour) the part of the atlas that covers a box
+    of the raw data.
+
+    :param np.array atlas: The atlas
+    :param list raw_bounds: The (start, stop) of the box in the raw data
+    :param tuple scales: The scaling from the atlas to the raw data
+    :return: The atlas, at the resolution of the raw data, in the box
+    :rtype: np.array
+    """
+    indices = [
+        np.clip(
+            np.floor(np.arange(start, stop) / scale + 0.5).astype(np.intp),
+            0,
+            size - 1,
+        )
+        for (start, stop), scale, size in zip(raw_bounds, scales, atlas.shape)
+    ]
+    # only the atlas planes that are needed are read
+    first, last = indices[0][0], indices[0][-1] + 1
+    atlas = np.asarray(atlas[first:last])
+    indices[0] = indices[0] - first
+    return atlas[np.ix_(*indices)]
+
+
+def crop_roi(atlas, raw_image, structure_ids, scales, padding=0):
+    """
+    Crop the raw data (and the upsampled atlas) to the bounding box of some
+    structures. The atlas and raw data must have the same orientation.
+
+    :param np.array atlas: The registered atlas
+    :param raw_image: The raw data (e.g. a dask array, or a chunk store).
+        Only the box is loaded.
+    :param structure_ids: The ids of the structures
+    :param tuple scales: The scaling from the atlas to the raw data
+    :param int padding: How many atlas voxels to add on each side of the box
+    :return: The raw data in the box, the atlas in the box (at the
+        resolution of the raw data), and the (start, stop) of the box in the
+        raw data
+    :rtype: tuple
+    """
+    bounds = get_structure_bounds(atlas, structure_ids, padding=padding)
+    raw_bounds = scale_bounds(bounds, scales, raw_image.shape)
+    box = tuple(slice(start, stop) for start, stop in raw_bounds)
+    raw_crop = np.asarray(raw_image[box])
+    atlas_crop = upsample_crop(atlas, raw_bounds, scales)
+    return raw_crop, atlas_crop, raw_bounds
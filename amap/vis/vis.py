@@ -1,22 +1,14 @@
-import napari
 import numpy as np
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
-from natsort import natsorted
-from napari.utils.io import magic_imread
 from pathlib import Path
-from vispy.color import Colormap
-from brainio import brainio
-from imlib.general.system import get_sorted_file_paths, get_text_lines
 from imlib.general.config import get_config_obj
-from imlib.IO.structures import load_structures_as_df
-from imlib.anatomy.structures.structures_tree import (
-    atlas_value_to_name,
-    UnknownAtlasValue,
-)
 from amap.utils.paths import Paths
-from amap.tools.source_files import get_structures_path
 
-label_red = Colormap([[0.0, 0.0, 0.0, 0.0], [1.0, 1.0, 1.0, 1.0]])
+# napari, the image readers and the structures table are only imported
+# when they are needed, so that e.g. "amap_vis --help" starts quickly.
+
+# transparent to white
+LABEL_RED_COLOURS = [[0.0, 0.0, 0.0, 0.0], [1.0, 1.0, 1.0, 1.0]]
 
 
 def parser():
@@ -56,6 +48,40 @@ def cli_parse(parser):
         action="store_true",
         help="Load data into RAM. ",
     )
+    cli_parser.add_argument(
+        "--multiscale",
+        dest="multiscale",
+        action="store_true",
+        help="Display the images as resolution pyramids, so that zoomed out "
+        "views only load downsampled levels. The pyramids are built (and "
+        "saved) the first time, which may take a while for the raw data.",
+    )
+    cli_parser.add_argument(
+        "--pyramid-directory",
+        dest="pyramid_directory",
+        type=str,
+        default=None,
+        help="Directory to save the resolution pyramids in. Defaults to "
+        "'pyramid' in the amap output directory.",
+    )
+    cli_parser.add_argument(
+        "--roi",
+        dest="roi",
+        type=str,
+        nargs="+",
+        help="Atlas structures (ids, names or acronyms) to inspect. Only the "
+        "raw data in the bounding box of these structures (and their "
+        "descendants) is loaded, and displayed at full resolution with the "
+        "annotations.",
+    )
+    cli_parser.add_argument(
+        "--roi-padding",
+        dest="roi_padding",
+        type=int,
+        default=2,
+        help="How many (atlas) voxels to add around the structures given by "
+        "'--roi'.",
+    )
 
     return parser
 
@@ -67,6 +93,8 @@ def get_most_recent_log(directory, log_pattern="amap*.log"):
     :param log_pattern: String pattern that defines the log
     :return: Path to the most recent log file
     """
+    from natsort import natsorted
+
     directory = Path(directory)
     return natsorted(directory.glob(log_pattern))[-1]
 
@@ -92,6 +120,8 @@ def read_log_file(
     Default: ": "
     :return: A dict of the entries and labels
     """
+    from imlib.general.system import get_text_lines
+
     lines = get_text_lines(log_file)
     entries = {}
     for line in lines:
@@ -109,12 +139,71 @@ def prepare_load_nii(nii_path, memory=False):
     :param memory: Load data into memory
     :return: Numpy array in the correct coordinate space
     """
+    from brainio import brainio
+
     nii_path = str(nii_path)
     image = brainio.load_any(nii_path, as_numpy=memory)
     image = np.swapaxes(image, 2, 0)
     return image
 
 
+def prepare_load_multiscale(
+    image, name, source_files, pyramid_directory=None, labels=False
+):
+    """
+    Returns the resolution pyramid of an image (see amap.vis.pyramid), or
+    the image itself if pyramid_directory is None
+    :param image: Image in the correct coordinate space
+    :param str name: Name of the image, used to cache its pyramid
+    :param source_files: The file(s) the image is loaded from
+    :param pyramid_directory: Directory to cache the pyramid in
+    :param labels: Whether the image is a label image
+    :return: The image, or a list of its pyramid levels
+    """
+    if pyramid_directory is None:
+        return image
+    from amap.vis.pyramid import get_pyramid
+
+    if isinstance(source_files, (str, Path)):
+        source_files = [source_files]
+    return get_pyramid(
+        image, pyramid_directory, name, source_files, labels=labels
+    )
+
+
+def prepare_load_boundaries(boundaries_path, memory=False):
+    """
+    Loads a boundary image (nii, or sparse .npz) in the same coordinate space
+    as the raw data. Unless loaded into memory, the planes of a sparse image
+    are only decoded when they are displayed.
+    :param boundaries_path: Path to the boundary image
+    :param memory: Load data into memory
+    :return: Array in the correct coordinate space
+    """
+    if str(boundaries_path).endswith(".npz"):
+        from amap.vis.boundaries import SparseBoundaries
+
+        boundaries = SparseBoundaries(boundaries_path)
+        if memory:
+            return np.swapaxes(boundaries.to_array(), 2, 0)
+        return boundaries.to_dask()
+    return prepare_load_nii(boundaries_path, memory=memory)
+
+
+def get_boundaries_path(paths):
+    """
+    Returns the path of the boundary image, preferring the sparse image
+    :param paths: amap paths object
+    :return: Path to the boundary image, or None if there is none
+    """
+    for boundaries_path in (
+        paths.sparse_boundaries_file_path,
+        paths.boundaries_file_path,
+    ):
+        if Path(boundaries_path).exists():
+            return boundaries_path
+
+
 def load_additional_downsampled_images(
     viewer,
     amap_directory,
@@ -122,6 +211,7 @@ def load_additional_downsampled_images(
     search_string="downsampled_",
     extension=".nii",
     memory=False,
+    pyramid_directory=None,
 ):
     """
     Loads additional downsampled (i.e. from nii) images into napari viewer
@@ -132,6 +222,8 @@ def load_additional_downsampled_images(
     Default: "downampled_"
     :param extension: File extension of the downsampled images. Default: ".nii"
     :param memory: Load data into memory
+    :param pyramid_directory: If not None, display the images as resolution
+    pyramids, cached in this directory
     """
 
     amap_directory = Path(amap_directory)
@@ -149,19 +241,56 @@ def load_additional_downsampled_images(
             )
             name = file.name.strip(search_string).strip(extension)
             viewer.add_image(
-                prepare_load_nii(file, memory=memory), name=name,
+                prepare_load_multiscale(
+                    prepare_load_nii(file, memory=memory),
+                    name,
+                    file,
+                    pyramid_directory=pyramid_directory,
+                ),
+                name=name,
             )
 
 
-def add_raw_image(viewer, image_path, name):
+def load_raw_image(image_path):
+    """
+    Load a raw image as a virtual stack (only the planes or chunks that are
+    used are read)
+    :param image_path: Path to the raw data (directory of tiffs or chunk
+    store)
+    :return: The (dask) image, and the files it is read from
+    """
+    from amap.tools.chunk_store import (
+        ChunkStore,
+        is_chunk_store,
+        METADATA_NAME,
+    )
+
+    if is_chunk_store(image_path):
+        images = ChunkStore(image_path).to_dask()
+        paths = [Path(image_path, METADATA_NAME)]
+    else:
+        from napari.utils.io import magic_imread
+        from imlib.general.system import get_sorted_file_paths
+
+        paths = get_sorted_file_paths(image_path, file_extension=".tif")
+        images = magic_imread(paths, use_dask=True, stack=True)
+    return images, paths
+
+
+def add_raw_image(viewer, image_path, name, pyramid_directory=None):
     """
     Add a raw image (as a virtual stack) to the napari viewer
     :param viewer: Napari viewer object
-    :param image_path: Path to the raw data
+    :param image_path: Path to the raw data (directory of tiffs or chunk
+    store)
     :param str name: Name to give the data
+    :param pyramid_directory: If not None, display the image as a resolution
+    pyramid, cached in this directory
     """
-    paths = get_sorted_file_paths(image_path, file_extension=".tif")
-    images = magic_imread(paths, use_dask=True, stack=True)
+    images, paths = load_raw_image(image_path)
+    images = prepare_load_multiscale(
+        images, name, paths, pyramid_directory=pyramid_directory
+    )
     viewer.add_image(images, name=name, opacity=0.6, blending="additive")
 
 
@@ -181,6 +310,20 @@ def get_image_scales(log_entries, config_file):
     return z_scale, y_scale, x_scale
 
 
+def get_pyramid_directory(args):
+    """
+    Returns the directory to cache the resolution pyramids in, or None if
+    the images are not displayed as pyramids
+    :param args:
+    :return: Path to the pyramid directory, or None
+    """
+    if not args.multiscale:
+        return None
+    if args.pyramid_directory is not None:
+        return Path(args.pyramid_directory)
+    return Path(args.amap_directory, "pyramid")
+
+
 def display_raw(viewer, args):
     """
     Display raw data
@@ -195,17 +338,85 @@ def display_raw(viewer, args):
     log_entries = read_log_file(get_most_recent_log(args.amap_directory))
     config_file = Path(args.amap_directory, "config.conf")
     image_scales = get_image_scales(log_entries, config_file)
-    add_raw_image(viewer, log_entries["image_paths"], name="Raw data")
+    pyramid_directory = get_pyramid_directory(args)
+    add_raw_image(
+        viewer,
+        log_entries["image_paths"],
+        name="Raw data",
+        pyramid_directory=pyramid_directory,
+    )
 
     if args.raw_channels:
         for raw_image in args.raw_channels:
             name = Path(raw_image).name
             print(f"Found additional raw image to add to viewer: " f"{name}")
-            add_raw_image(viewer, raw_image, name=name)
+            add_raw_image(
+                viewer,
+                raw_image,
+                name=name,
+                pyramid_directory=pyramid_directory,
+            )
 
     return image_scales
 
 
+def display_roi(viewer, args, paths, structure_lookup):
+    """
+    Display the raw data at full resolution, with the annotations and their
+    boundaries, cropped to the structures given by "--roi"
+    :param viewer: napari viewer object
+    :param args:
+    :param paths: amap paths object
+    :param structure_lookup: StructureLookup of the atlas
+    :return: The annotations layer
+    """
+    from skimage.segmentation import find_boundaries
+    from vispy.color import Colormap
+    from amap.vis.roi import get_roi_structure_ids, crop_roi
+
+    log_entries = read_log_file(get_most_recent_log(args.amap_directory))
+    config_file = Path(args.amap_directory, "config.conf")
+    image_scales = get_image_scales(log_entries, config_file)
+    structure_ids = get_roi_structure_ids(args.roi, structure_lookup)
+
+    atlas = prepare_load_nii(paths.registered_atlas_path, memory=args.memory)
+    raw_image, _ = load_raw_image(log_entries["image_paths"])
+    raw_crop, atlas_crop, raw_bounds = crop_roi(
+        atlas,
+        raw_image,
+        structure_ids,
+        image_scales,
+        padding=args.roi_padding,
+    )
+    print(
+        f"Displaying the raw data in the region: {raw_bounds} "
+        f"(z, y, x) around: {args.roi}"
+    )
+    viewer.add_image(
+        raw_crop, name="Raw data", opacity=0.6, blending="additive"
+    )
+
+    if args.raw_channels:
+        box = tuple(slice(start, stop) for start, stop in raw_bounds)
+        for raw_image in args.raw_channels:
+            name = Path(raw_image).name
+            print(f"Found additional raw image to add to viewer: " f"{name}")
+            viewer.add_image(
+                np.asarray(load_raw_image(raw_image)[0][box]),
+                name=name,
+                opacity=0.6,
+                blending="additive",
+            )
+
+    viewer.add_image(
+        find_boundaries(atlas_crop, mode="inner").astype(np.uint8),
+        name="Outlines",
+        contrast_limits=[0, 1],
+        colormap=("label_red", Colormap(LABEL_RED_COLOURS)),
+    )
+    return viewer.add_labels(atlas_crop, name="Annotations", opacity=0.2)
+
+
 def display_downsampled(viewer, args, paths):
     """
     Display downsampled data
@@ -215,12 +426,22 @@ def display_downsampled(viewer, args, paths):
     :return:
     """
     image_scales = (1, 1, 1)
+    pyramid_directory = get_pyramid_directory(args)
     load_additional_downsampled_images(
-        viewer, args.amap_directory, paths, memory=args.memory
+        viewer,
+        args.amap_directory,
+        paths,
+        memory=args.memory,
+        pyramid_directory=pyramid_directory,
     )
 
     viewer.add_image(
-        prepare_load_nii(paths.downsampled_brain_path, memory=args.memory),
+        prepare_load_multiscale(
+            prepare_load_nii(paths.downsampled_brain_path, memory=args.memory),
+            "downsampled",
+            paths.downsampled_brain_path,
+            pyramid_directory=pyramid_directory,
+        ),
         name="Downsampled raw data",
     )
 
@@ -228,27 +449,43 @@ def display_downsampled(viewer, args, paths):
 
 
 def display_registration(
-    viewer, atlas, boundaries, image_scales, memory=False
+    viewer,
+    atlas,
+    boundaries,
+    image_scales,
+    memory=False,
+    pyramid_directory=None,
 ):
     """
     Display results of the registration
     :param viewer: napari viewer object
     :param atlas: Annotations in sample space
-    :param boundaries: Annotation boundaries in sample space
+    :param boundaries: Annotation boundaries in sample space (nii, or
+    sparse .npz)
     :param tuple image_scales: Scaling of images from annotations -> data
     :param memory: Load data into memory
+    :param pyramid_directory: If not None, display the annotations as a
+    resolution pyramid, cached in this directory
     """
+    from vispy.color import Colormap
+
     viewer.add_image(
-        prepare_load_nii(boundaries, memory=memory),
+        prepare_load_boundaries(boundaries, memory=memory),
         name="Outlines",
         contrast_limits=[0, 1],
-        colormap=("label_red", label_red),
+        colormap=("label_red", Colormap(LABEL_RED_COLOURS)),
         scale=image_scales,
     )
 
     # labels added last so on top
     labels = viewer.add_labels(
-        prepare_load_nii(atlas, memory=memory),
+        prepare_load_multiscale(
+            prepare_load_nii(atlas, memory=memory),
+            "annotations",
+            atlas,
+            pyramid_directory=pyramid_directory,
+            labels=True,
+        ),
         name="Annotations",
         opacity=0.2,
         scale=image_scales,
@@ -256,12 +493,53 @@ def display_registration(
     return labels
 
 
+def get_label_value(layer):
+    """
+    Get the value of a labels layer under the cursor
+    :param layer: napari labels layer
+    :return: The label, or None if the cursor is outside the layer
+    """
+    value = layer.get_value()
+    # for a multiscale (pyramid) layer, napari returns the level displayed,
+    # and the value
+    if getattr(layer, "multiscale", getattr(layer, "is_pyramid", False)):
+        if value is not None:
+            value = value[1]
+    return value
+
+
+def get_structure_message(value, structure_lookup):
+    """
+    Describe the structure of a label, to display when hovering over it
+    :param value: The label
+    :param structure_lookup: The amap.tools.structures.StructureLookup of
+    the atlas
+    :return: The message
+    """
+    if value != 0 and value is not None:
+        region = structure_lookup.get_name(value)
+        acronym = structure_lookup.get_acronym(value)
+        if region is None:
+            msg = "Unknown region"
+        elif acronym is None:
+            msg = f"{region}"
+        else:
+            msg = f"{region} ({acronym})"
+    else:
+        msg = "No label here!"
+    return msg
+
+
 def main():
     print("Starting amap viewer")
     args = parser().parse_args()
 
-    structures_path = get_structures_path()
-    structures_df = load_structures_as_df(structures_path)
+    import napari
+    from amap.tools.source_files import get_structures_path
+    from amap.tools.structures import StructureLookup
+
+    # built once, so that hovering over the labels is a dict lookup
+    structure_lookup = StructureLookup.from_file(get_structures_path())
 
     if not args.memory:
         print(
@@ -271,18 +549,22 @@ def main():
         )
 
     paths = Paths(args.amap_directory)
+    boundaries_path = get_boundaries_path(paths)
     with napari.gui_qt():
         v = napari.Viewer(title="amap viewer")
         if (
             Path(paths.registered_atlas_path).exists()
-            and Path(paths.boundaries_file_path).exists()
+            and boundaries_path is not None
         ):
 
-            if args.raw:
-                image_scales = display_raw(v, args)
+            if args.roi:
+                labels = display_roi(v, args, paths, structure_lookup)
 
             else:
-                if Path(paths.downsampled_brain_path).exists():
+                if args.raw:
+                    image_scales = display_raw(v, args)
+
+                elif Path(paths.downsampled_brain_path).exists():
                     image_scales = display_downsampled(v, args, paths)
 
                 else:
@@ -293,26 +575,20 @@ def main():
                         f"directory and that amap has completed. "
                     )
 
-            labels = display_registration(
-                v,
-                paths.registered_atlas_path,
-                paths.boundaries_file_path,
-                image_scales,
-                memory=args.memory,
-            )
+                labels = display_registration(
+                    v,
+                    paths.registered_atlas_path,
+                    boundaries_path,
+                    image_scales,
+                    memory=args.memory,
+                    pyramid_directory=get_pyramid_directory(args),
+                )
 
             @labels.mouse_move_callbacks.append
             def get_connected_component_shape(layer, event):
-                val = layer.get_value()
-                if val != 0 and val is not None:
-                    try:
-                        region = atlas_value_to_name(val, structures_df)
-                        msg = f"{region}"
-                    except UnknownAtlasValue:
-                        msg = "Unknown region"
-                else:
-                    msg = "No label here!"
-                layer.help = msg
+                layer.help = get_structure_message(
+                    get_label_value(layer), structure_lookup
+                )
 
         else:
             raise FileNotFoundError(
@@ -0,0 +1,104 @@
+"""
+filter
+======
+
+Benchmark of the registration filter (despeckle and pseudo flatfield),
+comparing the per-plane loop against the batched (vectorised) engine.
+
+Usage:
+    python benchmarks/filter.py
+    python benchmarks/filter.py --image path/to/downsampled.nii
+
+e.g. with tests/data/registration_output/downsampled.nii
+"""
+
+import time
+import numpy as np
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from brainio import brainio
+
+from amap.register.brain_processor import BrainProcessor
+
+
+def parser():
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        "--image",
+        dest="image",
+        type=str,
+        help="Image to filter. If not given, a random image of size "
+        "'--shape' is used.",
+    )
+    parser.add_argument(
+        "--shape",
+        dest="shape",
+        type=int,
+        nargs=3,
+        default=[800, 1140, 132],
+        help="Shape of the synthetic image (planes along the last axis). "
+        "The default is roughly a 10um atlas-sized brain.",
+    )
+    parser.add_argument(
+        "--batch-sizes",
+        dest="batch_sizes",
+        type=int,
+        nargs="+",
+        default=[1, 8, 32],
+        help="Number of planes to filter at once with the batched engine",
+    )
+    parser.add_argument(
+        "--repeats",
+        dest="repeats",
+        type=int,
+        default=3,
+        help="Number of times to repeat each measurement (best is kept)",
+    )
+    return parser
+
+
+def get_image(image_path, shape):
+    if image_path is not None:
+        return brainio.load_any(image_path, as_numpy=True)
+    else:
+        rng = np.random.default_rng(0)
+        return rng.integers(0, 2**12, shape, dtype=np.uint16)
+
+
+def time_filter(brain, repeats, **kwargs):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        filtered = BrainProcessor.filter_for_registration(
+            brain.copy(), **kwargs
+        )
+        times.append(time.perf_counter() - start)
+    return min(times), filtered
+
+
+def main():
+    args = parser().parse_args()
+    brain = get_image(args.image, args.shape)
+    print(f"Image shape: {brain.shape}, dtype: {brain.dtype}")
+
+    reference_time, reference = time_filter(brain, args.repeats)
+    print(f"{'mode':<28}{'time (s)':>10}{'speedup':>10}{'max diff':>10}")
+    print(f"{'per-plane loop':<28}{reference_time:>10.3f}{1:>10.2f}{0:>10}")
+
+    for dtype in (np.float64, np.float32):
+        for batch_size in args.batch_sizes:
+            run_time, filtered = time_filter(
+                brain, args.repeats, batch_size=batch_size, dtype=dtype
+            )
+            max_difference = np.abs(
+                filtered.astype(np.int32) - reference.astype(np.int32)
+            ).max()
+            mode = f"batched {batch_size} ({np.dtype(dtype).name})"
+            print(
+                f"{mode:<28}{run_time:>10.3f}"
+                f"{reference_time / run_time:>10.2f}{max_difference:>10}"
+            )
+
+
+if __name__ == "__main__":
+    main()
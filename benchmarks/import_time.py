@@ -0,0 +1,246 @@
+"""
+import_time
+===========
+
+Benchmark of the start-up time of the amap command line programs. Each
+entry point module is imported in a fresh interpreter with
+"python -X importtime", and the time taken to import it, and to print its
+"--help", are reported, with any heavy libraries (e.g. napari or pandas)
+that were imported. These should only be imported once a command needs
+them, so importing one is reported as a regression, as is an import that
+has slowed down by more than the tolerance since the baseline.
+
+Usage:
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --save-baseline import_baseline.json
+    python benchmarks/import_time.py --baseline import_baseline.json
+"""
+
+import sys
+import json
+import time
+import subprocess
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+# The module of each entry point
+ENTRY_POINTS = (
+    ("amap", "amap.cli"),
+    ("amap_vis", "amap.vis.vis"),
+    ("amap_download", "amap.download.cli"),
+)
+
+# Libraries that are slow to import, and are only needed once a command
+# runs (not to parse its arguments)
+HEAVY_MODULES = (
+    "napari",
+    "vispy",
+    "brainio",
+    "nibabel",
+    "pandas",
+    "skimage",
+    "scipy",
+    "dask",
+    "tifffile",
+    "micrometa",
+    "fancylog",
+    "pkg_resources",
+)
+
+
+def parser():
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        "--repeats",
+        dest="repeats",
+        type=int,
+        default=5,
+        help="How many times to import each module. The fastest time is "
+        "reported, as it is the least affected by other processes.",
+    )
+    parser.add_argument(
+        "--output",
+        dest="output",
+        type=str,
+        default=None,
+        help="Save the results to this JSON file",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        dest="save_baseline",
+        type=str,
+        default=None,
+        help="Save the results as a baseline to this JSON file",
+    )
+    parser.add_argument(
+        "--baseline",
+        dest="baseline",
+        type=str,
+        default=None,
+        help="Compare the results to this baseline JSON file",
+    )
+    parser.add_argument(
+        "--tolerance",
+        dest="tolerance",
+        type=float,
+        default=0.5,
+        help="Fraction by which an import may be slower than the baseline "
+        "before it is reported as a regression",
+    )
+    return parser
+
+
+def parse_import_times(importtime_output):
+    """
+    Parse the output of "python -X importtime".
+
+    :param str importtime_output: The standard error of the interpreter
+    :return: dict of {module: cumulative import time (s)}
+    :rtype: dict
+    """
+    import_times = {}
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, module = line[len("import time:") :].split("|")
+        if cumulative.strip().isdigit():
+            # in microseconds
+            import_times[module.strip()] = int(cumulative) / 1e6
+    return import_times
+
+
+def time_import(module):
+    """
+    Import a module in a fresh interpreter.
+
+    :param str module: The module
+    :return: The time taken to import it (s), and the sorted heavy modules
+        that were imported with it
+    :rtype: tuple
+    """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    if process.returncode != 0:
+        raise RuntimeError(f"Could not import {module}:\n{process.stderr}")
+    import_times = parse_import_times(process.stderr)
+    heavy_modules = sorted(
+        {
+            name.split(".")[0]
+            for name in import_times
+            if name.split(".")[0] in HEAVY_MODULES
+        }
+    )
+    return import_times[module], heavy_modules
+
+
+def time_help(module):
+    """
+    Time "python -m <module> --help" (i.e. starting the program, and
+    building and printing its argument parser).
+
+    :param str module: The module
+    :return: The wall time (s)
+    :rtype: float
+    """
+    start_time = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-m", module, "--help"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+    return time.perf_counter() - start_time
+
+
+def run_benchmarks(repeats=5):
+    results = []
+    for program, module in ENTRY_POINTS:
+        import_times = []
+        heavy_modules = []
+        for _ in range(repeats):
+            import_time, heavy_modules = time_import(module)
+            import_times.append(import_time)
+        results.append(
+            {
+                "program": program,
+                "module": module,
+                "import_time_s": min(import_times),
+                "help_time_s": min(time_help(module) for _ in range(repeats)),
+                "heavy_modules": heavy_modules,
+            }
+        )
+    return results
+
+
+def print_results(results):
+    print(
+        f"{'program':<15}{'module':<20}{'import (s)':>11}{'--help (s)':>11}"
+        f"  heavy modules"
+    )
+    for result in results:
+        print(
+            f"{result['program']:<15}{result['module']:<20}"
+            f"{result['import_time_s']:>11.3f}{result['help_time_s']:>11.3f}"
+            f"  {', '.join(result['heavy_modules']) or '-'}"
+        )
+
+
+def compare_to_baseline(results, baseline_path, tolerance=0.5):
+    """
+    Compare the import time of each entry point to the baseline.
+
+    :return: The number of entry points that have slowed down by more than
+        the tolerance
+    :rtype: int
+    """
+    with open(baseline_path, "r") as baseline_file:
+        baseline = {
+            result["module"]: result for result in json.load(baseline_file)
+        }
+    n_regressions = 0
+    print(f"\nComparison with baseline: {baseline_path}")
+    print(f"{'program':<15}{'baseline (s)':>14}{'import (s)':>11}{'ratio':>8}")
+    for result in results:
+        if result["module"] not in baseline:
+            continue
+        baseline_time = baseline[result["module"]]["import_time_s"]
+        ratio = result["import_time_s"] / baseline_time
+        regression = ratio > 1 + tolerance
+        n_regressions += regression
+        print(
+            f"{result['program']:<15}{baseline_time:>14.3f}"
+            f"{result['import_time_s']:>11.3f}{ratio:>8.2f}"
+            + ("  REGRESSION" if regression else "")
+        )
+    return n_regressions
+
+
+def main():
+    args = parser().parse_args()
+    results = run_benchmarks(repeats=args.repeats)
+    print_results(results)
+    for output_path in (args.output, args.save_baseline):
+        if output_path is not None:
+            with open(output_path, "w") as output_file:
+                json.dump(results, output_file, indent=4)
+
+    n_heavy = sum(bool(result["heavy_modules"]) for result in results)
+    if n_heavy:
+        print(f"{n_heavy} entry points import heavy modules")
+    n_regressions = 0
+    if args.baseline is not None:
+        n_regressions = compare_to_baseline(
+            results, args.baseline, tolerance=args.tolerance
+        )
+        if n_regressions:
+            print(f"{n_regressions} entry points are slower than the baseline")
+    if n_heavy or n_regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
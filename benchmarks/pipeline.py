@@ -0,0 +1,634 @@
+"""
+pipeline
+========
+
+End to end benchmark of the amap pipeline, stage by stage, on the bundled
+test brain (tests/data/brain) and on synthetic brains of increasing size.
+It runs offline: a synthetic atlas is generated rather than downloaded.
+
+Each stage is run in its own process (so that its peak memory can be
+measured), with each of the given numbers of threads, and the time taken,
+throughput (voxels/s), peak memory, CPU utilisation and the speedup over
+the fewest threads are reported. The NiftyReg stages are skipped if the
+NiftyReg binaries are not available.
+
+The results can be saved as a baseline, and later runs compared against
+it. The comparison exits with an error if any stage has slowed down by
+more than the tolerance.
+
+Usage:
+    python benchmarks/pipeline.py
+    python benchmarks/pipeline.py --scales 1 2 4 --threads 1 2 4 8
+    python benchmarks/pipeline.py --save-baseline baseline.json
+    python benchmarks/pipeline.py --baseline baseline.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+
+import numpy as np
+import tifffile
+
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, SUPPRESS
+from brainio import brainio
+
+from amap.utils.paths import Paths
+from amap.utils.resources import execute_command
+
+BUNDLED_BRAIN = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "tests",
+    "data",
+    "brain",
+)
+# pixel sizes (um) of the bundled brain, as used by the integration test
+BUNDLED_PIXEL_SIZES = (40, 40, 50)
+BUNDLED_ORIENTATION = "coronal"
+
+# The stages, and whether they use the thread budget
+STAGES = (
+    ("load_downsample", True),
+    ("filter", True),
+    ("atlas", False),
+    ("affine", True),
+    ("freeform", True),
+    ("inverse_transform", True),
+    ("segment", True),
+    ("hemispheres", True),
+    ("volumes", False),
+    ("boundaries", False),
+)
+NIFTYREG_STAGES = (
+    "affine",
+    "freeform",
+    "inverse_transform",
+    "segment",
+    "hemispheres",
+)
+
+SYNTHETIC_ATLAS_CONFIG = """[atlas]
+    base_folder = '{base_folder}'
+    atlas_name = 'annotations.nii'
+    brain_name = 'brain_filtered.nii'
+    hemispheres_name = 'hemispheres.nii'
+    structures_name = 'structures.csv'
+    orientation = 'horizontal'
+    left_hemisphere_value = 2
+    right_hemisphere_value = 1
+
+    [[pixel_size]]
+        x = {pixel_size}
+        y = {pixel_size}
+        z = {pixel_size}
+"""
+
+
+def parser():
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        "--scales",
+        dest="scales",
+        type=int,
+        nargs="*",
+        default=[1, 2],
+        help="Sizes of the synthetic brains, as multiples of the bundled "
+        "brain along each axis of the planes (the number of planes is "
+        "scaled too). No synthetic brains are used if none are given.",
+    )
+    parser.add_argument(
+        "--no-bundled",
+        dest="no_bundled",
+        action="store_true",
+        help="Don't benchmark the bundled test brain",
+    )
+    parser.add_argument(
+        "--threads",
+        dest="threads",
+        type=int,
+        nargs="+",
+        default=[1, os.cpu_count()],
+        help="Numbers of threads to run the multithreaded stages with",
+    )
+    parser.add_argument(
+        "--stages",
+        dest="stages",
+        type=str,
+        nargs="+",
+        default=[name for name, _ in STAGES],
+        choices=[name for name, _ in STAGES],
+        help="Stages to benchmark (the earlier stages are always run, to "
+        "produce their inputs)",
+    )
+    parser.add_argument(
+        "--atlas-shape",
+        dest="atlas_shape",
+        type=int,
+        nargs=3,
+        default=[114, 132, 80],
+        help="Shape of the synthetic atlas (roughly that of a 100um atlas)",
+    )
+    parser.add_argument(
+        "--atlas-pixel-size",
+        dest="atlas_pixel_size",
+        type=float,
+        default=100,
+        help="Pixel size (um) of the synthetic atlas",
+    )
+    parser.add_argument(
+        "--work-dir",
+        dest="work_dir",
+        type=str,
+        default=None,
+        help="Directory for the benchmark data and outputs. Defaults to a "
+        "temporary directory, which is removed afterwards.",
+    )
+    parser.add_argument(
+        "--output",
+        dest="output",
+        type=str,
+        default=None,
+        help="Save the results to this JSON file",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        dest="save_baseline",
+        type=str,
+        default=None,
+        help="Save the results as a baseline to this JSON file",
+    )
+    parser.add_argument(
+        "--baseline",
+        dest="baseline",
+        type=str,
+        default=None,
+        help="Compare the results to this baseline JSON file",
+    )
+    parser.add_argument(
+        "--tolerance",
+        dest="tolerance",
+        type=float,
+        default=0.2,
+        help="Fraction by which a stage may be slower than the baseline "
+        "before it is reported as a regression",
+    )
+    # used internally, to run a single stage in a separate process
+    parser.add_argument("--run-stage", dest="run_stage", help=SUPPRESS)
+    parser.add_argument("--dataset", dest="dataset", help=SUPPRESS)
+    parser.add_argument(
+        "--n-threads", dest="n_threads", type=int, default=1, help=SUPPRESS
+    )
+    return parser
+
+
+def make_synthetic_atlas(atlas_directory, shape, pixel_size, n_regions=4):
+    """
+    Make an atlas of an ellipsoidal brain, divided into n_regions ** 3
+    blocks, with its config file.
+
+    :return: The path of the config file
+    """
+    os.makedirs(atlas_directory, exist_ok=True)
+    coordinates = np.meshgrid(
+        *[np.linspace(-1, 1, size) for size in shape], indexing="ij"
+    )
+    inside = sum(coordinate ** 2 for coordinate in coordinates) < 0.8
+
+    region = np.zeros(shape, dtype=np.int32)
+    for coordinate in coordinates:
+        bins = np.clip(
+            ((coordinate + 1) / 2 * n_regions).astype(int), 0, n_regions - 1
+        )
+        region = region * n_regions + bins
+    annotations = np.where(inside, region + 1, 0).astype(np.uint32)
+    hemispheres = np.where(coordinates[2] < 0, 2, 1).astype(np.uint8)
+    brain = np.where(inside, 1000 + 100 * (annotations % 7), 0).astype(
+        np.uint16
+    )
+
+    scale = (pixel_size / 1000,) * 3
+    for image, name in (
+        (annotations, "annotations.nii"),
+        (hemispheres, "hemispheres.nii"),
+        (brain, "brain_filtered.nii"),
+    ):
+        brainio.to_nii(image, os.path.join(atlas_directory, name), scale)
+
+    with open(os.path.join(atlas_directory, "structures.csv"), "w") as f:
+        f.write("name,acronym,id,structure_id_path\n")
+        f.write('root,root,997,"/997/"\n')
+        for label in range(1, n_regions ** 3 + 1):
+            f.write(f'region {label},R{label},{label},"/997/{label}/"\n')
+
+    config_path = os.path.join(atlas_directory, "atlas.conf")
+    with open(config_path, "w") as config_file:
+        config_file.write(
+            SYNTHETIC_ATLAS_CONFIG.format(
+                base_folder=atlas_directory, pixel_size=pixel_size
+            )
+        )
+    return config_path
+
+
+def make_synthetic_brain(brain_directory, scale, seed=0):
+    """
+    Make a directory of planes of an ellipsoidal "brain" with noise, scale
+    times the size of the bundled brain along each axis.
+    """
+    os.makedirs(brain_directory, exist_ok=True)
+    n_planes = len(os.listdir(BUNDLED_BRAIN)) * scale
+    plane_shape = [
+        size * scale
+        for size in brainio.load_any(
+            os.path.join(BUNDLED_BRAIN, sorted(os.listdir(BUNDLED_BRAIN))[0])
+        ).shape
+    ]
+    rng = np.random.default_rng(seed)
+    y, x = np.meshgrid(
+        *[np.linspace(-1, 1, size) for size in plane_shape], indexing="ij"
+    )
+    for idx, z in enumerate(np.linspace(-1, 1, n_planes)):
+        inside = (x ** 2 + y ** 2 + z ** 2) < 0.8
+        plane = rng.integers(0, 200, plane_shape, dtype=np.uint16)
+        plane[inside] += 2000
+        tifffile.imwrite(
+            os.path.join(brain_directory, f"plane_{idx:05d}.tif"), plane
+        )
+
+
+def prepare_datasets(args, work_dir):
+    """
+    Make the synthetic atlas and brains, and describe each dataset.
+
+    :return: List of dataset dicts
+    """
+    config_path = make_synthetic_atlas(
+        os.path.join(work_dir, "atlas"),
+        args.atlas_shape,
+        args.atlas_pixel_size,
+    )
+    datasets = []
+    if not args.no_bundled:
+        datasets.append(("bundled", BUNDLED_BRAIN, None))
+    for scale in args.scales:
+        brain_directory = os.path.join(work_dir, f"synthetic_x{scale}", "raw")
+        print(f"Making synthetic brain (scale: {scale})")
+        make_synthetic_brain(brain_directory, scale)
+        datasets.append((f"synthetic_x{scale}", brain_directory, scale))
+
+    described = []
+    for name, brain_path, scale in datasets:
+        output_folder = os.path.join(work_dir, name, "output")
+        os.makedirs(output_folder, exist_ok=True)
+        n_planes = len(os.listdir(brain_path))
+        plane_shape = brainio.load_any(
+            os.path.join(brain_path, sorted(os.listdir(brain_path))[0])
+        ).shape
+        dataset = {
+            "name": name,
+            "brain_path": brain_path,
+            "n_voxels": int(n_planes * np.prod(plane_shape)),
+            "pixel_sizes": BUNDLED_PIXEL_SIZES,
+            "orientation": BUNDLED_ORIENTATION,
+            "config": config_path,
+            "output_folder": output_folder,
+        }
+        dataset_path = os.path.join(work_dir, name, "dataset.json")
+        with open(dataset_path, "w") as dataset_file:
+            json.dump(dataset, dataset_file)
+        dataset["path"] = dataset_path
+        described.append(dataset)
+    return described
+
+
+def run_stage(stage, dataset, n_threads):
+    """
+    Run a single stage (in this process).
+
+    :return: dict of the time taken (s) and number of voxels processed
+    """
+    # imported here so that only the stage is timed, not the imports
+    import nibabel as nb
+    from amap.config.atlas import Atlas
+    from amap.main import flips
+    from amap.register.brain_processor import BrainProcessor
+    from amap.register.volume import calculate_volumes
+    from amap.vis.boundaries import boundaries
+
+    paths = Paths(dataset["output_folder"])
+    atlas = Atlas(dataset["config"], dest_folder=dataset["output_folder"])
+    x_pixel_um, y_pixel_um, z_pixel_um = dataset["pixel_sizes"]
+
+    if stage in NIFTYREG_STAGES:
+        from amap.register.brain_registration import BrainRegistration
+        from amap.register.registration_params import RegistrationParams
+
+        brain_reg = BrainRegistration(
+            dataset["config"],
+            paths,
+            RegistrationParams(dataset["config"]),
+            n_processes=n_threads,
+        )
+        function, n_voxels = {
+            "affine": brain_reg.register_affine,
+            "freeform": brain_reg.register_freeform,
+            "inverse_transform": brain_reg.generate_inverse_transforms,
+            "segment": brain_reg.segment,
+            "hemispheres": brain_reg.register_hemispheres,
+        }[stage], _n_voxels(paths.tmp__downsampled_filtered)
+        start_time = time.perf_counter()
+        function()
+
+    elif stage == "load_downsample":
+        n_voxels = dataset["n_voxels"]
+        start_time = time.perf_counter()
+        brain = BrainProcessor(
+            atlas,
+            dataset["brain_path"],
+            dataset["output_folder"],
+            x_pixel_um,
+            y_pixel_um,
+            z_pixel_um,
+            original_orientation=dataset["orientation"],
+            load_parallel=n_threads > 1,
+            load_atlas=False,
+            n_free_cpus=max(0, os.cpu_count() - n_threads),
+        )
+        brain.save(paths.downsampled_brain_path)
+
+    elif stage == "filter":
+        image = brainio.load_nii(paths.downsampled_brain_path)
+        data = np.asanyarray(image.dataobj)
+        n_voxels = data.size
+        start_time = time.perf_counter()
+        filtered = BrainProcessor.filter_for_registration(
+            data, n_processes=n_threads, batch_size=32
+        )
+        brainio.to_nii(
+            nb.Nifti1Image(filtered, image.affine, image.header),
+            paths.tmp__downsampled_filtered,
+        )
+
+    elif stage == "atlas":
+        n_voxels = 3 * _n_voxels(atlas.get_path())
+        start_time = time.perf_counter()
+        atlas.load_all()
+        atlas.reorientate_to_sample(dataset["orientation"])
+        atlas.flip(flips[dataset["orientation"]])
+        atlas.save_all()
+
+    elif stage == "volumes":
+        atlas_path, hemispheres_path = _get_segmentation_paths(paths)
+        n_voxels = _n_voxels(atlas_path)
+        start_time = time.perf_counter()
+        calculate_volumes(
+            atlas_path,
+            hemispheres_path,
+            atlas.get_structures_path(),
+            dataset["config"],
+            paths.volume_csv_path,
+            left_hemisphere_value=atlas.get_left_hemisphere_value(),
+            right_hemisphere_value=atlas.get_right_hemisphere_value(),
+        )
+
+    elif stage == "boundaries":
+        atlas_path, _ = _get_segmentation_paths(paths)
+        n_voxels = _n_voxels(atlas_path)
+        start_time = time.perf_counter()
+        image = brainio.load_nii(atlas_path)
+        boundaries(
+            np.asanyarray(image.dataobj),
+            paths.boundaries_file_path,
+            atlas_scale=image.header.get_zooms(),
+            transformation_matrix=image.affine,
+        )
+    else:
+        raise ValueError(f"Unknown stage: {stage}")
+
+    return {"time_s": time.perf_counter() - start_time, "n_voxels": n_voxels}
+
+
+def _n_voxels(image_path):
+    return int(np.prod(brainio.load_nii(str(image_path)).shape))
+
+
+def _get_segmentation_paths(paths):
+    # the registered atlas if NiftyReg was run, otherwise the atlas itself
+    if os.path.exists(paths.registered_atlas_img_path) and os.path.exists(
+        paths.registered_hemispheres_img_path
+    ):
+        return (
+            paths.registered_atlas_img_path,
+            paths.registered_hemispheres_img_path,
+        )
+    return paths.annotations, paths.hemispheres
+
+
+def niftyreg_available():
+    try:
+        from imlib.source.niftyreg_binaries import get_niftyreg_binaries
+
+        return os.path.isdir(get_niftyreg_binaries())
+    except Exception:
+        return False
+
+
+def benchmark_stage(stage, dataset, n_threads, work_dir):
+    """
+    Run a stage in a separate process, and measure it.
+
+    :return: The result. If the stage failed, only its error is recorded.
+    :rtype: dict
+    """
+    log_path = os.path.join(work_dir, f"{stage}.log")
+    error_path = os.path.join(work_dir, f"{stage}.err")
+    cmd = (
+        f'"{sys.executable}" "{os.path.abspath(__file__)}" '
+        f'--run-stage {stage} --dataset "{dataset["path"]}" '
+        f"--n-threads {n_threads}"
+    )
+    # limit the threads used by numpy and NiftyReg (OpenMP)
+    environment = dict(
+        os.environ,
+        OMP_NUM_THREADS=str(n_threads),
+        MKL_NUM_THREADS=str(n_threads),
+    )
+    benchmark = {
+        "dataset": dataset["name"],
+        "stage": stage,
+        "n_threads": n_threads,
+    }
+    try:
+        usage = execute_command(cmd, log_path, error_path, env=environment)
+    except Exception as err:
+        print(f"Stage: {stage} failed; {err}")
+        # the last line of the standard error is usually the exception
+        with open(error_path, "r") as error_file:
+            errors = error_file.read().strip().splitlines()
+        return dict(
+            benchmark,
+            error=errors[-1] if errors else f"{type(err).__name__}: {err}",
+        )
+
+    with open(log_path, "r") as log_file:
+        result = json.loads(log_file.read().strip().splitlines()[-1])
+    return {
+        **benchmark,
+        "error": None,
+        "time_s": result["time_s"],
+        "n_voxels": result["n_voxels"],
+        "voxels_per_s": result["n_voxels"] / result["time_s"],
+        "peak_rss_mb": usage.get("peak_rss_mb"),
+        "cpu_utilisation": usage.get("cpu_utilisation"),
+    }
+
+
+def run_benchmarks(args, work_dir):
+    datasets = prepare_datasets(args, work_dir)
+    run_niftyreg = niftyreg_available()
+    if not run_niftyreg:
+        print("NiftyReg is not available, skipping the registration stages")
+
+    # the earlier stages produce the inputs of the later ones
+    last_stage = max(
+        idx for idx, (name, _) in enumerate(STAGES) if name in args.stages
+    )
+    results = []
+    for dataset in datasets:
+        for name, threaded in STAGES[: last_stage + 1]:
+            if name in NIFTYREG_STAGES and not run_niftyreg:
+                continue
+            # only the stages asked for are run with each number of threads
+            if threaded and name in args.stages:
+                thread_counts = sorted(args.threads)
+            else:
+                thread_counts = [max(args.threads)]
+            for n_threads in thread_counts:
+                print(f"{dataset['name']}: {name} ({n_threads} threads)")
+                result = benchmark_stage(name, dataset, n_threads, work_dir)
+                # the stages the others depend on are reported if they fail
+                if name in args.stages or result["error"] is not None:
+                    results.append(result)
+    add_speedups(results)
+    return results
+
+
+def add_speedups(results):
+    # speedup relative to the same stage with the fewest threads
+    results = [result for result in results if result["error"] is None]
+    fewest = {}
+    for result in results:
+        key = (result["dataset"], result["stage"])
+        if key not in fewest or result["n_threads"] < fewest[key]["n_threads"]:
+            fewest[key] = result
+    for result in results:
+        reference = fewest[(result["dataset"], result["stage"])]
+        result["speedup"] = reference["time_s"] / result["time_s"]
+
+
+def print_results(results):
+    print(
+        f"{'dataset':<14}{'stage':<19}{'threads':>8}{'time (s)':>10}"
+        f"{'Mvoxels/s':>11}{'peak (MB)':>11}{'cores used':>12}"
+        f"{'speedup':>9}"
+    )
+    for result in results:
+        if result["error"] is not None:
+            print(
+                f"{result['dataset']:<14}{result['stage']:<19}"
+                f"{result['n_threads']:>8}  FAILED: {result['error']}"
+            )
+            continue
+        peak = result["peak_rss_mb"]
+        cores = result["cpu_utilisation"]
+        print(
+            f"{result['dataset']:<14}{result['stage']:<19}"
+            f"{result['n_threads']:>8}{result['time_s']:>10.2f}"
+            f"{result['voxels_per_s'] / 1e6:>11.2f}"
+            f"{'' if peak is None else f'{peak:.0f}':>11}"
+            f"{'' if cores is None else f'{cores:.2f}':>12}"
+            f"{result['speedup']:>9.2f}"
+        )
+
+
+def compare_to_baseline(results, baseline_path, tolerance=0.2):
+    """
+    Compare the time taken by each stage to the baseline.
+
+    :return: The number of stages that have slowed down by more than the
+        tolerance
+    :rtype: int
+    """
+    with open(baseline_path, "r") as baseline_file:
+        baseline = {
+            (result["dataset"], result["stage"], result["n_threads"]): result
+            for result in json.load(baseline_file)
+            if result.get("error") is None
+        }
+    n_regressions = 0
+    print(f"\nComparison with baseline: {baseline_path}")
+    print(
+        f"{'dataset':<14}{'stage':<19}{'threads':>8}{'baseline (s)':>14}"
+        f"{'time (s)':>10}{'ratio':>8}"
+    )
+    for result in results:
+        key = (result["dataset"], result["stage"], result["n_threads"])
+        if key not in baseline or result["error"] is not None:
+            continue
+        ratio = result["time_s"] / baseline[key]["time_s"]
+        regression = ratio > 1 + tolerance
+        n_regressions += regression
+        print(
+            f"{result['dataset']:<14}{result['stage']:<19}"
+            f"{result['n_threads']:>8}{baseline[key]['time_s']:>14.2f}"
+            f"{result['time_s']:>10.2f}{ratio:>8.2f}"
+            + ("  REGRESSION" if regression else "")
+        )
+    return n_regressions
+
+
+def main():
+    args = parser().parse_args()
+    if args.run_stage is not None:
+        with open(args.dataset, "r") as dataset_file:
+            dataset = json.load(dataset_file)
+        result = run_stage(args.run_stage, dataset, args.n_threads)
+        print(json.dumps(result))
+        return
+
+    if args.work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix="amap_benchmark_")
+    else:
+        work_dir = os.path.abspath(args.work_dir)
+        os.makedirs(work_dir, exist_ok=True)
+    try:
+        results = run_benchmarks(args, work_dir)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print()
+    print_results(results)
+    for output_path in (args.output, args.save_baseline):
+        if output_path is not None:
+            with open(output_path, "w") as output_file:
+                json.dump(results, output_file, indent=4)
+    n_failures = sum(result["error"] is not None for result in results)
+    if n_failures:
+        print(f"{n_failures} stages failed")
+    n_regressions = 0
+    if args.baseline is not None:
+        n_regressions = compare_to_baseline(
+            results, args.baseline, tolerance=args.tolerance
+        )
+        if n_regressions:
+            print(f"{n_regressions} stages are slower than the baseline")
+    if n_failures or n_regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -23,6 +23,7 @@ requirements = [
     "napari>=0.2.8",
     "scikit-image",
     "luddite",
+    "pyyaml",
 ]
 
 
@@ -48,14 +49,19 @@ setup(
         ]
     },
     python_requires=">=3.6",
-    packages=find_namespace_packages(exclude=("docs", "tests*")),
+    packages=find_namespace_packages(
+        exclude=("docs", "tests*", "benchmarks*")
+    ),
     include_package_data=True,
     entry_points={
         "console_scripts": [
             "amap = amap.cli:main",
+            "amap_batch = amap.batch:main",
+            "amap_sweep = amap.sweep:main",
             "amap_gui = amap.cli:gui",
             "amap_download = amap.download.cli:main",
             "amap_vis = amap.vis.vis:main",
+            "amap_ingest = amap.ingest:main",
         ]
     },
     project_urls={
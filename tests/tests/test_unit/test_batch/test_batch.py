@@ -0,0 +1,99 @@
+import os
+from datetime import timedelta
+
+import pytest
+
+import amap.batch
+from amap.batch import (
+    read_manifest,
+    get_thread_budget,
+    register_job,
+    ManifestError,
+)
+
+defaults = {
+    "x_pixel_um": 2,
+    "y_pixel_um": 2,
+    "z_pixel_um": None,
+    "orientation": "coronal",
+    "flip_x": False,
+    "flip_y": False,
+    "flip_z": False,
+}
+
+
+def test_read_manifest(tmpdir):
+    tmpdir = str(tmpdir)
+    csv_manifest = os.path.join(tmpdir, "manifest.csv")
+    with open(csv_manifest, "w") as manifest:
+        manifest.write(
+            "image_paths,registration_output_folder,z_pixel_um,"
+            "orientation,flip_z,downsample\n"
+            "brain_0,output_0,5,sagittal,true,ch1;ch2\n"
+            "brain_1,output_1,10,,,\n"
+        )
+    yaml_manifest = os.path.join(tmpdir, "manifest.yaml")
+    with open(yaml_manifest, "w") as manifest:
+        manifest.write(
+            "brains:\n"
+            "  - image_paths: brain_0\n"
+            "    registration_output_folder: output_0\n"
+            "    z_pixel_um: 5\n"
+            "    orientation: sagittal\n"
+            "    flip_z: true\n"
+            "    downsample: [ch1, ch2]\n"
+            "  - image_paths: brain_1\n"
+            "    registration_output_folder: output_1\n"
+            "    z_pixel_um: 10\n"
+        )
+
+    for manifest in (csv_manifest, yaml_manifest):
+        jobs = read_manifest(manifest, defaults)
+        assert len(jobs) == 2
+        assert jobs[0]["image_paths"] == os.path.join(tmpdir, "brain_0")
+        assert jobs[0]["x_pixel_um"] == 2
+        assert jobs[0]["z_pixel_um"] == 5
+        assert jobs[0]["orientation"] == "sagittal"
+        assert jobs[0]["flip_z"] is True
+        assert jobs[0]["additional_images_downsample"] == {
+            "ch1": os.path.join(tmpdir, "ch1"),
+            "ch2": os.path.join(tmpdir, "ch2"),
+        }
+        assert jobs[1]["orientation"] == "coronal"
+        assert jobs[1]["flip_z"] is False
+        assert jobs[1]["additional_images_downsample"] == {}
+
+    with pytest.raises(ManifestError):
+        read_manifest(csv_manifest, dict(defaults, x_pixel_um=None))
+
+
+def test_get_thread_budget():
+    assert get_thread_budget(4, threads_per_job=3) == 3
+    assert get_thread_budget(10 ** 6, n_free_cpus=0) == 1
+
+
+def test_register_job(tmpdir, monkeypatch):
+    def register(registration_config, image_paths, *args, **kwargs):
+        if image_paths == "broken":
+            raise ValueError("broken brain")
+
+    monkeypatch.setattr(amap.batch, "register", register)
+    monkeypatch.setattr(amap.batch, "_atlas", None, raising=False)
+    registration_config = str(tmpdir.join("amap.conf"))
+    with open(registration_config, "w") as config_file:
+        config_file.write("")
+
+    for image_paths, expected_error in (
+        ("brain", None),
+        ("broken", "ValueError: broken brain"),
+    ):
+        job = {
+            "image_paths": image_paths,
+            "registration_output_folder": str(tmpdir.join(image_paths)),
+        }
+        output_folder, time_taken, error = register_job(
+            registration_config, job, {}, 1
+        )
+        assert output_folder == job["registration_output_folder"]
+        assert isinstance(time_taken, timedelta)
+        assert error == expected_error
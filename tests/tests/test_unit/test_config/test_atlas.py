@@ -0,0 +1,117 @@
+import os
+import itertools
+
+import numpy as np
+import nibabel as nb
+
+from amap.config.atlas import Atlas
+from amap.tools.source_files import source_config
+
+atlas_elements = ("annotations.nii", "brain_filtered.nii", "hemispheres.nii")
+
+
+def make_test_atlas(directory):
+    atlas_directory = os.path.join(directory, "atlas")
+    os.makedirs(atlas_directory)
+    affine = np.diag([0.1, 0.1, 0.1, 1])
+    for idx, element in enumerate(atlas_elements):
+        data = np.arange(4 * 5 * 6, dtype=np.uint16).reshape(4, 5, 6) + idx
+        nb.save(
+            nb.Nifti1Image(data, affine),
+            os.path.join(atlas_directory, element),
+        )
+
+    with open(source_config(), "r") as in_conf:
+        config = in_conf.read()
+    config = config.replace(
+        "base_folder = ''", f"base_folder = '{atlas_directory}'"
+    )
+    config_path = os.path.join(directory, "test.conf")
+    with open(config_path, "w") as out_conf:
+        out_conf.write(config)
+    return config_path
+
+
+def save_reoriented(config_path, output_directory, header_only):
+    atlas = Atlas(config_path, dest_folder=output_directory)
+    atlas.load_all()
+    atlas.reorientate_to_sample("coronal")
+    atlas.flip((True, True, False))
+    atlas.flip((False, False, True))
+    atlas.save_all(header_only=header_only)
+
+
+def test_header_only_reorientation(tmpdir):
+    tmpdir = str(tmpdir)
+    config_path = make_test_atlas(tmpdir)
+    data_directory = os.path.join(tmpdir, "data")
+    header_directory = os.path.join(tmpdir, "header")
+    os.makedirs(data_directory)
+    os.makedirs(header_directory)
+
+    save_reoriented(config_path, data_directory, header_only=False)
+    save_reoriented(config_path, header_directory, header_only=True)
+
+    for element in atlas_elements:
+        reoriented = nb.load(os.path.join(data_directory, element))
+        header_only = nb.load(os.path.join(header_directory, element))
+        reoriented_data = np.asanyarray(reoriented.dataobj)
+        header_only_data = np.asanyarray(header_only.dataobj)
+
+        # each voxel should have the same value at the same world coordinate
+        to_header_only_voxel = (
+            np.linalg.inv(header_only.affine) @ reoriented.affine
+        )
+        for voxel in itertools.product(*map(range, reoriented.shape)):
+            header_only_voxel = to_header_only_voxel @ (*voxel, 1)
+            header_only_voxel = tuple(
+                np.round(header_only_voxel[:3]).astype(int)
+            )
+            assert (
+                reoriented_data[voxel] == header_only_data[header_only_voxel]
+            )
+
+
+def test_header_only_reorientation_keeps_header(tmpdir):
+    tmpdir = str(tmpdir)
+    config_path = make_test_atlas(tmpdir)
+    atlas_directory = os.path.join(tmpdir, "atlas")
+    for idx, element in enumerate(atlas_elements):
+        data = np.arange(4 * 5 * 6, dtype=np.float64).reshape(4, 5, 6) + idx
+        image = nb.Nifti1Image(data * 0.5, np.diag([0.1, 0.1, 0.1, 1]))
+        image.set_data_dtype(np.int16)
+        image.header["descrip"] = b"test atlas"
+        image.header.set_intent("label")
+        image.header.set_xyzt_units("mm", "sec")
+        image.set_qform(image.affine, code=1)
+        image.set_sform(image.affine, code=4)
+        nb.save(image, os.path.join(atlas_directory, element))
+
+    data_directory = os.path.join(tmpdir, "data")
+    header_directory = os.path.join(tmpdir, "header")
+    os.makedirs(data_directory)
+    os.makedirs(header_directory)
+    save_reoriented(config_path, data_directory, header_only=False)
+    save_reoriented(config_path, header_directory, header_only=True)
+
+    for element in atlas_elements:
+        reoriented = nb.load(os.path.join(data_directory, element))
+        header_only = nb.load(os.path.join(header_directory, element))
+        reoriented_header = reoriented.header
+        header_only_header = header_only.header
+
+        assert header_only.get_data_dtype() == np.int16
+        assert header_only.get_data_dtype() == reoriented.get_data_dtype()
+        for field in ("descrip", "intent_code", "xyzt_units"):
+            assert header_only_header[field] == reoriented_header[field]
+        assert header_only_header.get_qform(coded=True)[1] == 1
+        assert header_only_header.get_sform(coded=True)[1] == 4
+        assert np.allclose(
+            header_only_header.get_qform(),
+            header_only_header.get_sform(),
+            atol=1e-4,
+        )
+        assert np.allclose(
+            np.sort(np.asanyarray(header_only.dataobj), axis=None),
+            np.sort(np.asanyarray(reoriented.dataobj), axis=None),
+        )
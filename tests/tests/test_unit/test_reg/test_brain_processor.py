@@ -0,0 +1,71 @@
+import logging
+import os
+import tracemalloc
+
+import numpy as np
+from brainio import brainio
+
+from amap.register.brain_processor import (
+    BrainProcessor,
+    filter_for_registration_low_memory,
+)
+
+downsampled_path = os.path.join(
+    "tests", "data", "registration_output", "downsampled.nii"
+)
+
+
+def test_filter_for_registration_parallel():
+    brain = brainio.load_any(downsampled_path, as_numpy=True)
+
+    filtered_serial = BrainProcessor.filter_for_registration(brain.copy())
+    filtered_parallel = BrainProcessor.filter_for_registration(
+        brain.copy(), n_processes=3
+    )
+
+    assert (filtered_serial == filtered_parallel).all()
+
+
+def test_filter_for_registration_batched():
+    brain = brainio.load_any(downsampled_path, as_numpy=True)
+
+    filtered_planes = BrainProcessor.filter_for_registration(brain.copy())
+    filtered_batched = BrainProcessor.filter_for_registration(
+        brain.copy(), batch_size=7
+    )
+
+    assert (filtered_planes == filtered_batched).all()
+
+
+def test_filter_for_registration_low_memory():
+    brain = brainio.load_any(downsampled_path, as_numpy=True)
+
+    tracemalloc.start()
+    filtered = BrainProcessor.filter_for_registration(brain.copy())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    tracemalloc.start()
+    filtered_low_memory = filter_for_registration_low_memory(brain.copy())
+    _, peak_low_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert peak_low_memory < peak / 3
+    assert filtered_low_memory.dtype == filtered.dtype
+    difference = filtered_low_memory.astype(np.int32) - filtered
+    assert np.abs(difference).max() <= 1
+
+
+def test_filter_low_memory_warns_about_ignored_options(caplog):
+    brain = brainio.load_any(downsampled_path, as_numpy=True)
+    brain_processor = BrainProcessor.__new__(BrainProcessor)
+
+    brain_processor.target_brain = brain.copy()
+    with caplog.at_level(logging.WARNING):
+        brain_processor.filter(low_memory=True)
+    assert not caplog.records
+
+    brain_processor.target_brain = brain.copy()
+    with caplog.at_level(logging.WARNING):
+        brain_processor.filter(n_processes=4, batch_size=32, low_memory=True)
+    assert "n_processes=4, batch_size=32" in caplog.text
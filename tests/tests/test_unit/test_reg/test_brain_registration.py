@@ -0,0 +1,48 @@
+import pytest
+
+from imlib.general.exceptions import SegmentationError
+
+from amap.register.brain_registration import BrainRegistration
+from amap.utils.paths import Paths
+from amap.utils.resources import ResourceMonitor
+
+
+class RegistrationParams:
+    def __init__(self, program_path):
+        self.affine_reg_program_path = program_path
+        self.segmentation_program_path = program_path
+
+    def format_affine_params(self):
+        return ""
+
+    def format_segmentation_params(self):
+        return ""
+
+
+def test_segmentation_error(tmpdir):
+    # a program that always fails
+    brain_reg = BrainRegistration(
+        None, Paths(str(tmpdir)), RegistrationParams("false"), n_processes=1
+    )
+    with pytest.raises(SegmentationError):
+        brain_reg.segment()
+    with pytest.raises(SegmentationError):
+        brain_reg.register_hemispheres()
+
+
+def test_recorded_threads(tmpdir):
+    resource_monitor = ResourceMonitor()
+    brain_reg = BrainRegistration(
+        None,
+        Paths(str(tmpdir)),
+        RegistrationParams("true"),
+        n_processes=4,
+        resource_monitor=resource_monitor,
+    )
+    brain_reg.register_affine()
+    brain_reg.segment()
+    # only the programs given the OpenMP flag use several threads
+    assert [
+        (record["stage"], record["n_threads"])
+        for record in resource_monitor.records
+    ] == [("affine", 4), ("segment", 1)]
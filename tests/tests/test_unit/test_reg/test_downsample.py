@@ -0,0 +1,32 @@
+import os
+
+import numpy as np
+from brainio import brainio
+
+from amap.register.downsample import (
+    get_plane_paths,
+    load_downsampled_streaming,
+)
+
+brain_dir = os.path.join("tests", "data", "brain")
+
+x_scaling = 0.4
+y_scaling = 0.4
+z_scaling = 0.37
+
+
+def test_load_downsampled_streaming(tmpdir):
+    downsampled = brainio.load_any(brain_dir, x_scaling, y_scaling, z_scaling)
+
+    paths = get_plane_paths(brain_dir)
+    downsampled_streaming = load_downsampled_streaming(
+        paths, x_scaling, y_scaling, z_scaling, chunk_size=17, n_processes=2
+    )
+    assert (downsampled == downsampled_streaming).all()
+
+    memmap_path = os.path.join(str(tmpdir), "downsampled.npy")
+    downsampled_memmap = load_downsampled_streaming(
+        paths, x_scaling, y_scaling, z_scaling, output_path=memmap_path
+    )
+    assert (downsampled == np.load(memmap_path)).all()
+    assert (downsampled == downsampled_memmap).all()
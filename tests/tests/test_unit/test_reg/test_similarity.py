@@ -0,0 +1,25 @@
+import numpy as np
+
+from amap.register.similarity import (
+    normalised_mutual_information,
+    correlation_coefficient,
+)
+
+
+def test_similarity():
+    random_state = np.random.RandomState(0)
+    image = random_state.random_sample((20, 20, 20))
+    noise = random_state.random_sample((20, 20, 20))
+
+    assert normalised_mutual_information(image, image) == 2
+    assert normalised_mutual_information(image, 2 * image + 1) == 2
+    assert normalised_mutual_information(image, noise) < 1.1
+    assert normalised_mutual_information(
+        image, image + 0.1 * noise
+    ) > normalised_mutual_information(image, image + noise)
+
+    assert correlation_coefficient(image, 2 * image) == 1
+    mask = image > 0.5
+    assert correlation_coefficient(image, image + 0.1 * noise, mask=mask) > (
+        correlation_coefficient(image, image + noise, mask=mask)
+    )
@@ -1,10 +1,26 @@
 import os
 
+import numpy as np
 import pandas as pd
+import pytest
 
-from amap.register.volume import calculate_volumes
+from brainio import brainio
+
+from amap.register.volume import (
+    UnknownAtlasValue,
+    add_structure_volume_to_df,
+    atlas_value_to_name,
+    calculate_volumes,
+    count_structure_voxels,
+    count_structure_voxels_in_slabs,
+    get_lateralised_atlas,
+    get_structure_ancestors,
+    roll_up_counts,
+    save_volume_hierarchy,
+)
 from amap.config.atlas import Atlas
 from amap.tools.source_files import source_custom_config
+from amap.tools.structures import StructureLookup
 
 volume_data_path = os.path.join("tests", "data", "register", "volume")
 registered_atlas_path = os.path.join(volume_data_path, "registered_atlas.nii")
@@ -39,3 +55,143 @@ def test_volume_calc(tmpdir):
     )
 
     assert (volumes_validate == volumes_test).all().all()
+
+
+def make_structure_lookup(structure_ids):
+    return StructureLookup(
+        pd.DataFrame(
+            {
+                "id": structure_ids,
+                "name": [str(structure_id) for structure_id in structure_ids],
+            }
+        )
+    )
+
+
+def test_count_structure_voxels():
+    structure_ids = np.array([0, 5, 182305712, 182305713])
+    atlas = np.array(
+        [[0, 5, 5, 182305712], [182305712, 7, 7, 5], [0, 5, 182305712, 7]],
+        dtype=np.float32,
+    )
+    hemispheres = np.array([[2, 2, 2, 2], [2, 2, 1, 1], [1, 1, 1, 0]])
+
+    counts, unknown_values = count_structure_voxels(
+        atlas, hemispheres, make_structure_lookup(structure_ids)
+    )
+    # left is 2, right is 1
+    assert (counts == [[1, 1], [2, 2], [2, 1], [0, 0]]).all()
+    assert list(unknown_values) == [7]
+
+
+def test_count_structure_voxels_in_slabs(tmpdir):
+    atlas = brainio.load_any(registered_atlas_path)
+    hemispheres = brainio.load_any(registered_hemispheres_path)
+    structure_ids = np.unique(atlas)[1::2].astype(np.float64)
+    structure_lookup = make_structure_lookup(structure_ids)
+    counts, unknown_values = count_structure_voxels(
+        atlas, hemispheres, structure_lookup
+    )
+
+    for slab_size, n_processes in ((1, 1), (2, 2)):
+        slab_counts, slab_unknown_values = count_structure_voxels_in_slabs(
+            registered_atlas_path,
+            registered_hemispheres_path,
+            structure_lookup,
+            slab_size=slab_size,
+            n_processes=n_processes,
+        )
+        assert (slab_counts == counts).all()
+        assert (slab_unknown_values == unknown_values).all()
+
+
+def test_volume_hierarchy(tmpdir):
+    structures = pd.DataFrame(
+        {
+            "id": [997, 8, 567, 688, 1000],
+            "name": ["root", "grey", "cerebrum", "cortex", "unused"],
+            "structure_id_path": [
+                "/997/",
+                "/997/8/",
+                "/997/8/567/",
+                "/997/8/567/688/",
+                "/997/1000/",
+            ],
+        }
+    )
+    counts = np.array([[1, 0], [0, 2], [3, 0], [4, 5], [0, 0]])
+
+    structure_positions, ancestor_positions, _ = get_structure_ancestors(
+        structures
+    )
+    rolled_up = roll_up_counts(counts, structure_positions, ancestor_positions)
+    assert (rolled_up == [[8, 7], [7, 7], [7, 5], [4, 5], [0, 0]]).all()
+
+    # the same hierarchy, from the parent of each structure
+    structures["parent_structure_id"] = [None, 997, 8, 567, 997]
+    parent_positions = get_structure_ancestors(
+        structures.drop(columns="structure_id_path")
+    )
+    assert (parent_positions[1] == ancestor_positions).all()
+
+    output_file = str(tmpdir.join("volumes_hierarchy.csv"))
+    save_volume_hierarchy(counts, structures, 0.5, output_file)
+    hierarchy = pd.read_csv(output_file)
+    assert list(hierarchy["structure_id"]) == [997, 8, 567, 688]
+    assert list(hierarchy["depth"]) == [0, 1, 2, 3]
+    assert list(hierarchy["total_volume_mm3"]) == [7.5, 7, 6, 4.5]
+
+
+def test_deprecated_volume_functions():
+    structures_df = pd.DataFrame(
+        {"id": [0, 5, 7, 113, 201], "name": ["bg", "a", "b", "c", "d"]}
+    )
+    structure_lookup = StructureLookup(structures_df)
+    atlas = brainio.load_any(registered_atlas_path)
+    hemispheres = brainio.load_any(registered_hemispheres_path)
+    counts, _ = count_structure_voxels(atlas, hemispheres, structure_lookup)
+    assert counts[3:].all()
+
+    with pytest.deprecated_call():
+        (
+            unique_vals_left,
+            unique_vals_right,
+            counts_left,
+            counts_right,
+        ) = get_lateralised_atlas(
+            registered_atlas_path, registered_hemispheres_path
+        )
+    for unique_vals, hemisphere_counts, idx in (
+        (unique_vals_left, counts_left, 0),
+        (unique_vals_right, counts_right, 1),
+    ):
+        for position, structure_id in enumerate(structure_lookup.ids):
+            index = np.flatnonzero(unique_vals == structure_id)
+            expected = hemisphere_counts[index[0]] if len(index) else 0
+            assert counts[position, idx] == expected
+
+    with pytest.deprecated_call():
+        assert atlas_value_to_name(7.0, structures_df) == "b"
+    with pytest.raises(UnknownAtlasValue), pytest.deprecated_call():
+        atlas_value_to_name(6, structures_df)
+
+    df = pd.DataFrame(
+        columns=[
+            "structure_name",
+            "left_volume_mm3",
+            "right_volume_mm3",
+            "total_volume_mm3",
+        ]
+    )
+    with pytest.deprecated_call():
+        df = add_structure_volume_to_df(
+            df,
+            5,
+            structures_df,
+            np.array([0, 5]),
+            np.array([0]),
+            np.array([10, 4]),
+            np.array([3]),
+            0.5,
+        )
+    assert df.values.tolist() == [["a", 2.0, 0, 2.0]]
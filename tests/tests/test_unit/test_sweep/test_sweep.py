@@ -0,0 +1,189 @@
+import os
+
+import numpy as np
+
+import amap.main
+from amap.main import main as register
+from amap.sweep import prepare_combination_folder
+from amap.utils.paths import Paths
+
+
+def write_file(path, contents="data"):
+    with open(path, "w") as file:
+        file.write(contents)
+
+
+class FakeAtlas:
+    atlas_conf = {
+        "atlas_name": "annotations.nii",
+        "brain_name": "brain_filtered.nii",
+        "hemispheres_name": "hemispheres.nii",
+        "structures_name": "structures.csv",
+    }
+
+    def __init__(self, atlas_folder, dest_folder=""):
+        self.atlas_folder = atlas_folder
+        self.dest_folder = dest_folder
+
+    def copy(self, dest_folder=""):
+        return FakeAtlas(self.atlas_folder, dest_folder=dest_folder)
+
+    def get_atlas_element_path(self, element):
+        return os.path.join(self.atlas_folder, self.atlas_conf[element])
+
+    def get_path(self):
+        return self.get_atlas_element_path("atlas_name")
+
+    def get_brain_path(self):
+        return self.get_atlas_element_path("brain_name")
+
+    def get_hemispheres_path(self):
+        return self.get_atlas_element_path("hemispheres_name")
+
+    def get_structures_path(self):
+        return self.get_atlas_element_path("structures_name")
+
+    def get_dest_path(self, element):
+        return os.path.join(self.dest_folder, self.atlas_conf[element])
+
+    def get_left_hemisphere_value(self):
+        return 2
+
+    def get_right_hemisphere_value(self):
+        return 1
+
+    def save_all(self, header_only=False):
+        for element in ("atlas_name", "brain_name", "hemispheres_name"):
+            write_file(self.get_dest_path(element))
+
+
+class FakeRegistrationParams:
+    transform_program_path = "reg_transform"
+    affine_reg_program_path = "reg_aladin"
+    freeform_reg_program_path = "reg_f3d"
+    segmentation_program_path = "reg_resample"
+
+    def __init__(self, config_path, **kwargs):
+        self.parameters = kwargs
+
+    def format_affine_params(self):
+        return ""
+
+    def format_freeform_params(self):
+        return str(self.parameters)
+
+    def format_segmentation_params(self):
+        return ""
+
+
+class FakeBrainProcessor:
+    def __init__(self, atlas, *args, **kwargs):
+        self.atlas = atlas
+        self.target_brain = np.zeros((2, 2, 2))
+
+    def swap_atlas_orientation_to_self(self):
+        pass
+
+    def flip_atlas(self, flips):
+        pass
+
+    def filter(self, **kwargs):
+        pass
+
+    def save(self, path):
+        write_file(path)
+
+
+class FakeBrainRegistration:
+    def __init__(self, registration_config, paths, *args, **kwargs):
+        self.paths = paths
+
+    def with_n_processes(self, n_processes):
+        return self
+
+    def register_affine(self):
+        write_file(self.paths.affine_matrix_path)
+        write_file(self.paths.tmp__affine_registered_atlas_brain_path)
+
+    def register_freeform(self):
+        write_file(self.paths.control_point_file_path)
+        write_file(self.paths.tmp__freeform_registered_atlas_brain_path)
+
+    def segment(self):
+        write_file(self.paths.registered_atlas_img_path)
+
+    def register_hemispheres(self):
+        write_file(self.paths.registered_hemispheres_img_path)
+
+    def generate_inverse_transforms(self):
+        write_file(self.paths.invert_affine_matrix_path)
+        write_file(self.paths.inverse_control_point_file_path)
+
+
+def fake_calculate_volumes(*args, hierarchy_output_file=None, **kwargs):
+    write_file(args[4])
+    write_file(hierarchy_output_file)
+
+
+def fake_calc_boundaries(registered_atlas, boundaries_out_path, **kwargs):
+    write_file(boundaries_out_path)
+
+
+def test_sweep_after_full_run(tmpdir, monkeypatch):
+    tmpdir = str(tmpdir)
+    for name, replacement in (
+        ("RegistrationParams", FakeRegistrationParams),
+        ("BrainProcessor", FakeBrainProcessor),
+        ("BrainRegistration", FakeBrainRegistration),
+        ("calculate_volumes", fake_calculate_volumes),
+        ("calc_boundaries", fake_calc_boundaries),
+    ):
+        monkeypatch.setattr(amap.main, name, replacement)
+
+    atlas_folder = os.path.join(tmpdir, "atlas")
+    output_folder = os.path.join(tmpdir, "output")
+    for folder in (atlas_folder, output_folder):
+        os.makedirs(folder)
+    atlas = FakeAtlas(atlas_folder)
+    for element in FakeAtlas.atlas_conf:
+        write_file(atlas.get_atlas_element_path(element))
+    registration_config = os.path.join(tmpdir, "amap.conf")
+    raw_data = os.path.join(tmpdir, "raw.tif")
+    write_file(registration_config)
+    write_file(raw_data)
+
+    # a complete run deletes the temporary files
+    register(
+        registration_config,
+        raw_data,
+        output_folder,
+        atlas=atlas,
+        n_processes=1,
+    )
+    paths = Paths(output_folder)
+    assert os.path.isfile(paths.registered_atlas_path)
+    assert not os.path.exists(paths.tmp__downsampled_filtered)
+
+    # the shared stages of a sweep in the same folder recreate them
+    register(
+        registration_config,
+        raw_data,
+        output_folder,
+        atlas=atlas,
+        n_processes=1,
+        stages=["preprocess", "affine"],
+    )
+    assert os.path.isfile(paths.tmp__downsampled_filtered)
+    combination_paths = prepare_combination_folder(
+        paths, os.path.join(output_folder, "sweep", "combination_000")
+    )
+    assert os.path.isfile(combination_paths.tmp__downsampled_filtered)
+    assert os.path.isfile(combination_paths.affine_matrix_path)
+
+    # rewriting the shared outputs in place leaves the combination as it was
+    with open(combination_paths.affine_matrix_path) as matrix_file:
+        affine_matrix = matrix_file.read()
+    with open(paths.affine_matrix_path, "w") as matrix_file:
+        matrix_file.write("rewritten")
+    with open(combination_paths.affine_matrix_path) as matrix_file:
+        assert matrix_file.read() == affine_matrix
@@ -0,0 +1,43 @@
+import os
+
+import pytest
+import numpy as np
+import tifffile
+
+from amap.ingest import ingest, IngestError
+from amap.register.downsample import (
+    get_plane_paths,
+    load_downsampled_streaming,
+)
+from amap.tools.chunk_store import ChunkStore, is_chunk_store
+
+brain_dir = os.path.join("tests", "data", "brain")
+
+
+def test_ingest(tmpdir):
+    paths = get_plane_paths(brain_dir)
+    image = np.stack([tifffile.imread(path) for path in paths])
+    store_path = str(tmpdir.join("brain_store"))
+
+    store = ingest(paths, store_path, chunks=(4, 16, 20), n_threads=2)
+    assert is_chunk_store(store_path)
+    assert store.shape == image.shape
+    assert store.dtype == image.dtype
+    assert (store[:] == image).all()
+    assert (store[5] == image[5]).all()
+    assert (store[3:10, 7:40:3, -25:] == image[3:10, 7:40:3, -25:]).all()
+    assert (store.to_dask()[2:6, 10:30].compute() == image[2:6, 10:30]).all()
+
+    with pytest.raises(IngestError):
+        ingest(paths, store_path)
+    # e.g. "amap_ingest raw/ store/"
+    store = ingest(paths, store_path + os.sep, overwrite=True)
+    assert (store[:] == image).all()
+
+    downsampled = load_downsampled_streaming(
+        paths, 0.4, 0.4, 0.37, chunk_size=8
+    )
+    downsampled_store = load_downsampled_streaming(
+        ChunkStore(store_path), 0.4, 0.4, 0.37, chunk_size=8
+    )
+    assert (downsampled == downsampled_store).all()
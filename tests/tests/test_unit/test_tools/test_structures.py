@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+
+from amap.tools.structures import StructureLookup
+
+
+def test_structure_lookup(tmpdir):
+    structures_path = str(tmpdir.join("structures.csv"))
+    pd.DataFrame(
+        {
+            "id": [997, 8, 567, 8],
+            "name": ["root", "Grey matter", "Cerebrum", "Duplicate"],
+            "acronym": ["root", "grey", "CH", "dup"],
+            "rgb_triplet": [
+                "[255, 255, 255]",
+                "[191, 218, 227]",
+                "[176, 240, 255]",
+                "[0, 0, 0]",
+            ],
+        }
+    ).to_csv(structures_path, index=False)
+
+    lookup = StructureLookup.from_file(structures_path)
+    assert StructureLookup.from_file(structures_path) is lookup
+    assert list(lookup.ids) == [8, 567, 997]
+    assert list(lookup.structures.index) == [1, 2, 0]
+
+    assert lookup.get_name(8) == "Grey matter"
+    assert lookup.get_name(np.float32(567)) == "Cerebrum"
+    assert lookup.get_acronym(997) == "root"
+    assert lookup.get_colour(567) == (176, 240, 255)
+    assert lookup.get_name(5) is None
+
+    labels = np.array([[0, 8.0], [567, 997.5]])
+    assert (lookup.get_positions(labels) == [[-1, 0], [1, -1]]).all()
@@ -0,0 +1,122 @@
+import os
+import time
+
+from amap.config.atlas import Atlas
+from amap.utils.cache import AtlasCache, FileCache, file_checksum, hash_inputs
+
+from tests.tests.test_unit.test_config.test_atlas import make_test_atlas
+
+
+def write_file(path, contents):
+    with open(path, "w") as file:
+        file.write(contents)
+
+
+def test_file_cache(tmpdir):
+    tmpdir = str(tmpdir)
+    cache = FileCache(os.path.join(tmpdir, "cache"), max_entries=2)
+    source = os.path.join(tmpdir, "source.txt")
+    destination = os.path.join(tmpdir, "destination.txt")
+    write_file(source, "atlas")
+
+    key = hash_inputs({"orientation": "coronal"})
+    assert not cache.fetch(key, {"atlas.nii": destination})
+    cache.store(key, {"atlas.nii": source})
+    assert cache.fetch(key, {"atlas.nii": destination})
+    with open(destination, "r") as file:
+        assert file.read() == "atlas"
+
+    # corrupt entries are removed
+    cached_file = cache.get_entry_paths(key)["atlas.nii"]
+    os.remove(cached_file)
+    write_file(cached_file, "corrupt")
+    assert not cache.fetch(key, {"atlas.nii": destination})
+    assert cache.get_keys() == []
+
+    # least recently used entries are evicted
+    keys = [hash_inputs({"orientation": idx}) for idx in range(3)]
+    for idx, key in enumerate(keys):
+        cache.store(key, {"atlas.nii": source})
+        manifest = cache.get_entry_directory(key) / "manifest.json"
+        os.utime(manifest, (idx + 1, idx + 1))
+    assert cache.get_keys() == keys[1:]
+
+    # recently used entries are not evicted
+    recent_key = hash_inputs({"orientation": "recent"})
+    cache.store(recent_key, {"atlas.nii": source})
+    assert cache.get_keys() == keys[2:] + [recent_key]
+    for orientation in ("newer", "newest"):
+        cache.store(hash_inputs({"orientation": orientation}), {"a": source})
+    assert len(cache.get_keys()) == 3
+    assert cache.get_keys()[0] == recent_key
+
+
+def test_atlas_cache_key(tmpdir):
+    tmpdir = str(tmpdir)
+    cache = AtlasCache(os.path.join(tmpdir, "cache"))
+    atlas_flips = [(True, True, False)]
+    first_directory = os.path.join(tmpdir, "first")
+    second_directory = os.path.join(tmpdir, "second")
+    os.makedirs(first_directory)
+    os.makedirs(second_directory)
+    atlas = Atlas(make_test_atlas(first_directory))
+    key = cache.get_key(atlas, "coronal", atlas_flips)
+
+    # the key depends on the contents of the atlas, not its path or times
+    copied_atlas = Atlas(make_test_atlas(second_directory))
+    assert cache.get_key(copied_atlas, "coronal", atlas_flips) == key
+    atlas_path = atlas.get_atlas_element_path("atlas_name")
+    os.utime(atlas_path, (time.time() + 10, time.time() + 10))
+    assert cache.get_key(atlas, "coronal", atlas_flips) == key
+
+    # an edit of the same size, with the same modification time
+    stat = os.stat(atlas_path)
+    with open(atlas_path, "r+b") as atlas_file:
+        atlas_file.seek(-1, os.SEEK_END)
+        last_byte = atlas_file.read(1)
+        atlas_file.seek(-1, os.SEEK_END)
+        atlas_file.write(bytes([last_byte[0] ^ 1]))
+    os.utime(atlas_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert cache.get_key(atlas, "coronal", atlas_flips) != key
+
+
+def test_atlas_template_cache(tmpdir):
+    tmpdir = str(tmpdir)
+    config_path = make_test_atlas(tmpdir)
+    atlas_flips = [(True, True, False), (False, False, False)]
+    cache = AtlasCache(os.path.join(tmpdir, "cache"))
+
+    for output_directory in ("first", "second"):
+        output_directory = os.path.join(tmpdir, output_directory)
+        os.makedirs(output_directory)
+        atlas = Atlas(config_path, dest_folder=output_directory)
+        atlas.load_all()
+        atlas.reorientate_to_sample("coronal")
+        for flip in atlas_flips:
+            atlas.flip(flip)
+        cache.save_all(atlas, "coronal", atlas_flips)
+
+    assert len(cache.get_keys()) == 1
+
+    # once cached, the atlas images do not need to be loaded
+    output_directory = os.path.join(tmpdir, "third")
+    os.makedirs(output_directory)
+    unloaded_atlas = Atlas(config_path, dest_folder=output_directory)
+    assert cache.fetch_atlas(unloaded_atlas, "coronal", atlas_flips)
+    assert unloaded_atlas._data is None
+    assert file_checksum(
+        unloaded_atlas.get_dest_path("atlas_name")
+    ) == file_checksum(atlas.get_dest_path("atlas_name"))
+    assert not cache.fetch_atlas(unloaded_atlas, "sagittal", atlas_flips)
+    template_path = cache.get_template_path(atlas, "coronal", atlas_flips)
+    assert file_checksum(template_path) == file_checksum(
+        atlas.get_dest_path("brain_name")
+    )
+    assert cache.get_template_path(atlas, "sagittal", atlas_flips) is None
+
+    # saving over the (linked) files of a run does not change the cache
+    cached_checksum = file_checksum(template_path)
+    atlas.flip((False, False, True))
+    atlas.save_all()
+    assert file_checksum(template_path) == cached_checksum
+    assert cache.get_template_path(atlas, "coronal", atlas_flips) is not None
@@ -0,0 +1,96 @@
+import os
+
+from amap.utils.manifest import RunManifest
+
+
+def write_file(path, contents):
+    with open(path, "w") as file:
+        file.write(contents)
+
+
+def make_manifest(directory, bending_energy_weight=0.95):
+    paths = {
+        name: os.path.join(directory, name)
+        for name in ("raw", "config", "filtered", "affine", "cpp", "atlas")
+    }
+    manifest = RunManifest(os.path.join(directory, "manifest.json"))
+    manifest.define_stage(
+        "preprocess",
+        inputs=[paths["config"]],
+        raw_inputs=[paths["raw"]],
+        temporary_outputs=[paths["filtered"]],
+    )
+    manifest.define_stage(
+        "affine",
+        dependencies=["preprocess"],
+        inputs=[paths["filtered"]],
+        outputs=[paths["affine"]],
+    )
+    manifest.define_stage(
+        "freeform",
+        dependencies=["preprocess", "affine"],
+        inputs=[paths["filtered"], paths["affine"]],
+        outputs=[paths["cpp"]],
+        parameters={"bending_energy_weight": bending_energy_weight},
+    )
+    manifest.define_stage(
+        "segment",
+        dependencies=["freeform"],
+        inputs=[paths["cpp"]],
+        outputs=[paths["atlas"]],
+    )
+    return manifest, paths
+
+
+def run_stages(manifest, paths):
+    outputs = {
+        "preprocess": "filtered",
+        "affine": "affine",
+        "freeform": "cpp",
+        "segment": "atlas",
+    }
+    ran = []
+    for stage, output in outputs.items():
+        if manifest.needs_run(stage):
+            write_file(paths[output], stage)
+            manifest.record(stage)
+            ran.append(stage)
+    return ran
+
+
+def test_run_manifest(tmpdir):
+    tmpdir = str(tmpdir)
+    manifest, paths = make_manifest(tmpdir)
+    write_file(paths["raw"], "raw")
+    write_file(paths["config"], "config")
+    assert run_stages(manifest, paths) == [
+        "preprocess",
+        "affine",
+        "freeform",
+        "segment",
+    ]
+
+    # nothing has changed
+    manifest, paths = make_manifest(tmpdir)
+    assert run_stages(manifest, paths) == []
+
+    # a changed parameter only affects that stage and those after it. The
+    # temporary output needed by the stage is recreated.
+    os.remove(paths["filtered"])
+    manifest, paths = make_manifest(tmpdir, bending_energy_weight=0.5)
+    assert run_stages(manifest, paths) == ["preprocess", "freeform", "segment"]
+
+    # a truncated output is not trusted
+    write_file(paths["atlas"], "")
+    manifest, paths = make_manifest(tmpdir, bending_energy_weight=0.5)
+    assert run_stages(manifest, paths) == ["segment"]
+
+    # a changed input affects everything after it
+    write_file(paths["config"], "new config")
+    manifest, paths = make_manifest(tmpdir, bending_energy_weight=0.5)
+    assert run_stages(manifest, paths) == [
+        "preprocess",
+        "affine",
+        "freeform",
+        "segment",
+    ]
@@ -0,0 +1,52 @@
+import sys
+import json
+
+import pytest
+
+from imlib.general.system import SafeExecuteCommandError
+
+from amap.utils.resources import ResourceMonitor
+
+
+def test_resource_monitor(tmpdir):
+    log_path = str(tmpdir.join("stage.log"))
+    error_path = str(tmpdir.join("stage.err"))
+    # allocate ~50MB, and spend some CPU time
+    cmd = (
+        f'{sys.executable} -c "data = bytearray(50 * 2 ** 20); '
+        f"sum(range(2 * 10 ** 6)); print('done')\""
+    )
+
+    monitor = ResourceMonitor()
+    monitor.execute("affine", cmd, log_path, error_path, n_threads=2)
+    with open(log_path) as log_file:
+        assert log_file.read().strip() == "done"
+
+    (record,) = monitor.records
+    assert record["stage"] == "affine"
+    assert record["n_threads"] == 2
+    assert record["wall_time_s"] > 0
+    assert record["cpu_time_s"] > 0
+    assert record["peak_rss_mb"] > 50
+    assert record["thread_utilisation"] == pytest.approx(
+        record["cpu_utilisation"] / 2
+    )
+
+    monitor.save_json(str(tmpdir.join("resource_usage.json")))
+    with open(str(tmpdir.join("resource_usage.json"))) as json_file:
+        assert json.load(json_file)[0]["stage"] == "affine"
+
+    monitor.save_csv(str(tmpdir.join("resource_usage.csv")))
+    with open(str(tmpdir.join("resource_usage.csv"))) as csv_file:
+        assert len(csv_file.readlines()) == 2
+
+
+def test_resource_monitor_failure(tmpdir):
+    log_path = str(tmpdir.join("stage.log"))
+    error_path = str(tmpdir.join("stage.err"))
+    cmd = f"{sys.executable} -c \"raise SystemExit('failed stage')\""
+
+    monitor = ResourceMonitor()
+    with pytest.raises(SafeExecuteCommandError, match="failed stage"):
+        monitor.execute("segment", cmd, log_path, error_path, n_threads=1)
+    assert not monitor.records
@@ -0,0 +1,131 @@
+import time
+import threading
+
+import pytest
+
+from concurrent.futures import ProcessPoolExecutor
+
+from amap.utils.scheduler import (
+    Scheduler,
+    SchedulerError,
+    get_process_pool_context,
+)
+
+held_lock = threading.Lock()
+
+
+def test_scheduler():
+    order = []
+    threads = {}
+    lock = threading.Lock()
+
+    def stage(name, duration=0.05):
+        def function(n_threads=None):
+            time.sleep(duration)
+            with lock:
+                order.append(name)
+                threads[name] = n_threads
+
+        return function
+
+    scheduler = Scheduler(n_threads=8)
+    scheduler.add_stage("preprocess", stage("preprocess"))
+    scheduler.add_stage(
+        "affine", stage("affine"), dependencies=["preprocess"], threaded=True
+    )
+    scheduler.add_stage(
+        "freeform", stage("freeform"), dependencies=["affine"], threaded=True
+    )
+    scheduler.add_stage(
+        "skipped", stage("skipped"), dependencies=["affine"], run=False
+    )
+    scheduler.add_stage(
+        "segment",
+        stage("segment"),
+        dependencies=["freeform", "skipped"],
+        threaded=True,
+    )
+    scheduler.add_stage(
+        "inverse_transform",
+        stage("inverse_transform", duration=0.3),
+        dependencies=["affine"],
+        threaded=True,
+    )
+    scheduler.run()
+
+    assert order == [
+        "preprocess",
+        "affine",
+        "freeform",
+        "segment",
+        "inverse_transform",
+    ]
+    # freeform and the inverse transform share the thread budget
+    assert threads["affine"] == 8
+    assert threads["freeform"] == 4
+    assert threads["inverse_transform"] == 4
+    assert [timing[0] for timing in scheduler.get_timings()] == [
+        "preprocess",
+        "affine",
+        "freeform",
+        "segment",
+        "inverse_transform",
+    ]
+
+    with pytest.raises(SchedulerError):
+        scheduler.add_stage("volumes", stage("volumes"), ["unknown"])
+
+
+def test_scheduler_error():
+    def fail():
+        raise ValueError
+
+    scheduler = Scheduler()
+    scheduler.add_stage("fail", fail)
+    scheduler.add_stage("never", lambda: pytest.fail(), dependencies=["fail"])
+    with pytest.raises(ValueError):
+        scheduler.run()
+
+
+def test_scheduler_stage_names():
+    ran = []
+    scheduler = Scheduler()
+    for name in ("preprocess", "affine", "freeform"):
+        scheduler.add_stage(name, lambda name=name: ran.append(name))
+    scheduler.run(stage_names=["preprocess", "affine"])
+    assert ran == ["preprocess", "affine"]
+    # the stages are only restricted for that run
+    scheduler.run()
+    assert ran == ["preprocess", "affine", "preprocess", "affine", "freeform"]
+
+
+def acquire_held_lock():
+    acquired = held_lock.acquire(timeout=5)
+    if acquired:
+        held_lock.release()
+    return acquired
+
+
+def test_process_pool_in_stage():
+    # a forked child would inherit the lock held by the other stage
+    pool_finished = threading.Event()
+    results = []
+
+    def hold_lock():
+        with held_lock:
+            pool_finished.wait(timeout=30)
+
+    def use_pool():
+        try:
+            with ProcessPoolExecutor(
+                max_workers=1, mp_context=get_process_pool_context()
+            ) as pool:
+                results.append(pool.submit(acquire_held_lock).result())
+        finally:
+            pool_finished.set()
+
+    scheduler = Scheduler()
+    scheduler.add_stage("hold_lock", hold_lock)
+    scheduler.add_stage("use_pool", lambda: time.sleep(0.1) or use_pool())
+    scheduler.run()
+    assert results == [True]
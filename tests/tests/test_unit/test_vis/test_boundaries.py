@@ -0,0 +1,118 @@
+import os
+
+import numpy as np
+import nibabel as nib
+
+from skimage.segmentation import find_boundaries
+from imlib.image.scale import scale_and_convert_to_16_bits
+
+from amap.vis.boundaries import (
+    GetAtlas,
+    find_boundaries_in_slabs,
+    save_sparse_boundaries,
+    SparseBoundaries,
+)
+
+test_config_path = os.path.join("tests", "data", "config", "test.conf")
+
+
+def get_atlas(dtype):
+    rng = np.random.default_rng(0)
+    blocks = rng.integers(0, 6, (6, 5, 7))
+    atlas = np.repeat(np.repeat(np.repeat(blocks, 3, 0), 3, 1), 3, 2)
+    return atlas.astype(dtype)
+
+
+def test_find_boundaries_in_slabs(tmpdir):
+    for dtype in (np.uint32, np.float32):
+        atlas = get_atlas(dtype)
+        for atlas_labels in (False, True):
+            boundaries = find_boundaries(atlas, mode="inner")
+            if atlas_labels:
+                boundaries = boundaries * atlas
+            expected = scale_and_convert_to_16_bits(boundaries)
+
+            for slab_size, n_processes in ((1, 1), (4, 2), (100, 1)):
+                result = find_boundaries_in_slabs(
+                    atlas,
+                    slab_size=slab_size,
+                    n_processes=n_processes,
+                    atlas_labels=atlas_labels,
+                )
+                assert result.dtype == np.uint16
+                assert (result == expected).all()
+
+    memmap_path = str(tmpdir.join("boundaries.npy"))
+    result = find_boundaries_in_slabs(
+        get_atlas(np.uint32), slab_size=5, memmap_path=memmap_path
+    )
+    assert (np.load(memmap_path) == result).all()
+
+
+def test_find_boundaries_label_ids():
+    for dtype, label_dtype in (
+        (np.uint16, np.uint16),
+        (np.float32, np.uint32),
+    ):
+        atlas = get_atlas(dtype) * 1000
+        expected = np.where(find_boundaries(atlas, mode="inner"), atlas, 0)
+        for slab_size, n_processes in ((1, 1), (4, 2)):
+            result = find_boundaries_in_slabs(
+                atlas,
+                slab_size=slab_size,
+                n_processes=n_processes,
+                label_ids=True,
+            )
+            assert result.dtype == label_dtype
+            assert (result == expected).all()
+
+
+def test_find_boundaries_in_slabs_nifti_proxy(tmpdir):
+    atlas = get_atlas(np.float32)
+    atlas_path = str(tmpdir.join("atlas.nii"))
+    nib.save(nib.Nifti1Image(atlas, np.eye(4)), atlas_path)
+    atlas_proxy = nib.load(atlas_path).dataobj
+
+    expected = scale_and_convert_to_16_bits(
+        find_boundaries(atlas, mode="inner") * atlas
+    )
+    for n_processes in (1, 2):
+        result = find_boundaries_in_slabs(
+            atlas_proxy,
+            slab_size=4,
+            n_processes=n_processes,
+            atlas_labels=True,
+        )
+        assert (result == expected).all()
+
+    expected = np.where(find_boundaries(atlas, mode="inner"), atlas, 0)
+    result = find_boundaries_in_slabs(atlas_proxy, slab_size=4, label_ids=True)
+    assert (result == expected).all()
+
+
+def test_sparse_boundaries(tmpdir):
+    atlas = get_atlas(np.uint16) * 1000
+    boundaries = np.where(find_boundaries(atlas, mode="inner"), atlas, 0)
+    sparse_path = str(tmpdir.join("boundaries.npz"))
+    save_sparse_boundaries(boundaries, sparse_path, atlas_scale=(1, 2, 3))
+
+    sparse = SparseBoundaries(sparse_path)
+    assert sparse.shape == boundaries.shape
+    assert sparse.dtype == boundaries.dtype
+    assert (sparse.scale == (1, 2, 3)).all()
+    assert (sparse.get_plane(4) == boundaries[:, :, 4]).all()
+    assert (sparse.to_array() == boundaries).all()
+    assert (sparse.to_dask().compute() == np.swapaxes(boundaries, 2, 0)).all()
+
+
+def test_get_atlas(tmpdir):
+    atlas = get_atlas(np.float32)
+    atlas_path = str(tmpdir.join("atlas.nii"))
+    nib.save(nib.Nifti1Image(atlas, np.eye(4)), atlas_path)
+
+    atlas_info = GetAtlas(atlas_path, atlas_config=test_config_path)
+    assert isinstance(atlas_info.atlas, np.ndarray)
+    assert (atlas_info.atlas == atlas).all()
+    assert (
+        np.asarray(atlas_info.atlas_proxy[..., 2:5]) == atlas[..., 2:5]
+    ).all()
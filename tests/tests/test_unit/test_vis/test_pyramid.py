@@ -0,0 +1,49 @@
+import os
+
+import numpy as np
+
+from amap.vis.pyramid import get_n_levels, downsample_slab, get_pyramid
+
+
+def test_get_n_levels():
+    assert get_n_levels((100, 200, 256), min_size=256) == 1
+    assert get_n_levels((100, 200, 257), min_size=256) == 2
+    assert get_n_levels((10, 1000, 1000), min_size=256) == 3
+
+
+def test_downsample_slab():
+    slab = np.arange(2 * 4 * 5, dtype=np.float32).reshape(2, 4, 5)
+    downsampled = downsample_slab(slab)
+    assert downsampled.shape == (1, 2, 3)
+    assert downsampled[0, 0, 0] == slab[:2, :2, :2].mean()
+    # the edge is repeated to fill the last block
+    assert downsampled[0, 0, 2] == slab[:2, :2, 4].mean()
+
+    labels = downsample_slab(slab.astype(np.uint32), labels=True)
+    assert labels.shape == (1, 2, 3)
+    assert (labels == slab[:1, ::2, ::2]).all()
+
+
+def test_get_pyramid(tmpdir):
+    image = np.random.default_rng(0).random((9, 40, 30)).astype(np.float32)
+    image_path = str(tmpdir.join("image.npy"))
+    np.save(image_path, image)
+    cache_directory = str(tmpdir.join("pyramid"))
+
+    pyramid = get_pyramid(
+        image, cache_directory, "image", [image_path], min_size=10
+    )
+    assert [level.shape for level in pyramid] == [
+        (9, 40, 30),
+        (5, 20, 15),
+        (3, 10, 8),
+    ]
+    assert pyramid[0] is image
+    assert np.allclose(pyramid[1][0, 0, 0], image[:2, :2, :2].mean())
+    assert np.allclose(pyramid[2][-1], downsample_slab(pyramid[1][-1:]))
+
+    # the cached levels are reused
+    level_path = os.path.join(cache_directory, "image", "level_1.npy")
+    modified_time = os.path.getmtime(level_path)
+    get_pyramid(image, cache_directory, "image", [image_path], min_size=10)
+    assert os.path.getmtime(level_path) == modified_time
@@ -0,0 +1,84 @@
+import pytest
+import numpy as np
+import pandas as pd
+
+from amap.tools.structures import StructureLookup
+from amap.vis.roi import (
+    RoiError,
+    get_roi_structure_ids,
+    crop_roi,
+    upsample_crop,
+)
+
+
+def get_structure_lookup():
+    return StructureLookup(
+        pd.DataFrame(
+            {
+                "id": [997, 8, 567, 688, 1089],
+                "name": [
+                    "root",
+                    "Grey matter",
+                    "Cerebrum",
+                    "Cerebral cortex",
+                    "Hippocampal formation",
+                ],
+                "acronym": ["root", "grey", "CH", "CTX", "HPF"],
+                "structure_id_path": [
+                    "/997/",
+                    "/997/8/",
+                    "/997/8/567/",
+                    "/997/8/567/688/",
+                    "/997/8/567/1089/",
+                ],
+            }
+        )
+    )
+
+
+def test_get_roi_structure_ids():
+    lookup = get_structure_lookup()
+    assert list(get_roi_structure_ids(["ctx"], lookup)) == [688]
+    assert list(get_roi_structure_ids(["1089", "CTX"], lookup)) == [688, 1089]
+    assert list(get_roi_structure_ids(["Cerebrum"], lookup)) == [
+        567,
+        688,
+        1089,
+    ]
+    with pytest.raises(RoiError):
+        get_roi_structure_ids(["Cerebellum"], lookup)
+
+
+def test_crop_roi():
+    atlas = np.zeros((10, 12, 14), dtype=np.uint32)
+    atlas[2:4, 5:8, 6:9] = 688
+    atlas[6:8, 1:3, 10:12] = 1089
+    scales = (2, 3, 2.5)
+    raw_shape = (20, 36, 35)
+    # the atlas, at the resolution of the raw data
+    raw = upsample_crop(atlas, [(0, size) for size in raw_shape], scales)
+
+    raw_crop, atlas_crop, raw_bounds = crop_roi(atlas, raw, [688], scales)
+    box = tuple(slice(start, stop) for start, stop in raw_bounds)
+    assert (raw_crop == raw[box]).all()
+    assert (atlas_crop == raw_crop).all()
+    # the whole structure, and nothing of the other, is in the crop
+    assert (raw_crop == 688).sum() == (raw == 688).sum()
+    assert not (raw_crop == 1089).any()
+
+    raw_crop, _, _ = crop_roi(atlas, raw, [688, 1089], scales, padding=1)
+    assert (raw_crop == 1089).sum() == (raw == 1089).sum()
+
+    with pytest.raises(RoiError):
+        crop_roi(atlas, raw, [567], scales)
+
+
+def test_crop_roi_boundary_planes():
+    atlas = np.zeros((5, 5, 5), dtype=np.uint32)
+    atlas[1:3, 1:3, 1:3] = 688
+    raw = np.zeros((10, 10, 10))
+
+    # atlas voxels 1 and 2 cover raw voxels 1 to 4
+    _, atlas_crop, raw_bounds = crop_roi(atlas, raw, [688], (2, 2, 2))
+    assert raw_bounds == [(1, 5)] * 3
+    assert (atlas_crop == 688).all()
@@ -0,0 +1,29 @@
+import pandas as pd
+
+from amap.tools.structures import StructureLookup
+from amap.vis.vis import get_label_value, get_structure_message
+
+
+class Layer:
+    def __init__(self, value, multiscale=False):
+        self.value = value
+        self.multiscale = multiscale
+
+    def get_value(self):
+        return self.value
+
+
+def test_get_structure_message():
+    structure_lookup = StructureLookup(
+        pd.DataFrame(
+            {"id": [688], "name": ["Cerebral cortex"], "acronym": ["CTX"]}
+        )
+    )
+    for layer in (Layer(688), Layer((2, 688), multiscale=True)):
+        assert (
+            get_structure_message(get_label_value(layer), structure_lookup)
+            == "Cerebral cortex (CTX)"
+        )
+    assert get_label_value(Layer(None, multiscale=True)) is None
+    assert get_structure_message(0, structure_lookup) == "No label here!"
+    assert get_structure_message(1, structure_lookup) == "Unknown region"